@@ -0,0 +1,51 @@
+"""
+Compare the timestamp parsers of ehr_dates against datetime.strptime.
+
+Run with `PYTHONPATH=src python benchmarks/bench_dates.py`.
+"""
+from datetime import datetime, timedelta
+import random
+import timeit
+from ehr_dates import (
+    DATE_FORMAT,
+    parse_datetime,
+    to_datetime64,
+)
+
+SAMPLES = 100_000
+
+
+def timestamps(count: int, seed: int = 0) -> list[str]:
+    """Generate timestamps in the EHR layout."""
+    rng = random.Random(seed)
+    start = datetime(1920, 1, 1)
+    return [
+        (start + timedelta(seconds=rng.randrange(3_000_000_000))).strftime(
+            DATE_FORMAT
+        )[:-3]
+        for _ in range(count)
+    ]
+
+
+def main() -> None:
+    """Time every parser on the same timestamps."""
+    values = timestamps(SAMPLES)
+    scenarios = {
+        "strptime": lambda: [
+            datetime.strptime(value, DATE_FORMAT) for value in values
+        ],
+        "parse_datetime": lambda: [parse_datetime(value) for value in values],
+        "to_datetime64": lambda: to_datetime64(values),
+    }
+    baseline = None
+    for name, scenario in scenarios.items():
+        seconds = min(timeit.repeat(scenario, number=1, repeat=3))
+        baseline = baseline or seconds
+        print(
+            f"{name:<28} {seconds * 1e9 / SAMPLES:8.0f} ns/value "
+            f"{baseline / seconds:6.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+"""
+Run the EHR benchmark scenarios and write the results as JSON.
+
+Run with `PYTHONPATH=src python -m benchmarks.run --scale 10k`, and pass
+--compare with an earlier results file to flag regressions.
+"""
+import argparse
+from datetime import datetime
+from functools import partial
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import typing
+import ehr_cache
+from ehr_backend import BACKENDS, Backend, create_backend
+from ehr_cohort import EHRCohort
+from ehr_connection import using_database
+from ehr_module import parse_columnar, parse_data, Patient
+from benchmarks.synthetic import SCALES, write_synthetic_files
+
+Scenario = typing.Callable[[], object]
+# Patients sampled by the per-patient scenarios
+PATIENT_SAMPLE = 1_000
+# Slowdown over the compared results reported as a regression
+REGRESSION_THRESHOLD = 1.2
+SICK_LAB = ("METABOLIC: ALBUMIN", "<", 3.5)
+
+
+def measure(scenario: Scenario, repeats: int) -> dict[str, float]:
+    """
+    Time a scenario and summarize the timings in seconds.
+
+    ehr_cache is cleared before every repeat, so repeats after the first
+    do not time cache hits instead of the queries.
+    """
+    timings = []
+    for _ in range(repeats):
+        ehr_cache.get_cache().clear()
+        start = time.perf_counter()
+        scenario()
+        timings.append(time.perf_counter() - start)
+    return {
+        "min": min(timings),
+        "mean": statistics.fmean(timings),
+        "median": statistics.median(timings),
+    }
+
+
+def scenarios(patient_filename: str, lab_filename: str) -> dict[str, Scenario]:
+    """Build the scenarios over loaded synthetic files."""
+    patients = parse_data(patient_filename, lab_filename)
+    sample = patients[:PATIENT_SAMPLE]
+    lazy_sample = [Patient(p.patient_id, p.patient_labs) for p in sample]
+
+    return {
+        "parse_data": lambda: parse_data(patient_filename, lab_filename),
+        "parse_columnar": lambda: parse_columnar(
+            patient_filename, lab_filename
+        ),
+        "Patient.age (database)": lambda: [p.age for p in lazy_sample],
+        "Patient.age (cohort)": lambda: [p.age for p in sample],
+        "Patient.is_sick": lambda: [p.is_sick(*SICK_LAB) for p in sample],
+        "Patient.initial_age (database)": lambda: [
+            p.initial_age() for p in lazy_sample
+        ],
+        "Patient.initial_age (cohort)": lambda: [
+            p.initial_age() for p in sample
+        ],
+        "cohort scan": lambda: scan_cohort(EHRCohort.from_database()),
+    }
+
+
+def backend_scenarios(
+    backend: Backend, patient_filename: str, lab_filename: str
+) -> dict[str, Scenario]:
+    """Build the scenarios shared by every storage backend."""
+    patients = backend.load(patient_filename, lab_filename)
+    sample = patients[:PATIENT_SAMPLE]
+
+    def active(scenario: Scenario) -> Scenario:
+        def run_active() -> object:
+            with backend.active():
+                return scenario()
+
+        return run_active
+
+    return {
+        f"{backend.name}: load": active(
+            partial(backend.load, patient_filename, lab_filename)
+        ),
+        f"{backend.name}: Patient.is_sick": active(
+            lambda: [p.is_sick(*SICK_LAB) for p in sample]
+        ),
+        f"{backend.name}: cohort scan": active(
+            lambda: scan_cohort(backend.cohort())
+        ),
+    }
+
+
+def scan_cohort(cohort: EHRCohort) -> None:
+    """Compute every cohort metric."""
+    cohort.ages()
+    cohort.initial_ages()
+    cohort.is_sick(*SICK_LAB)
+
+
+def run(scale: str, repeats: int, seed: int) -> dict[str, typing.Any]:
+    """Generate files at a scale and run every scenario on them."""
+    with tempfile.TemporaryDirectory() as directory:
+        patient_filename = os.path.join(directory, "patients.txt")
+        lab_filename = os.path.join(directory, "labs.txt")
+        patient_count, lab_count = write_synthetic_files(
+            patient_filename, lab_filename, SCALES[scale], seed
+        )
+        with using_database(os.path.join(directory, "ehr.db")):
+            results = [
+                {"name": name, **measure(scenario, repeats)}
+                for name, scenario in scenarios(
+                    patient_filename, lab_filename
+                ).items()
+            ]
+        for backend_name in BACKENDS:
+            with create_backend(
+                backend_name, os.path.join(directory, "backend.db")
+            ) as backend:
+                results.extend(
+                    {"name": name, **measure(scenario, repeats)}
+                    for name, scenario in backend_scenarios(
+                        backend, patient_filename, lab_filename
+                    ).items()
+                )
+    return {
+        "scale": scale,
+        "patients": patient_count,
+        "labs": lab_count,
+        "seed": seed,
+        "repeats": repeats,
+        "python": platform.python_version(),
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "results": results,
+    }
+
+
+def regressions(
+    report: dict[str, typing.Any], baseline: dict[str, typing.Any]
+) -> list[str]:
+    """List the scenarios that got slower than the baseline."""
+    previous = {result["name"]: result for result in baseline["results"]}
+    slower = []
+    for result in report["results"]:
+        before = previous.get(result["name"])
+        if before and result["min"] > before["min"] * REGRESSION_THRESHOLD:
+            slower.append(
+                f"{result['name']}: {before['min']:.4f}s -> "
+                f"{result['min']:.4f}s"
+            )
+    return slower
+
+
+def main(argv: list[str] | None = None) -> int:
+    """Run the benchmarks from the command line."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--scale", choices=SCALES, default="10k")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the results to this file")
+    parser.add_argument("--compare", help="results file to compare against")
+    args = parser.parse_args(argv)
+
+    report = run(args.scale, args.repeats, args.seed)
+    for result in report["results"]:
+        print(f"{result['name']:<32} {result['min']:10.4f}s")
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+    if args.compare:
+        with open(args.compare) as compare:
+            slower = regressions(report, json.load(compare))
+        for line in slower:
+            print(f"REGRESSION {line}")
+        return 1 if slower else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,155 @@
+"""
+Generate deterministic synthetic EHR files.
+
+Labs per patient and lab names follow skewed distributions, so a few
+patients have many labs and a few lab names dominate, as in real
+extracts. The same seed always produces the same files.
+"""
+from datetime import datetime, timedelta
+import itertools
+import random
+import uuid
+
+SCALES = {
+    "10k": 10_000,
+    "100k": 100_000,
+    "1m": 1_000_000,
+    "10m": 10_000_000,
+}
+MEAN_LABS_PER_PATIENT = 100
+# Zipf exponents of the labs per patient and the lab name distributions
+PATIENT_SKEW = 0.8
+LAB_NAME_SKEW = 1.2
+
+PATIENT_HEADER = (
+    "PatientID",
+    "PatientGender",
+    "PatientDateOfBirth",
+    "PatientRace",
+    "PatientMaritalStatus",
+    "PatientLanguage",
+    "PatientPopulationPercentageBelowPoverty",
+)
+LAB_HEADER = (
+    "PatientID",
+    "AdmissionID",
+    "LabName",
+    "LabValue",
+    "LabUnits",
+    "LabDateTime",
+)
+# Lab names with their units and the mean and spread of their values
+LAB_CATALOG = (
+    ("CBC: HEMOGLOBIN", "gm/dl", 13.5, 2.0),
+    ("CBC: WHITE BLOOD CELL COUNT", "k/cumm", 7.5, 2.5),
+    ("CBC: PLATELET COUNT", "k/cumm", 250.0, 60.0),
+    ("METABOLIC: GLUCOSE", "mg/dL", 110.0, 30.0),
+    ("METABOLIC: SODIUM", "mmol/L", 139.0, 3.0),
+    ("METABOLIC: POTASSIUM", "mmol/L", 4.2, 0.5),
+    ("METABOLIC: ALBUMIN", "gm/dL", 4.0, 0.6),
+    ("METABOLIC: CREATININE", "mg/dL", 1.0, 0.4),
+    ("METABOLIC: CALCIUM", "mg/dL", 9.4, 0.6),
+    ("URINALYSIS: PH", "no unit", 6.0, 0.8),
+    ("URINALYSIS: RED BLOOD CELLS", "rbc/hpf", 2.0, 1.5),
+    ("URINALYSIS: WHITE BLOOD CELLS", "wbc/hpf", 3.0, 2.0),
+)
+GENDERS = ("Male", "Female")
+RACES = ("White", "African American", "Asian", "Unknown")
+MARITAL_STATUSES = ("Married", "Single", "Divorced", "Separated", "Unknown")
+LANGUAGES = ("English", "Spanish", "Icelandic", "Unknown")
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+
+def zipf_weights(count: int, exponent: float) -> list[float]:
+    """Build cumulative weights of a Zipf distribution over count ranks."""
+    return list(
+        itertools.accumulate(
+            1 / rank**exponent for rank in range(1, count + 1)
+        )
+    )
+
+
+def timestamp(rng: random.Random, start: datetime, days: int) -> str:
+    """Draw a timestamp within days of start in the EHR layout."""
+    offset = timedelta(milliseconds=rng.randrange(days * 86_400_000))
+    return (start + offset).strftime(DATE_FORMAT)[:-3]
+
+
+def labs_per_patient(
+    lab_count: int, patient_count: int, rng: random.Random
+) -> list[int]:
+    """Split lab_count labs across patients with a Zipf skew."""
+    weights = zipf_weights(patient_count, PATIENT_SKEW)
+    counts = [1] * patient_count
+    for patient in rng.choices(
+        range(patient_count),
+        cum_weights=weights,
+        k=lab_count - patient_count,
+    ):
+        counts[patient] += 1
+    rng.shuffle(counts)
+    return counts
+
+
+def write_synthetic_files(
+    patient_filename: str,
+    lab_filename: str,
+    lab_count: int,
+    seed: int = 0,
+) -> tuple[int, int]:
+    """
+    Write a patient file and a lab file with lab_count labs.
+
+    Every patient has at least one lab. Labs are streamed to the file so
+    memory does not grow with lab_count. Return the number of patients
+    and labs written.
+    """
+    rng = random.Random(seed)
+    patient_count = max(1, lab_count // MEAN_LABS_PER_PATIENT)
+    lab_count = max(lab_count, patient_count)
+    name_weights = zipf_weights(len(LAB_CATALOG), LAB_NAME_SKEW)
+    counts = labs_per_patient(lab_count, patient_count, rng)
+
+    with open(patient_filename, "w") as patient_file, open(
+        lab_filename, "w"
+    ) as lab_file:
+        patient_file.write("\t".join(PATIENT_HEADER) + "\n")
+        lab_file.write("\t".join(LAB_HEADER) + "\n")
+        for count in counts:
+            patient_id = str(uuid.UUID(int=rng.getrandbits(128))).upper()
+            birth_date = timestamp(rng, datetime(1920, 1, 1), 365 * 70)
+            patient_file.write(
+                "\t".join(
+                    (
+                        patient_id,
+                        rng.choice(GENDERS),
+                        birth_date,
+                        rng.choice(RACES),
+                        rng.choice(MARITAL_STATUSES),
+                        rng.choice(LANGUAGES),
+                        f"{rng.uniform(0, 40):.2f}",
+                    )
+                )
+                + "\n"
+            )
+            first_lab = datetime.strptime(birth_date, DATE_FORMAT)
+            for lab in rng.choices(
+                LAB_CATALOG, cum_weights=name_weights, k=count
+            ):
+                name, units, mean, spread = lab
+                lab_file.write(
+                    "\t".join(
+                        (
+                            patient_id,
+                            str(rng.randrange(1, 6)),
+                            name,
+                            f"{max(0.0, rng.gauss(mean, spread)):.1f}",
+                            units,
+                            timestamp(
+                                rng, first_lab + timedelta(days=6570), 365 * 30
+                            ),
+                        )
+                    )
+                    + "\n"
+                )
+    return patient_count, lab_count
@@ -0,0 +1,352 @@
+"""
+This module selects cohorts with compound predicates.
+
+Predicates are built from fields, for example age > 60,
+lab("METABOLIC: ALBUMIN") < 3.5 and gender == "Male". A query is planned
+by ordering its predicates from the cheapest to evaluate, then compiled
+to a single SQL query or evaluated as a columnar scan that only checks
+the patients every earlier predicate kept.
+"""
+from datetime import datetime
+import operator as op
+from typing import TYPE_CHECKING, Any, Callable, Sequence
+import numpy as np
+import numpy.typing as npt
+import ehr_cache
+from ehr_connection import get_manager
+import ehr_metrics
+import ehr_schema as schema
+
+if TYPE_CHECKING:
+    from ehr_cohort import EHRCohort
+
+COMPARISONS: dict[str, Callable[[Any, Any], Any]] = {
+    "<": op.lt,
+    "<=": op.le,
+    ">": op.gt,
+    ">=": op.ge,
+    "==": op.eq,
+    "!=": op.ne,
+}
+SQL_OPERATORS = {"==": "=", "!=": "<>"}
+
+# Relative cost of evaluating a predicate on one patient: demographics
+# are read from the patient's row, ages are computed from it and
+# initial ages and labs need an index lookup in the labs table
+DEMOGRAPHIC_COST = 1
+AGE_COST = 2
+INITIAL_AGE_COST = 5
+LAB_COST = 10
+
+US_PER_DAY = 86_400_000_000
+# Whole years like ehr_cohort.years_between, which uses 365.2425 days
+AGE_SQL = f"""CAST((? - PatientDateOfBirth) / {US_PER_DAY} / 365.2425
+            AS INTEGER)"""
+INITIAL_AGE_SQL = f"""CAST(((SELECT MIN(LabDateTime)
+                FROM labs
+                WHERE labs.PatientKey=patients.PatientKey)
+            - PatientDateOfBirth) / {US_PER_DAY} / 365.2425 AS INTEGER)"""
+
+
+class Predicate:
+    """Create a comparison of a field with a value."""
+
+    def __init__(self, field: "Field", operator: str, value: Any) -> None:
+        """Initialize the predicate, checking the operator is supported."""
+        if operator not in COMPARISONS:
+            raise ValueError(f"Unsupported operator: {operator!r}")
+        self.field = field
+        self.operator = operator
+        self.value = value
+
+    @property
+    def cost(self) -> int:
+        """Estimate the cost of evaluating the predicate."""
+        return self.field.cost
+
+    def sql(self, as_of: datetime) -> tuple[str, list[Any]]:
+        """Compile the predicate to a WHERE term on the patients table."""
+        return self.field.sql(self.operator, self.value, as_of)
+
+    def mask(
+        self,
+        cohort: "EHRCohort",
+        rows: npt.NDArray[np.int64],
+        as_of: datetime,
+    ) -> npt.NDArray[np.bool_]:
+        """Evaluate the predicate for the patients at rows of the cohort."""
+        return self.field.mask(cohort, rows, self.operator, self.value, as_of)
+
+    def __repr__(self) -> str:
+        """Show the predicate as it was written."""
+        return f"{self.field!r} {self.operator} {self.value!r}"
+
+
+class Field:
+    """Create a patient column that predicates compare."""
+
+    def __init__(self, name: str, column: str, cost: int) -> None:
+        """Initialize the field from its name and patients table column."""
+        self.name = name
+        self.column = column
+        self.cost = cost
+
+    def __lt__(self, value: Any) -> Predicate:
+        """Build a less than predicate."""
+        return Predicate(self, "<", value)
+
+    def __le__(self, value: Any) -> Predicate:
+        """Build a less than or equal predicate."""
+        return Predicate(self, "<=", value)
+
+    def __gt__(self, value: Any) -> Predicate:
+        """Build a greater than predicate."""
+        return Predicate(self, ">", value)
+
+    def __ge__(self, value: Any) -> Predicate:
+        """Build a greater than or equal predicate."""
+        return Predicate(self, ">=", value)
+
+    def __eq__(self, value: Any) -> Predicate:  # type: ignore[override]
+        """Build an equality predicate."""
+        return Predicate(self, "==", value)
+
+    def __ne__(self, value: Any) -> Predicate:  # type: ignore[override]
+        """Build an inequality predicate."""
+        return Predicate(self, "!=", value)
+
+    __hash__ = object.__hash__
+
+    def __repr__(self) -> str:
+        """Show the field by name."""
+        return self.name
+
+    def sql(
+        self, operator: str, value: Any, as_of: datetime
+    ) -> tuple[str, list[Any]]:
+        """Compile a comparison of the field to a WHERE term."""
+        sql_operator = SQL_OPERATORS.get(operator, operator)
+        return f"{self.column} {sql_operator} ?", [value]
+
+    def values(
+        self,
+        cohort: "EHRCohort",
+        rows: npt.NDArray[np.int64],
+        as_of: datetime,
+    ) -> npt.NDArray[Any]:
+        """Read the field for the patients at rows of the cohort."""
+        if cohort.demographics is None:
+            raise ValueError("The cohort has no demographics")
+        return cohort.demographics[self.column][rows]
+
+    def present(
+        self, cohort: "EHRCohort", rows: npt.NDArray[np.int64]
+    ) -> npt.NDArray[np.bool_]:
+        """Find the patients at rows with a value, like SQL's NOT NULL."""
+        if cohort.demographics is None:
+            raise ValueError("The cohort has no demographics")
+        values = cohort.demographics[self.column][rows]
+        present: npt.NDArray[np.bool_]
+        if values.dtype.kind == "f":
+            present = ~np.isnan(values)
+        else:
+            present = values != ""
+        return present
+
+    def mask(
+        self,
+        cohort: "EHRCohort",
+        rows: npt.NDArray[np.int64],
+        operator: str,
+        value: Any,
+        as_of: datetime,
+    ) -> npt.NDArray[np.bool_]:
+        """
+        Compare the field with value for the patients at rows.
+
+        Like in SQL, a missing value never compares true.
+        """
+        present = self.present(cohort, rows)
+        mask = np.zeros(len(rows), dtype=np.bool_)
+        mask[present] = COMPARISONS[operator](
+            self.values(cohort, rows[present], as_of), value
+        )
+        return mask
+
+
+class AgeField(Field):
+    """Create the age field, computed as of a date."""
+
+    def sql(
+        self, operator: str, value: Any, as_of: datetime
+    ) -> tuple[str, list[Any]]:
+        """Compile a comparison of the age to a WHERE term."""
+        as_of_us = int(np.datetime64(as_of, "us").astype(np.int64))
+        return f"{AGE_SQL} {SQL_OPERATORS.get(operator, operator)} ?", [
+            as_of_us,
+            value,
+        ]
+
+    def values(
+        self,
+        cohort: "EHRCohort",
+        rows: npt.NDArray[np.int64],
+        as_of: datetime,
+    ) -> npt.NDArray[Any]:
+        """Compute the ages of the patients at rows."""
+        return cohort.ages(as_of, rows)
+
+    def present(
+        self, cohort: "EHRCohort", rows: npt.NDArray[np.int64]
+    ) -> npt.NDArray[np.bool_]:
+        """Find the patients at rows with a birth date."""
+        present: npt.NDArray[np.bool_] = ~np.isnat(cohort.birth_dates[rows])
+        return present
+
+
+class InitialAgeField(Field):
+    """Create the age at the first lab field."""
+
+    def sql(
+        self, operator: str, value: Any, as_of: datetime
+    ) -> tuple[str, list[Any]]:
+        """Compile a comparison of the initial age to a WHERE term."""
+        sql_operator = SQL_OPERATORS.get(operator, operator)
+        return f"{INITIAL_AGE_SQL} {sql_operator} ?", [value]
+
+    def values(
+        self,
+        cohort: "EHRCohort",
+        rows: npt.NDArray[np.int64],
+        as_of: datetime,
+    ) -> npt.NDArray[Any]:
+        """Read the initial ages of the patients at rows."""
+        return cohort.initial_ages(rows)
+
+    def present(
+        self, cohort: "EHRCohort", rows: npt.NDArray[np.int64]
+    ) -> npt.NDArray[np.bool_]:
+        """Find the patients at rows with a birth date and labs."""
+        present: npt.NDArray[np.bool_] = ~np.isnat(
+            cohort.birth_dates[rows]
+        ) & ~np.isnat(cohort.first_lab_dates[rows])
+        return present
+
+
+class LabField(Field):
+    """Create the field of whether any lab of one name compares true."""
+
+    def __init__(self, lab_name: str) -> None:
+        """Initialize the field for labs named lab_name."""
+        super().__init__(f"lab({lab_name!r})", "LabValue", LAB_COST)
+        self.lab_name = lab_name
+
+    def sql(
+        self, operator: str, value: Any, as_of: datetime
+    ) -> tuple[str, list[Any]]:
+        """Compile a lab comparison to an indexed EXISTS term."""
+        schema.check_operator(operator)
+        return (
+            f"""EXISTS (SELECT 1
+                FROM labs
+                WHERE LabNameKey={schema.LAB_NAME_KEY}
+                    AND PatientKey=patients.PatientKey
+                    AND LabValue {operator} ?)""",
+            [self.lab_name, value],
+        )
+
+    def mask(
+        self,
+        cohort: "EHRCohort",
+        rows: npt.NDArray[np.int64],
+        operator: str,
+        value: Any,
+        as_of: datetime,
+    ) -> npt.NDArray[np.bool_]:
+        """Check the labs of the patients at rows like is_sick."""
+        return cohort.is_sick(self.lab_name, operator, value, rows)
+
+
+age = AgeField("age", "PatientDateOfBirth", AGE_COST)
+initial_age = InitialAgeField(
+    "initial_age", "PatientDateOfBirth", INITIAL_AGE_COST
+)
+gender = Field("gender", "PatientGender", DEMOGRAPHIC_COST)
+race = Field("race", "PatientRace", DEMOGRAPHIC_COST)
+marital_status = Field(
+    "marital_status", "PatientMaritalStatus", DEMOGRAPHIC_COST
+)
+language = Field("language", "PatientLanguage", DEMOGRAPHIC_COST)
+poverty = Field(
+    "poverty", "PatientPopulationPercentageBelowPoverty", DEMOGRAPHIC_COST
+)
+
+
+def lab(lab_name: str) -> LabField:
+    """Build the field comparing a patient's labs named lab_name."""
+    return LabField(lab_name)
+
+
+def plan(predicates: Sequence[Predicate]) -> list[Predicate]:
+    """Order predicates from the cheapest, keeping ties in given order."""
+    for predicate in predicates:
+        if isinstance(predicate.field, LabField):
+            schema.check_operator(predicate.operator)
+    return sorted(predicates, key=lambda predicate: predicate.cost)
+
+
+def compile_sql(
+    predicates: Sequence[Predicate], as_of: datetime | None = None
+) -> tuple[str, list[Any]]:
+    """
+    Compile predicates to one query selecting the matching PatientIDs.
+
+    SQLite checks the terms of the WHERE clause in order, so the
+    cheapest predicates rule out patients before any lab is looked up.
+    """
+    when = ehr_cache.as_of() if as_of is None else as_of
+    terms = [f"({schema.KNOWN_PATIENT})"]
+    parameters: list[Any] = []
+    for predicate in plan(predicates):
+        term, term_parameters = predicate.sql(when)
+        terms.append(f"({term})")
+        parameters.extend(term_parameters)
+    where = " AND ".join(terms)
+    return (
+        f"""SELECT PatientID
+            FROM patients
+            WHERE {where}
+            ORDER BY PatientKey""",
+        parameters,
+    )
+
+
+@ehr_metrics.accessor("select_patient_ids")
+def select_patient_ids(
+    *predicates: Predicate, as_of: datetime | None = None
+) -> list[str]:
+    """Find the PatientIDs matching every predicate with one query."""
+    sql, parameters = compile_sql(predicates, as_of)
+    cursor = get_manager().connection().cursor()
+    return [row[0] for row in cursor.execute(sql, parameters)]
+
+
+def scan(
+    cohort: "EHRCohort",
+    predicates: Sequence[Predicate],
+    as_of: datetime | None = None,
+) -> npt.NDArray[np.int64]:
+    """
+    Find the positions of the cohort patients matching every predicate.
+
+    Predicates are evaluated from the cheapest, each only for the
+    patients the earlier ones kept, and evaluation stops once no
+    patient is left.
+    """
+    when = ehr_cache.as_of() if as_of is None else as_of
+    rows = np.arange(len(cohort))
+    for predicate in plan(predicates):
+        if not len(rows):
+            break
+        rows = rows[predicate.mask(cohort, rows, when)]
+    return rows
@@ -0,0 +1,272 @@
+"""
+This module serves patient metrics to asyncio code.
+
+Queries run on a bounded pool of threads, each with its own pooled
+connection, so the event loop never waits on sqlite3. Concurrent requests
+for the same result share one query.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import partial
+from itertools import islice
+from typing import Any, Callable, Hashable, Iterable, TypeVar
+import ehr_cache
+from ehr_cohort import whole_years
+from ehr_connection import ConnectionManager, get_manager
+from ehr_dates import from_epoch_us
+import ehr_metrics
+import ehr_schema as schema
+
+DEFAULT_WORKERS = 4
+BATCH_SIZE = 500
+
+T = TypeVar("T")
+
+
+def batches(patient_ids: Iterable[str], size: int) -> list[tuple[str, ...]]:
+    """Split PatientIDs into tuples of at most size IDs."""
+    ids = iter(patient_ids)
+    return list(iter(lambda: tuple(islice(ids, size)), ()))
+
+
+class AsyncEHRStore:
+    """Create the asyncio facade over an EHR database."""
+
+    def __init__(
+        self,
+        database: str | None = None,
+        max_workers: int = DEFAULT_WORKERS,
+        batch_size: int = BATCH_SIZE,
+        read_only: bool = False,
+    ) -> None:
+        """
+        Initialize the store, which defaults to the EHR module's database.
+
+        At most max_workers queries run at once, and the bulk methods
+        query batch_size patients at a time. Set read_only to open the
+        database read-only, so the store never blocks a load.
+        """
+        if database is None:
+            database = get_manager().database
+        self.manager = ConnectionManager(database, read_only)
+        self.batch_size = batch_size
+        self.queries = 0
+        self._executor = ThreadPoolExecutor(
+            max_workers, thread_name_prefix="ehr-async"
+        )
+        self._in_flight: dict[Hashable, asyncio.Future[Any]] = {}
+
+    async def _run(self, key: Hashable, query: Callable[[], T]) -> T:
+        """Run a query on the pool, sharing it with identical requests."""
+        future = self._in_flight.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(self._executor, query)
+            self.queries += 1
+            self._in_flight[key] = future
+
+            def forget(_: object) -> None:
+                del self._in_flight[key]
+
+            future.add_done_callback(forget)
+        # A cancelled caller must not cancel the query other callers share
+        result: T = await asyncio.shield(future)
+        return result
+
+    def _fetch(
+        self, sql: str, parameters: tuple[Any, ...]
+    ) -> list[tuple[Any, ...]]:
+        """Run a query on the calling thread's connection."""
+        cursor = self.manager.connection().cursor()
+        try:
+            return cursor.execute(sql, parameters).fetchall()
+        finally:
+            cursor.close()
+
+    def _birth_dates(
+        self, patient_ids: tuple[str, ...]
+    ) -> dict[str, datetime | None]:
+        """
+        Read the birth dates of patients, failing for unknown ones.
+
+        A patient without a birth date has None.
+        """
+        rows = self._fetch(
+            schema.select_birth_dates(len(patient_ids)), patient_ids
+        )
+        birth_dates = {
+            patient_id: None
+            if birth_date is None
+            else from_epoch_us(birth_date)
+            for patient_id, birth_date in rows
+        }
+        for patient_id in patient_ids:
+            if patient_id not in birth_dates:
+                raise KeyError(patient_id)
+        return birth_dates
+
+    @ehr_metrics.accessor("AsyncEHRStore.ages")
+    def _ages(
+        self, patient_ids: tuple[str, ...], as_of: datetime
+    ) -> dict[str, int | None]:
+        """Calculate the ages of patients on a worker thread."""
+        return {
+            patient_id: None
+            if birth_date is None
+            else whole_years(birth_date, as_of)
+            for patient_id, birth_date in self._birth_dates(
+                patient_ids
+            ).items()
+        }
+
+    @ehr_metrics.accessor("AsyncEHRStore.initial_ages")
+    def _initial_ages(
+        self, patient_ids: tuple[str, ...]
+    ) -> dict[str, int | None]:
+        """Calculate the ages at the first lab on a worker thread."""
+        birth_dates = self._birth_dates(patient_ids)
+        initial_ages: dict[str, int | None] = dict.fromkeys(patient_ids)
+        rows = self._fetch(
+            schema.select_first_lab_dates(len(patient_ids)), patient_ids
+        )
+        for patient_id, first_date in rows:
+            birth_date = birth_dates[patient_id]
+            if birth_date is not None and first_date is not None:
+                initial_ages[patient_id] = whole_years(
+                    birth_date, from_epoch_us(first_date)
+                )
+        return initial_ages
+
+    @ehr_metrics.accessor("AsyncEHRStore.is_sick")
+    def _is_sick(
+        self,
+        patient_ids: tuple[str, ...],
+        lab_name: str,
+        operator: str,
+        value: float,
+    ) -> dict[str, bool]:
+        """Answer is_sick for patients, failing for unknown ones."""
+        rows = self._fetch(
+            schema.select_patients_is_sick(operator, len(patient_ids)),
+            (value, lab_name, *patient_ids),
+        )
+        sick = {
+            patient_id: bool(patient_sick) for patient_id, patient_sick in rows
+        }
+        for patient_id in patient_ids:
+            if patient_id not in sick:
+                raise KeyError(patient_id)
+        return sick
+
+    def _cached(
+        self, key: tuple[Hashable, ...], compute: Callable[[], T]
+    ) -> T:
+        """Look up a metric in ehr_cache, unless the store is read-only."""
+        if self.manager.read_only:
+            return compute()
+        return ehr_cache.cached(key, compute)
+
+    async def age(
+        self, patient_id: str, as_of: datetime | None = None
+    ) -> int | None:
+        """Calculate the age in years like Patient.age."""
+        when = ehr_cache.as_of() if as_of is None else as_of
+
+        def query() -> int | None:
+            return self._cached(
+                ("age", self.manager.database, patient_id, when),
+                lambda: self._ages((patient_id,), when)[patient_id],
+            )
+
+        return await self._run(("age", patient_id, when), query)
+
+    async def initial_age(self, patient_id: str) -> int | None:
+        """
+        Calculate the age at the first lab like Patient.initial_age.
+
+        A patient without labs has an initial age of None.
+        """
+
+        def query() -> int | None:
+            return self._cached(
+                ("initial_age", self.manager.database, patient_id),
+                lambda: self._initial_ages((patient_id,))[patient_id],
+            )
+
+        return await self._run(("initial_age", patient_id), query)
+
+    async def is_sick(
+        self, patient_id: str, lab_name: str, operator: str, value: float
+    ) -> bool:
+        """Answer Patient.is_sick for one patient."""
+        schema.check_operator(operator)
+        sick = await self._run(
+            ("is_sick", patient_id, lab_name, operator, value),
+            lambda: self._is_sick((patient_id,), lab_name, operator, value),
+        )
+        return sick[patient_id]
+
+    async def ages(
+        self, patient_ids: Iterable[str], as_of: datetime | None = None
+    ) -> dict[str, int | None]:
+        """Calculate the ages of many patients, one query per batch."""
+        when = ehr_cache.as_of() if as_of is None else as_of
+        results = await asyncio.gather(
+            *(
+                self._run(
+                    ("ages", batch, when),
+                    partial(self._ages, batch, when),
+                )
+                for batch in batches(patient_ids, self.batch_size)
+            )
+        )
+        return {k: v for result in results for k, v in result.items()}
+
+    async def initial_ages(
+        self, patient_ids: Iterable[str]
+    ) -> dict[str, int | None]:
+        """Calculate many ages at the first lab, one query per batch."""
+        results = await asyncio.gather(
+            *(
+                self._run(
+                    ("initial_ages", batch),
+                    partial(self._initial_ages, batch),
+                )
+                for batch in batches(patient_ids, self.batch_size)
+            )
+        )
+        return {k: v for result in results for k, v in result.items()}
+
+    async def is_sick_many(
+        self,
+        patient_ids: Iterable[str],
+        lab_name: str,
+        operator: str,
+        value: float,
+    ) -> dict[str, bool]:
+        """Answer is_sick for many patients, one query per batch."""
+        schema.check_operator(operator)
+        results = await asyncio.gather(
+            *(
+                self._run(
+                    ("is_sick_many", batch, lab_name, operator, value),
+                    partial(self._is_sick, batch, lab_name, operator, value),
+                )
+                for batch in batches(patient_ids, self.batch_size)
+            )
+        )
+        return {k: v for result in results for k, v in result.items()}
+
+    def close(self) -> None:
+        """Wait for running queries, then close the pool's connections."""
+        self._executor.shutdown(wait=True)
+        self.manager.close()
+
+    async def __aenter__(self) -> "AsyncEHRStore":
+        """Enter a block that closes the store on exit."""
+        return self
+
+    async def __aexit__(self, *exc_info: object) -> None:
+        """Close the store without blocking the event loop."""
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
@@ -0,0 +1,182 @@
+"""
+This module selects the storage behind Patient, Lab and parse_data.
+
+A backend loads the patient and lab files and answers for the patients
+it loaded. SQLiteBackend keeps them in a database file, or in memory
+for tests and short-lived jobs, and ColumnarBackend keeps them in NumPy
+columns without SQL.
+"""
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Generator
+from ehr_cohort import EHRCohort
+from ehr_connection import (
+    DEFAULT_DATABASE,
+    MEMORY_DATABASE,
+    ConnectionManager,
+    using_manager,
+)
+from ehr_module import (
+    Lab,
+    Patient,
+    cohort_patient,
+    hydrate_labs,
+    parse_columnar,
+    parse_data,
+)
+import ehr_schema as schema
+
+
+class Backend(ABC):
+    """Create the storage of patients and labs."""
+
+    name = ""
+
+    @abstractmethod
+    def load(self, patient_filename: str, lab_filename: str) -> list[Patient]:
+        """Load the patient and lab files, replacing any loaded data."""
+
+    @abstractmethod
+    def cohort(self) -> EHRCohort:
+        """Return the cohort of the loaded patients."""
+
+    @abstractmethod
+    def patient(self, patient_id: str) -> Patient:
+        """Return a loaded patient by PatientID."""
+
+    @contextmanager
+    def active(self) -> Generator["Backend", None, None]:
+        """Make Patient and Lab read from the backend in a block."""
+        yield self
+
+    def close(self) -> None:
+        """Release the storage."""
+
+    def __enter__(self) -> "Backend":
+        """Enter a block that closes the backend on exit."""
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        """Close the backend."""
+        self.close()
+
+
+class SQLiteBackend(Backend):
+    """Create the backend storing patients and labs in SQLite."""
+
+    name = "sqlite"
+
+    def __init__(
+        self, database: str = DEFAULT_DATABASE, lazy: bool = False
+    ) -> None:
+        """
+        Initialize the backend on a database file, URI or ":memory:".
+
+        Set lazy to keep the labs in the database instead of in memory.
+        Missing tables are created, keeping the data of existing ones.
+        """
+        self.manager = ConnectionManager(database)
+        with self.manager.transaction() as cursor:
+            schema.create_missing_tables(cursor)
+        self.lazy = lazy
+        self._cohort: EHRCohort | None = None
+        self._patients: dict[str, Patient] = {}
+
+    @contextmanager
+    def active(self) -> Generator["Backend", None, None]:
+        """Point the EHR module at the backend's database in a block."""
+        with using_manager(self.manager):
+            yield self
+
+    def load(self, patient_filename: str, lab_filename: str) -> list[Patient]:
+        """Load the files into the database like parse_data."""
+        with self.active():
+            patients = parse_data(patient_filename, lab_filename, self.lazy)
+        self._cohort = patients[0].cohort if patients else None
+        self._patients = {patient.patient_id: patient for patient in patients}
+        return patients
+
+    def cohort(self) -> EHRCohort:
+        """Return the cohort, reading it again once the tables changed."""
+        if self._cohort is None or self._cohort.stale:
+            with self.active():
+                self._cohort = EHRCohort.from_database()
+        return self._cohort
+
+    def patient(self, patient_id: str) -> Patient:
+        """
+        Return a patient, failing for unknown ones.
+
+        Patients of a database loaded earlier are read with their labs.
+        """
+        patient = self._patients.get(patient_id)
+        if patient is not None:
+            return patient
+        cohort = self.cohort()
+        cohort.position(patient_id)
+        with self.active():
+            cursor = self.manager.connection().cursor()
+            rows = cursor.execute(schema.SELECT_PATIENT_LAB_IDS, (patient_id,))
+            labs = [Lab(patient_id, str(row[0])) for row in rows]
+            if not self.lazy:
+                hydrate_labs(labs)
+        patient = self._patients[patient_id] = Patient(
+            patient_id, labs, cohort
+        )
+        return patient
+
+    def close(self) -> None:
+        """Close the database connections."""
+        self.manager.close()
+
+
+class MemorySQLiteBackend(SQLiteBackend):
+    """Create the backend storing patients and labs in in-memory SQLite."""
+
+    name = "sqlite-memory"
+
+    def __init__(self, lazy: bool = False) -> None:
+        """Initialize the backend on a new in-memory database."""
+        super().__init__(MEMORY_DATABASE, lazy)
+
+
+class ColumnarBackend(Backend):
+    """Create the backend storing patients and labs in NumPy columns."""
+
+    name = "columnar"
+
+    def __init__(self) -> None:
+        """Initialize the backend without any data."""
+        self._cohort: EHRCohort | None = None
+
+    def load(self, patient_filename: str, lab_filename: str) -> list[Patient]:
+        """Load the files into columns like parse_columnar."""
+        patients = parse_columnar(patient_filename, lab_filename)
+        self._cohort = patients[0].cohort if patients else None
+        return patients
+
+    def cohort(self) -> EHRCohort:
+        """Return the cohort, failing before anything was loaded."""
+        if self._cohort is None:
+            raise RuntimeError("Nothing was loaded")
+        return self._cohort
+
+    def patient(self, patient_id: str) -> Patient:
+        """Return a patient of the cohort, failing for unknown ones."""
+        cohort = self.cohort()
+        cohort.position(patient_id)
+        return cohort_patient(cohort, patient_id)
+
+
+BACKENDS = (SQLiteBackend.name, MemorySQLiteBackend.name, ColumnarBackend.name)
+
+
+def create_backend(name: str, database: str = DEFAULT_DATABASE) -> Backend:
+    """Create a backend by name, on-disk SQLite storing in database."""
+    if name == SQLiteBackend.name:
+        return SQLiteBackend(database)
+    if name == MemorySQLiteBackend.name:
+        return MemorySQLiteBackend()
+    if name == ColumnarBackend.name:
+        return ColumnarBackend()
+    raise ValueError(f"Unknown backend: {name!r}")
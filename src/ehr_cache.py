@@ -0,0 +1,133 @@
+"""
+This module caches patient metrics between loads.
+
+Results are kept in a bounded LRU cache keyed by the generation of the
+data, which every load that modifies the tables bumps, so stale results
+are never returned. A new generation drops the results of the previous
+ones, and with them the cohorts their keys refer to. Ages are computed
+as of a configurable date, which defaults to the start of the current
+day.
+
+Generations only count the loads of this process, so the cache is not
+used for read-only databases, which other processes write.
+"""
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import date, datetime
+import threading
+from typing import Callable, Generator, Hashable, NamedTuple, TypeVar
+
+DEFAULT_MAXSIZE = 65_536
+
+T = TypeVar("T")
+
+
+class CacheStats(NamedTuple):
+    """Counters of a cache."""
+
+    hits: int
+    misses: int
+    size: int
+    maxsize: int
+
+
+class LRUCache:
+    """Create the bounded least recently used cache."""
+
+    def __init__(self, maxsize: int = DEFAULT_MAXSIZE) -> None:
+        """Initialize an empty cache holding at most maxsize results."""
+        if maxsize < 0:
+            raise ValueError("maxsize must not be negative")
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._results: OrderedDict[Hashable, object] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, compute: Callable[[], T]) -> T:
+        """Return the cached result for key, computing it on a miss."""
+        with self._lock:
+            if key in self._results:
+                self.hits += 1
+                self._results.move_to_end(key)
+                result: T = self._results[key]  # type: ignore[assignment]
+                return result
+            self.misses += 1
+        result = compute()
+        with self._lock:
+            self._results[key] = result
+            while len(self._results) > self.maxsize:
+                self._results.popitem(last=False)
+        return result
+
+    def clear(self) -> None:
+        """Drop every result and reset the counters."""
+        with self._lock:
+            self._results.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def discard(self) -> None:
+        """Drop every result, keeping the counters."""
+        with self._lock:
+            self._results.clear()
+
+    def stats(self) -> CacheStats:
+        """Report the counters of the cache."""
+        with self._lock:
+            return CacheStats(
+                self.hits, self.misses, len(self._results), self.maxsize
+            )
+
+
+_cache = LRUCache()
+_generation = 0
+_as_of: datetime | None = None
+
+
+def get_cache() -> LRUCache:
+    """Return the cache used for patient metrics."""
+    return _cache
+
+
+def generation() -> int:
+    """Return the generation of the loaded data."""
+    return _generation
+
+
+def invalidate() -> int:
+    """Start a new generation after the tables were modified."""
+    global _generation
+    _generation += 1
+    _cache.discard()
+    return _generation
+
+
+def cached(key: tuple[Hashable, ...], compute: Callable[[], T]) -> T:
+    """Look up a result of the current generation in the cache."""
+    return _cache.get((_generation, *key), compute)
+
+
+def as_of() -> datetime:
+    """Return the date ages are computed at."""
+    if _as_of is not None:
+        return _as_of
+    return datetime.combine(date.today(), datetime.min.time())
+
+
+def set_as_of(as_of_date: datetime | None) -> None:
+    """Compute ages at as_of_date, or at the start of today if None."""
+    global _as_of
+    _as_of = as_of_date
+
+
+@contextmanager
+def using_as_of(as_of_date: datetime) -> Generator[datetime, None, None]:
+    """Temporarily compute ages at another date."""
+    global _as_of
+    previous = _as_of
+    _as_of = as_of_date
+    try:
+        yield as_of_date
+    finally:
+        _as_of = previous
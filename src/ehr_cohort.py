@@ -0,0 +1,318 @@
+"""
+This module computes EHR metrics for a whole cohort of patients at once.
+
+Birth dates and first lab dates are held in NumPy arrays aligned with the
+cohort's patient IDs, so each metric is one vectorized pass.
+"""
+from datetime import datetime
+from functools import cached_property
+from typing import Any, Sequence, TypeVar
+import numpy as np
+import numpy.typing as npt
+import ehr_cache
+from cohort_query import Predicate, scan
+from ehr_connection import get_manager
+from ehr_dates import to_datetime64
+import ehr_metrics
+import ehr_schema as schema
+from lab_store import LabStore, PatientIDs
+
+DAYS_PER_YEAR = 365.2425
+# PatientIDs per query when checking the labs of part of a cohort
+IS_SICK_BATCH_SIZE = 500
+
+T = TypeVar("T", bound=np.generic)
+# Ages, masked where a date they are computed from is missing
+Ages = np.ma.MaskedArray[Any, np.dtype[np.int64]]
+# Demographic columns keyed by patients table column
+Demographics = dict[str, npt.NDArray[Any]]
+
+
+def years_between(
+    start: npt.NDArray[np.datetime64],
+    end: npt.NDArray[np.datetime64] | np.datetime64,
+) -> Ages:
+    """Count whole years between the dates the way Patient.age does."""
+    delta = end - start
+    missing = np.isnat(delta)
+    days = np.floor_divide(
+        np.where(missing, np.timedelta64(0, "D"), delta),
+        np.timedelta64(1, "D"),
+    )
+    ages: Ages = np.ma.masked_array(
+        (days / DAYS_PER_YEAR).astype(np.int64), mask=missing
+    )
+    return ages
+
+
+def first_age(ages: Ages) -> int | None:
+    """Return the first of the ages, None if it is masked."""
+    if np.ma.getmaskarray(ages)[0]:
+        return None
+    return int(ages[0])
+
+
+def whole_years(start: datetime, end: datetime) -> int:
+    """Count whole years between two dates, like years_between."""
+    return int((end - start).days / DAYS_PER_YEAR)
+
+
+def demographic_arrays(rows: Sequence[Sequence[Any]]) -> Demographics:
+    """
+    Convert rows in DEMOGRAPHIC_COLUMNS order to arrays.
+
+    Text columns hold "" for missing values and numeric ones NaN.
+    """
+    columns = list(zip(*rows)) or [()] * len(schema.DEMOGRAPHIC_COLUMNS)
+    demographics: Demographics = {}
+    for name, column in zip(schema.DEMOGRAPHIC_COLUMNS, columns):
+        if name in schema.NUMERIC_DEMOGRAPHICS:
+            demographics[name] = np.array(
+                [np.nan if v in (None, "") else float(v) for v in column]
+            )
+        else:
+            demographics[name] = np.array(
+                ["" if v is None else str(v) for v in column], dtype=np.str_
+            )
+    return demographics
+
+
+def as_of_date(as_of: datetime | None) -> np.datetime64:
+    """Convert an as-of date, defaulting to ehr_cache.as_of(), for NumPy."""
+    return np.datetime64(ehr_cache.as_of() if as_of is None else as_of, "us")
+
+
+class EHRCohort:
+    """Create the cohort class."""
+
+    def __init__(
+        self,
+        patient_ids: PatientIDs,
+        birth_dates: npt.NDArray[np.datetime64],
+        first_lab_dates: npt.NDArray[np.datetime64],
+        store: LabStore | None = None,
+        demographics: Demographics | None = None,
+    ) -> None:
+        """
+        Initialize the cohort from arrays aligned with patient_ids.
+
+        With a store, lab metrics are computed from its columns instead
+        of the database. demographics holds DEMOGRAPHIC_COLUMNS arrays.
+        """
+        self.patient_ids = patient_ids
+        self.birth_dates = birth_dates
+        self.first_lab_dates = first_lab_dates
+        self.store = store
+        self.demographics = demographics
+        # Database and ehr_cache generation of a cohort read from SQLite
+        self.database: str | None = None
+        self.generation: int | None = None
+
+    @classmethod
+    @ehr_metrics.accessor("EHRCohort.from_database")
+    def from_database(cls) -> "EHRCohort":
+        """Load the cohort with one pass over the patients and labs."""
+        manager = get_manager()
+        cursor = manager.connection().cursor()
+        rows = cursor.execute(schema.SELECT_COHORT_COLUMNS).fetchall()
+        cohort = cls(
+            [row[0] for row in rows],
+            to_datetime64(row[1] for row in rows),
+            to_datetime64(row[2] for row in rows),
+            demographics=demographic_arrays([row[3:] for row in rows]),
+        )
+        cohort.database = manager.database
+        cohort.generation = ehr_cache.generation()
+        return cohort
+
+    @classmethod
+    def from_store(
+        cls,
+        store: LabStore,
+        patient_ids: PatientIDs,
+        birth_dates: npt.NDArray[np.datetime64],
+        demographics: Demographics | None = None,
+    ) -> "EHRCohort":
+        """Build the cohort on top of a columnar lab store."""
+        cohort = cls(
+            patient_ids,
+            birth_dates,
+            np.full(len(patient_ids), np.datetime64("NaT", "us")),
+            store,
+            demographics,
+        )
+        rows, store_rows = cohort._store_rows
+        cohort.first_lab_dates[rows] = store.first_lab_dates()[store_rows]
+        return cohort
+
+    @cached_property
+    def _positions(self) -> dict[str, int]:
+        """Map each PatientID to its position, built on first use."""
+        return {
+            str(patient_id): i for i, patient_id in enumerate(self.patient_ids)
+        }
+
+    @cached_property
+    def _store_rows(
+        self,
+    ) -> tuple[npt.NDArray[np.int64], npt.NDArray[np.int64]]:
+        """Match cohort positions with store positions of the same patient."""
+        assert self.store is not None
+        store_positions = self.store.patient_positions(self.patient_ids)
+        (rows,) = np.nonzero(store_positions >= 0)
+        return rows, store_positions[rows]
+
+    @property
+    def stale(self) -> bool:
+        """Check whether the tables changed since the cohort was read."""
+        return (
+            self.generation is not None
+            and self.generation != ehr_cache.generation()
+        )
+
+    def __len__(self) -> int:
+        """Count the patients in the cohort."""
+        return len(self.patient_ids)
+
+    def position(self, patient_id: str) -> int:
+        """Find the position of a patient in the cohort arrays."""
+        return self._positions[patient_id]
+
+    def ages(
+        self,
+        as_of: datetime | None = None,
+        rows: npt.NDArray[np.int64] | None = None,
+    ) -> Ages:
+        """
+        Calculate every patient's age, masked without a birth date.
+
+        With rows, only the ages of the patients at rows are calculated.
+        """
+        birth_dates = (
+            self.birth_dates if rows is None else self.birth_dates[rows]
+        )
+        return years_between(birth_dates, as_of_date(as_of))
+
+    def initial_ages(self, rows: npt.NDArray[np.int64] | None = None) -> Ages:
+        """
+        Calculate every patient's age at their first lab, masked without.
+
+        With rows, only the ages of the patients at rows are calculated.
+        """
+        if rows is None:
+            return years_between(self.birth_dates, self.first_lab_dates)
+        return years_between(
+            self.birth_dates[rows], self.first_lab_dates[rows]
+        )
+
+    @ehr_metrics.accessor("EHRCohort.is_sick")
+    def is_sick(
+        self,
+        lab_name: str,
+        operator: str,
+        value: float,
+        rows: npt.NDArray[np.int64] | None = None,
+    ) -> npt.NDArray[np.bool_]:
+        """
+        Answer Patient.is_sick for every patient in one pass.
+
+        With rows, only the labs of the patients at rows are checked: the
+        store's rows of those patients, or a query by their PatientIDs.
+        """
+        schema.check_operator(operator)
+        if rows is not None and len(rows) < len(self):
+            return self._rows_are_sick(rows, lab_name, operator, value)
+        sick = np.zeros(len(self), dtype=np.bool_)
+        if self.store is not None:
+            store_rows, store_positions = self._store_rows
+            sick[store_rows] = self.store.is_sick(lab_name, operator, value)[
+                store_positions
+            ]
+        else:
+            cursor = get_manager().connection().cursor()
+            results = cursor.execute(
+                schema.select_cohort_is_sick(operator), (value, lab_name)
+            )
+            for patient_id, patient_sick in results:
+                # A subset's query still returns the patients left out of it
+                position = self._positions.get(patient_id)
+                if position is not None:
+                    sick[position] = bool(patient_sick)
+        return sick if rows is None else sick[rows]
+
+    def _rows_are_sick(
+        self,
+        rows: npt.NDArray[np.int64],
+        lab_name: str,
+        operator: str,
+        value: float,
+    ) -> npt.NDArray[np.bool_]:
+        """Answer is_sick for the patients at rows only."""
+        patient_ids = np.asarray(self.patient_ids)[rows]
+        if self.store is not None:
+            return self.store.is_sick(
+                lab_name,
+                operator,
+                value,
+                self.store.patient_positions(patient_ids),
+            )
+        ids = patient_ids.tolist()
+        sick = dict.fromkeys(ids, False)
+        cursor = get_manager().connection().cursor()
+        for start in range(0, len(ids), IS_SICK_BATCH_SIZE):
+            stop = start + IS_SICK_BATCH_SIZE
+            batch = ids[start:stop]
+            results = cursor.execute(
+                schema.select_patients_is_sick(operator, len(batch)),
+                (value, lab_name, *batch),
+            )
+            for patient_id, patient_sick in results:
+                sick[patient_id] = bool(patient_sick)
+        return np.array([sick[i] for i in ids], dtype=np.bool_)
+
+    def age_of(
+        self, patient_id: str, as_of: datetime | None = None
+    ) -> int | None:
+        """Calculate the age in years of one patient, like Patient.age."""
+        i = [self._positions[patient_id]]
+        return first_age(years_between(self.birth_dates[i], as_of_date(as_of)))
+
+    def initial_age_of(self, patient_id: str) -> int | None:
+        """Calculate one patient's age at their first lab."""
+        i = [self._positions[patient_id]]
+        return first_age(
+            years_between(self.birth_dates[i], self.first_lab_dates[i])
+        )
+
+    def subset(self, rows: npt.NDArray[np.int64]) -> "EHRCohort":
+        """Build the cohort of the patients at rows, sharing the store."""
+        demographics = None
+        if self.demographics is not None:
+            demographics = {
+                name: column[rows]
+                for name, column in self.demographics.items()
+            }
+        cohort = EHRCohort(
+            np.asarray(self.patient_ids)[rows],
+            self.birth_dates[rows],
+            self.first_lab_dates[rows],
+            self.store,
+            demographics,
+        )
+        cohort.database = self.database
+        cohort.generation = self.generation
+        return cohort
+
+    def where(
+        self, *predicates: Predicate, as_of: datetime | None = None
+    ) -> "EHRCohort":
+        """
+        Select the patients matching every predicate of cohort_query.
+
+        Ages are computed as of as_of, which defaults to ehr_cache.as_of().
+        """
+        return self.subset(scan(self, predicates, as_of))
+
+    def as_dict(self, values: npt.NDArray[T]) -> dict[str, Any]:
+        """Key a per-patient array by PatientID."""
+        return dict(zip(self.patient_ids, values.tolist()))
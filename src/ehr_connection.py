@@ -0,0 +1,218 @@
+"""
+This module manages the SQLite connections used by the EHR module.
+
+Each thread gets one pooled connection per database, which is reused by
+every accessor until the manager is closed. A manager of the ":memory:"
+database shares one in-memory database between its threads, which lives
+until the manager is closed.
+
+Database files are opened in WAL mode, so readers, including read-only
+managers in other processes, keep reading the last committed data while
+a writer loads more, and publish_database replaces all of a database's
+data in one transaction.
+"""
+from contextlib import closing, contextmanager
+import pathlib
+import sqlite3
+import threading
+import typing
+from uuid import uuid4
+import ehr_metrics
+import ehr_schema as schema
+
+DEFAULT_DATABASE = "ehr_database.db"
+MEMORY_DATABASE = ":memory:"
+# Applied to every writable connection, and kept by the database file
+WRITER_PRAGMAS = {"journal_mode": "WAL", "synchronous": "NORMAL"}
+
+
+def shared_memory_database() -> str:
+    """Name a new in-memory database that connections can share."""
+    return f"file:ehr-{uuid4().hex}?mode=memory&cache=shared"
+
+
+def read_only_uri(database: str) -> str:
+    """Build the URI opening a database file or "file:" URI read-only."""
+    if database.startswith("file:"):
+        separator = "&" if "?" in database else "?"
+        return f"{database}{separator}mode=ro"
+    return f"{pathlib.Path(database).absolute().as_uri()}?mode=ro"
+
+
+class ConnectionManager:
+    """Hand out one pooled connection per thread for a database."""
+
+    def __init__(
+        self, database: str = DEFAULT_DATABASE, read_only: bool = False
+    ) -> None:
+        """
+        Initialize the manager without opening any connection.
+
+        database is a file name, a "file:" URI or ":memory:". Set
+        read_only to open it read-only, as analytics workers do.
+        """
+        if database == MEMORY_DATABASE:
+            if read_only:
+                raise ValueError("An in-memory database cannot be read-only")
+            database = shared_memory_database()
+        self.database = database
+        self.read_only = read_only
+        self._uri = read_only_uri(database) if read_only else database
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections: list[sqlite3.Connection] = []
+        self.closed = False
+
+    def connection(self) -> sqlite3.Connection:
+        """
+        Return the connection for the calling thread.
+
+        Writable connections switch the database to WAL mode and
+        migrate databases written with the older VARCHAR schema, which
+        read-only connections refuse to open.
+        """
+        connection: sqlite3.Connection | None = getattr(
+            self._local, "connection", None
+        )
+        if connection is None:
+            if self.closed:
+                raise RuntimeError(f"{self.database} manager is closed")
+            # Connections are only used by their own thread, but close()
+            # may be called from another one
+            connection = sqlite3.connect(
+                self._uri,
+                check_same_thread=False,
+                uri=True,
+                factory=ehr_metrics.MeteredConnection,
+            )
+            ehr_metrics.count("connection_opens")
+            if self.read_only:
+                check_migrated(connection, self.database)
+            else:
+                for name, value in WRITER_PRAGMAS.items():
+                    connection.execute(f"PRAGMA {name}={value}")
+                schema.migrate(connection)
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    @contextmanager
+    def transaction(self) -> typing.Generator[sqlite3.Cursor, None, None]:
+        """Run a block in a transaction, committing on success."""
+        connection = self.connection()
+        cursor = connection.cursor()
+        try:
+            yield cursor
+        except BaseException:
+            connection.rollback()
+            raise
+        else:
+            connection.commit()
+        finally:
+            cursor.close()
+
+    def close(self) -> None:
+        """Close the connections of every thread."""
+        with self._lock:
+            connections, self._connections = self._connections, []
+            self.closed = True
+        for connection in connections:
+            connection.close()
+        self._local = threading.local()
+
+    def __enter__(self) -> "ConnectionManager":
+        """Enter a block that closes the manager on exit."""
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        """Close the manager."""
+        self.close()
+
+
+def check_migrated(connection: sqlite3.Connection, database: str) -> None:
+    """Refuse a read-only connection to a database still to be migrated."""
+    if schema.legacy_tables(connection.cursor()):
+        connection.close()
+        raise sqlite3.OperationalError(
+            f"{database} uses the older schema, open it writable once to "
+            "migrate it"
+        )
+
+
+def publish_database(source: str, target: str) -> None:
+    """
+    Replace the data of the target database by that of source.
+
+    The copy is one write transaction on target, so readers keep seeing
+    the previous data until it commits and then see all of the new data,
+    never a half-loaded database.
+    """
+    with closing(sqlite3.connect(source, uri=True)) as source_connection:
+        with closing(sqlite3.connect(target, uri=True)) as target_connection:
+            for name, value in WRITER_PRAGMAS.items():
+                target_connection.execute(f"PRAGMA {name}={value}")
+            source_connection.backup(target_connection)
+
+
+@contextmanager
+def tuned_pragmas(
+    connection: sqlite3.Connection, pragmas: typing.Mapping[str, str]
+) -> typing.Generator[sqlite3.Connection, None, None]:
+    """Apply PRAGMAs for the duration of a block, then restore them."""
+    previous = {
+        name: connection.execute(f"PRAGMA {name}").fetchone()[0]
+        for name in pragmas
+    }
+    for name, value in pragmas.items():
+        connection.execute(f"PRAGMA {name}={value}")
+    try:
+        yield connection
+    finally:
+        for name, value in previous.items():
+            connection.execute(f"PRAGMA {name}={value}")
+
+
+_manager = ConnectionManager()
+
+
+def get_manager() -> ConnectionManager:
+    """Return the manager used by the EHR module."""
+    return _manager
+
+
+def set_database(database: str, read_only: bool = False) -> ConnectionManager:
+    """Point the EHR module at another database file."""
+    global _manager
+    _manager.close()
+    _manager = ConnectionManager(database, read_only)
+    return _manager
+
+
+@contextmanager
+def using_manager(
+    manager: ConnectionManager,
+) -> typing.Generator[ConnectionManager, None, None]:
+    """Temporarily point the EHR module at a manager, leaving it open."""
+    global _manager
+    previous = _manager
+    _manager = manager
+    try:
+        yield manager
+    finally:
+        _manager = previous
+
+
+@contextmanager
+def using_database(
+    database: str, read_only: bool = False
+) -> typing.Generator[ConnectionManager, None, None]:
+    """Temporarily point the EHR module at another database file."""
+    global _manager
+    previous = _manager
+    _manager = ConnectionManager(database, read_only)
+    try:
+        yield _manager
+    finally:
+        _manager.close()
+        _manager = previous
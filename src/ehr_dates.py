@@ -0,0 +1,77 @@
+"""
+This module parses the timestamps used in EHR files.
+
+Every timestamp has the fixed layout "%Y-%m-%d %H:%M:%S.%f", which is
+parsed without going through datetime.strptime whenever possible.
+"""
+from datetime import datetime
+from typing import Iterable
+import numpy as np
+import numpy.typing as npt
+import ehr_metrics
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+# Lengths of the layout with millisecond and microsecond fractions
+FAST_LENGTHS = (23, 26)
+
+
+def parse_datetime(value: str) -> datetime:
+    """
+    Parse a timestamp in DATE_FORMAT.
+
+    Timestamps with a millisecond or microsecond fraction are parsed by
+    datetime.fromisoformat, which agrees with strptime on them. Anything
+    else falls back to strptime.
+    """
+    if (
+        len(value) in FAST_LENGTHS
+        and value[10] == " "
+        and value[19] == "."
+        and value[20:].isdigit()
+    ):
+        return datetime.fromisoformat(value)
+    ehr_metrics.count("strptime_calls")
+    return datetime.strptime(value, DATE_FORMAT)
+
+
+def to_datetime64(
+    values: Iterable[str | int | None],
+) -> npt.NDArray[np.datetime64]:
+    """
+    Convert a column of timestamps, with None for missing ones.
+
+    Timestamps are strings or microseconds since the epoch.
+    """
+    return np.array(
+        ["NaT" if value is None else value for value in values],
+        dtype="datetime64[us]",
+    )
+
+
+def to_epoch_us(
+    values: Iterable[str | int | None],
+) -> npt.NDArray[np.int64]:
+    """Convert a column of timestamps to microseconds since the epoch."""
+    return to_datetime64(values).astype(np.int64)
+
+
+def epoch_us_column(values: Iterable[str | None]) -> list[int | None]:
+    """Convert timestamps for SQLite, with None for missing ones."""
+    timestamps = to_datetime64(values)
+    return [
+        None if missing else timestamp
+        for timestamp, missing in zip(
+            timestamps.astype(np.int64).tolist(), np.isnat(timestamps)
+        )
+    ]
+
+
+def epoch_us(value: datetime) -> int:
+    """Convert a datetime to microseconds since the epoch."""
+    return int(np.datetime64(value, "us").astype(np.int64))
+
+
+def from_epoch_us(value: int) -> datetime:
+    """Convert microseconds since the epoch to a datetime."""
+    date_time: datetime = np.datetime64(value, "us").item()
+    return date_time
@@ -0,0 +1,360 @@
+"""
+This module exports tables and cohort results to CSV, NPZ and Parquet.
+
+Exports stream chunks of columns, reading the labs and patients tables
+chunk_size rows at a time without building Lab or Patient objects, so
+memory stays bounded by the chunk size however large the table. The
+format is chosen by the file extension, and Parquet needs pyarrow.
+"""
+from abc import ABC, abstractmethod
+import csv
+import math
+import os
+import tempfile
+from datetime import datetime
+from typing import IO, Any, Iterable, Iterator, Mapping, Sequence
+import zipfile
+import numpy as np
+import numpy.typing as npt
+from ehr_cohort import EHRCohort
+from ehr_connection import get_manager
+from ehr_dates import to_datetime64
+import ehr_metrics
+import ehr_schema as schema
+
+EXPORT_CHUNK_SIZE = 50_000
+
+# Kinds of exported columns, which decide their dtype and missing value
+TEXT = "text"
+INTEGER = "integer"
+REAL = "real"
+DATE = "date"
+LAB_EXPORT = (
+    ("PatientID", TEXT),
+    ("AdmissionID", INTEGER),
+    ("LabName", TEXT),
+    ("LabValue", REAL),
+    ("LabUnits", TEXT),
+    ("LabDateTime", DATE),
+    ("LabID", INTEGER),
+)
+PATIENT_EXPORT = (
+    ("PatientID", TEXT),
+    ("PatientGender", TEXT),
+    ("PatientDateOfBirth", DATE),
+    ("PatientRace", TEXT),
+    ("PatientMaritalStatus", TEXT),
+    ("PatientLanguage", TEXT),
+    ("PatientPopulationPercentageBelowPoverty", REAL),
+)
+EXPORT_TABLES = {
+    "labs": (schema.SELECT_EXPORT_LABS, LAB_EXPORT),
+    "patients": (schema.SELECT_EXPORT_PATIENTS, PATIENT_EXPORT),
+}
+
+Chunk = dict[str, npt.NDArray[Any]]
+
+
+def column_array(values: Sequence[Any], kind: str) -> npt.NDArray[Any]:
+    """
+    Convert a column of SQLite values to an array of its kind.
+
+    None, and "" in numeric columns, are missing values, which are
+    "", masked integers, NaN or NaT.
+    """
+    if kind == TEXT:
+        return np.array(["" if v is None else v for v in values], dtype=str)
+    if kind == INTEGER:
+        missing = [v in (None, "") for v in values]
+        return np.ma.masked_array(
+            [0 if m else v for v, m in zip(values, missing)],
+            mask=missing,
+            dtype=np.int64,
+        )
+    if kind == REAL:
+        return np.array(
+            [math.nan if v in (None, "") else v for v in values],
+            dtype=np.float64,
+        )
+    if kind == DATE:
+        return to_datetime64(values)
+    raise ValueError(f"Unknown column kind: {kind!r}")
+
+
+def table_chunks(
+    table: str, chunk_size: int = EXPORT_CHUNK_SIZE
+) -> Iterator[Chunk]:
+    """Read the labs or patients table chunk_size rows at a time."""
+    if table not in EXPORT_TABLES:
+        raise ValueError(f"Unknown table: {table!r}")
+    sql, columns = EXPORT_TABLES[table]
+    cursor = get_manager().connection().cursor()
+    with ehr_metrics.attributed(f"export.{table}"):
+        cursor.execute(sql)
+    try:
+        # An empty table is one empty chunk, so writers still get columns
+        rows = cursor.fetchmany(chunk_size)
+        while True:
+            yield {
+                name: column_array(values, kind)
+                for (name, kind), values in zip(
+                    columns, zip(*rows) if rows else [()] * len(columns)
+                )
+            }
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+    finally:
+        cursor.close()
+
+
+def array_chunks(
+    columns: Mapping[str, npt.NDArray[Any]],
+    chunk_size: int = EXPORT_CHUNK_SIZE,
+) -> Iterator[Chunk]:
+    """
+    Split equally long columns into chunks of chunk_size rows.
+
+    Empty columns are one empty chunk, so writers still get the columns.
+    """
+    length = min((len(values) for values in columns.values()), default=0)
+    for start in range(0, max(length, 1), chunk_size):
+        stop = start + chunk_size
+        yield {name: values[start:stop] for name, values in columns.items()}
+
+
+def cohort_columns(
+    cohort: EHRCohort,
+    as_of: datetime | None = None,
+    sick: Iterable[tuple[str, str, float]] = (),
+) -> Chunk:
+    """
+    Compute the per-patient results of a cohort as columns.
+
+    Every patient gets an age as of as_of and an initial age, masked
+    when unknown, and an is_sick flag per (lab_name, operator, value)
+    condition in sick.
+    """
+    columns: Chunk = {
+        "PatientID": np.asarray(cohort.patient_ids, dtype=str),
+        "age": cohort.ages(as_of),
+        "initial_age": cohort.initial_ages(),
+    }
+    for lab_name, operator, value in sick:
+        name = f"is_sick({lab_name} {operator} {value})"
+        columns[name] = cohort.is_sick(lab_name, operator, value)
+    return columns
+
+
+class ChunkWriter(ABC):
+    """Create the writer of a stream of chunks to one file."""
+
+    def __init__(self, path: str) -> None:
+        """Initialize the writer of path."""
+        self.path = path
+
+    @abstractmethod
+    def write(self, chunk: Chunk) -> None:
+        """Append the rows of a chunk."""
+
+    @abstractmethod
+    def close(self) -> None:
+        """Finish the file."""
+
+
+def text_column(values: npt.NDArray[Any]) -> list[str]:
+    """Format a column for CSV, leaving missing or masked values empty."""
+    if not len(values):
+        return []
+    if np.ma.isMaskedArray(values):
+        text = text_column(np.ma.getdata(values))
+        for row in np.flatnonzero(np.ma.getmaskarray(values)).tolist():
+            text[row] = ""
+        return text
+    if values.dtype.kind == "M":
+        # Microseconds, like DATE_FORMAT, so dates read back unchanged
+        strings = np.char.replace(
+            np.datetime_as_string(values, unit="us"), "T", " "
+        )
+        strings[np.isnat(values)] = ""
+        dates: list[str] = strings.tolist()
+        return dates
+    if values.dtype.kind == "f":
+        return ["" if math.isnan(v) else repr(v) for v in values.tolist()]
+    return [str(v) for v in values.tolist()]
+
+
+class CsvWriter(ChunkWriter):
+    """Create the writer of a CSV file with a header row."""
+
+    def __init__(self, path: str) -> None:
+        """Initialize the writer, opening the file."""
+        super().__init__(path)
+        self._file = open(path, "w", newline="")
+        self._writer = csv.writer(self._file)
+        self._header = False
+
+    def write(self, chunk: Chunk) -> None:
+        """Append the rows of a chunk, after the header for the first."""
+        if not self._header:
+            self._writer.writerow(chunk)
+            self._header = True
+        columns = [text_column(values) for values in chunk.values()]
+        self._writer.writerows(zip(*columns))
+
+    def close(self) -> None:
+        """Close the file."""
+        self._file.close()
+
+
+def unmasked(values: npt.NDArray[Any]) -> npt.NDArray[Any]:
+    """Replace masked values by NaN, keeping unmasked columns as they are."""
+    if not np.ma.is_masked(values):
+        return np.ma.getdata(values)
+    return np.ma.filled(values.astype(np.float64), np.nan)
+
+
+class NpzWriter(ChunkWriter):
+    """
+    Create the writer of an NPZ file with one array per column.
+
+    Chunks are spooled to temporary files, and each column is written
+    to the archive in the dtype fitting all of its chunks, such as the
+    longest string, on close. Integers hold NaN for masked values, so a
+    column with any is written as floats.
+    """
+
+    def __init__(self, path: str) -> None:
+        """Initialize the writer, deferring the file to close."""
+        super().__init__(path)
+        self._directory = tempfile.TemporaryDirectory()
+        self._spools: dict[str, IO[bytes]] = {}
+        self._parts: dict[str, list[tuple[np.dtype[Any], int]]] = {}
+
+    def write(self, chunk: Chunk) -> None:
+        """Spool the columns of a chunk."""
+        for name, values in chunk.items():
+            if name not in self._spools:
+                spool = os.path.join(
+                    self._directory.name, str(len(self._spools))
+                )
+                self._spools[name] = open(spool, "w+b")
+                self._parts[name] = []
+            values = np.ascontiguousarray(unmasked(values))
+            self._spools[name].write(values.tobytes())
+            self._parts[name].append((values.dtype, len(values)))
+
+    def close(self) -> None:
+        """Write the archive, one chunk of a column at a time."""
+        try:
+            with zipfile.ZipFile(self.path, "w", allowZip64=True) as archive:
+                for name, spool in self._spools.items():
+                    self._write_column(archive, name, spool)
+        finally:
+            for spool in self._spools.values():
+                spool.close()
+            self._directory.cleanup()
+
+    def _write_column(
+        self, archive: zipfile.ZipFile, name: str, spool: IO[bytes]
+    ) -> None:
+        """Write the spooled chunks of a column as one array."""
+        parts = self._parts[name]
+        dtype = np.result_type(*(part_dtype for part_dtype, _ in parts))
+        header = {
+            "descr": np.lib.format.dtype_to_descr(dtype),
+            "fortran_order": False,
+            "shape": (sum(length for _, length in parts),),
+        }
+        spool.seek(0)
+        with archive.open(f"{name}.npy", "w", force_zip64=True) as member:
+            np.lib.format.write_array_header_2_0(member, header)
+            for part_dtype, length in parts:
+                data = spool.read(part_dtype.itemsize * length)
+                values = np.frombuffer(data, dtype=part_dtype)
+                member.write(values.astype(dtype).tobytes())
+
+
+class ParquetWriter(ChunkWriter):
+    """Create the writer of a Parquet file, one row group per chunk."""
+
+    def __init__(self, path: str) -> None:
+        """Initialize the writer, failing if pyarrow is not installed."""
+        super().__init__(path)
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError as error:
+            raise ImportError(
+                "Exporting to Parquet needs pyarrow, install it with "
+                "pip install pyarrow"
+            ) from error
+        self._pyarrow = pyarrow
+        self._parquet = pyarrow.parquet
+        self._writer: Any = None
+
+    def write(self, chunk: Chunk) -> None:
+        """Append the rows of a chunk, opening the file for the first."""
+        table = self._pyarrow.table(
+            {
+                name: self._pyarrow.array(
+                    np.ma.getdata(values), mask=np.ma.getmaskarray(values)
+                )
+                for name, values in chunk.items()
+            }
+        )
+        if self._writer is None:
+            self._writer = self._parquet.ParquetWriter(self.path, table.schema)
+        self._writer.write_table(table)
+
+    def close(self) -> None:
+        """Close the file."""
+        if self._writer is not None:
+            self._writer.close()
+
+
+WRITERS: dict[str, type[ChunkWriter]] = {
+    ".csv": CsvWriter,
+    ".npz": NpzWriter,
+    ".parquet": ParquetWriter,
+}
+
+
+def open_writer(path: str) -> ChunkWriter:
+    """Open the writer of the format named by the file extension."""
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in WRITERS:
+        raise ValueError(f"Unknown export format: {extension!r}")
+    return WRITERS[extension](path)
+
+
+def write_chunks(chunks: Iterable[Chunk], path: str) -> int:
+    """Write a stream of chunks to path, returning the number of rows."""
+    writer = open_writer(path)
+    rows = 0
+    try:
+        for chunk in chunks:
+            writer.write(chunk)
+            rows += min((len(v) for v in chunk.values()), default=0)
+    finally:
+        writer.close()
+    return rows
+
+
+def export_table(
+    table: str, path: str, chunk_size: int = EXPORT_CHUNK_SIZE
+) -> int:
+    """Export the labs or patients table, returning the number of rows."""
+    return write_chunks(table_chunks(table, chunk_size), path)
+
+
+def export_cohort(
+    cohort: EHRCohort,
+    path: str,
+    as_of: datetime | None = None,
+    sick: Iterable[tuple[str, str, float]] = (),
+    chunk_size: int = EXPORT_CHUNK_SIZE,
+) -> int:
+    """Export the results of cohort_columns, returning the patients."""
+    columns = cohort_columns(cohort, as_of, sick)
+    return write_chunks(array_chunks(columns, chunk_size), path)
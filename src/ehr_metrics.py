@@ -0,0 +1,237 @@
+"""
+This module instruments the EHR module's hot paths.
+
+While enabled, every SQL statement is counted and timed into a latency
+histogram, grouped by the accessor that ran it, such as Lab.LabValue or
+Patient.age, and named events such as connection opens and strptime
+calls are counted. While disabled, which is the default, accessors and
+connections only check one flag.
+"""
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import lru_cache, wraps
+import json
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Generator, Iterable, TypeVar, overload
+
+# Upper bounds of the latency histogram buckets in microseconds, the
+# last bucket holding every slower statement
+BUCKET_BOUNDS_US = (10, 100, 1_000, 10_000, 100_000, 1_000_000)
+UNATTRIBUTED = "unattributed"
+
+F = TypeVar("F", bound=Callable[..., Any])
+CursorT = TypeVar("CursorT", bound=sqlite3.Cursor)
+
+_enabled = False
+_lock = threading.Lock()
+_local = threading.local()
+
+
+class Histogram:
+    """Create the latency histogram of one statement."""
+
+    def __init__(self) -> None:
+        """Initialize an empty histogram."""
+        self.count = 0
+        self.total_seconds = 0.0
+        self.buckets = [0] * (len(BUCKET_BOUNDS_US) + 1)
+
+    def record(self, seconds: float) -> None:
+        """Add one latency."""
+        self.count += 1
+        self.total_seconds += seconds
+        self.buckets[bisect_left(BUCKET_BOUNDS_US, seconds * 1e6)] += 1
+
+    def as_dict(self) -> dict[str, Any]:
+        """Export the histogram, keying buckets by their upper bound."""
+        labels = [f"<={bound}us" for bound in BUCKET_BOUNDS_US]
+        labels.append(f">{BUCKET_BOUNDS_US[-1]}us")
+        return {
+            "count": self.count,
+            "total_seconds": self.total_seconds,
+            "buckets": dict(zip(labels, self.buckets)),
+        }
+
+
+# Histograms by accessor and statement, and event counters
+_statements: dict[str, dict[str, Histogram]] = {}
+_counters: dict[str, int] = {}
+
+
+def enable() -> None:
+    """Start recording."""
+    global _enabled
+    _enabled = True
+
+
+def disable() -> None:
+    """Stop recording, keeping what was recorded."""
+    global _enabled
+    _enabled = False
+
+
+def is_enabled() -> bool:
+    """Check whether recording is enabled."""
+    return _enabled
+
+
+def reset() -> None:
+    """Drop everything recorded."""
+    with _lock:
+        _statements.clear()
+        _counters.clear()
+
+
+@contextmanager
+def recording() -> Generator[None, None, None]:
+    """Record for the duration of a block."""
+    previous = _enabled
+    enable()
+    try:
+        yield
+    finally:
+        if not previous:
+            disable()
+
+
+def count(event: str, n: int = 1) -> None:
+    """Count n occurrences of an event while enabled."""
+    if _enabled:
+        with _lock:
+            _counters[event] = _counters.get(event, 0) + n
+
+
+def current_accessor() -> str:
+    """Return the accessor running on the calling thread."""
+    accessor: str = getattr(_local, "accessor", UNATTRIBUTED)
+    return accessor
+
+
+@contextmanager
+def attributed(name: str) -> Generator[None, None, None]:
+    """Attribute the statements a block runs to the accessor name."""
+    previous = getattr(_local, "accessor", UNATTRIBUTED)
+    _local.accessor = name
+    try:
+        yield
+    finally:
+        _local.accessor = previous
+
+
+def accessor(name: str) -> Callable[[F], F]:
+    """Attribute the statements a function runs to the accessor name."""
+
+    def decorate(function: F) -> F:
+        @wraps(function)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            if not _enabled:
+                return function(*args, **kwargs)
+            with attributed(name):
+                return function(*args, **kwargs)
+
+        return wrapper  # type: ignore[return-value]
+
+    return decorate
+
+
+@lru_cache(maxsize=1024)
+def statement_key(sql: str) -> str:
+    """Collapse the whitespace of a statement to key it."""
+    return " ".join(sql.split())
+
+
+def record_statement(sql: str, seconds: float) -> None:
+    """Add the latency of a statement run by the current accessor."""
+    key = statement_key(sql)
+    with _lock:
+        histograms = _statements.setdefault(current_accessor(), {})
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = Histogram()
+        histogram.record(seconds)
+
+
+class MeteredCursor(sqlite3.Cursor):
+    """Create the cursor that times its statements while enabled."""
+
+    def execute(self, sql: str, parameters: Any = (), /) -> "MeteredCursor":
+        """Run a statement, recording its latency."""
+        if not _enabled:
+            super().execute(sql, parameters)
+            return self
+        start = time.perf_counter()
+        try:
+            super().execute(sql, parameters)
+        finally:
+            record_statement(sql, time.perf_counter() - start)
+        return self
+
+    def executemany(
+        self, sql: str, seq_of_parameters: Iterable[Any], /
+    ) -> "MeteredCursor":
+        """Run a statement for every parameter set, recording its latency."""
+        if not _enabled:
+            super().executemany(sql, seq_of_parameters)
+            return self
+        start = time.perf_counter()
+        try:
+            super().executemany(sql, seq_of_parameters)
+        finally:
+            record_statement(sql, time.perf_counter() - start)
+        return self
+
+
+class MeteredConnection(sqlite3.Connection):
+    """Create the connection whose cursors are metered while enabled."""
+
+    @overload
+    def cursor(self, factory: None = None) -> sqlite3.Cursor:
+        ...
+
+    @overload
+    def cursor(
+        self, factory: Callable[[sqlite3.Connection], CursorT]
+    ) -> CursorT:
+        ...
+
+    def cursor(self, factory: Any = None) -> Any:
+        """Return a metered cursor while enabled, else a plain one."""
+        if factory is None:
+            factory = MeteredCursor if _enabled else sqlite3.Cursor
+        return super().cursor(factory)
+
+    def execute(self, sql: str, parameters: Any = (), /) -> sqlite3.Cursor:
+        """Run a statement on a new cursor."""
+        if not _enabled:
+            return super().execute(sql, parameters)
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(
+        self, sql: str, seq_of_parameters: Iterable[Any], /
+    ) -> sqlite3.Cursor:
+        """Run a statement for every parameter set on a new cursor."""
+        if not _enabled:
+            return super().executemany(sql, seq_of_parameters)
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def snapshot() -> dict[str, Any]:
+    """Export the statements by accessor and the event counters."""
+    with _lock:
+        return {
+            "statements": {
+                name: {
+                    sql: histogram.as_dict()
+                    for sql, histogram in histograms.items()
+                }
+                for name, histograms in _statements.items()
+            },
+            "counters": dict(_counters),
+        }
+
+
+def to_json(indent: int | None = None) -> str:
+    """Export the snapshot as JSON."""
+    return json.dumps(snapshot(), indent=indent)
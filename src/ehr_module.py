@@ -3,103 +3,529 @@ This module analyzes EHR records.
 
 It analyzes both patient and lab information.
 """
+from contextlib import closing
 from datetime import datetime
+from itertools import islice
+import math
+import os
 import sqlite3
-from fake_files import fake_files
+import tempfile
+import time
+from typing import (
+    Any,
+    Callable,
+    Hashable,
+    Iterable,
+    NamedTuple,
+    Sequence,
+    TypeVar,
+)
+import ehr_cache
+import ehr_metrics
+from incremental_ingest import record_ingested
+from parallel_ingest import read_chunks_parallel
+from tsv_reader import read_chunks, read_rows
+from ehr_connection import (
+    get_manager,
+    publish_database,
+    tuned_pragmas,
+    using_database,
+)
+from ehr_dates import epoch_us, from_epoch_us, parse_datetime, to_datetime64
+from ehr_cohort import EHRCohort, demographic_arrays, whole_years
+import ehr_schema as schema
+from ehr_schema import LAB_COLUMNS, PATIENT_COLUMNS
+from lab_dictionary import Categories
+from lab_store import LabStore
+from patient_lab_index import IndexEntry, PatientLabIndex
+
+
+HYDRATE_CHUNK_SIZE = 500
+DEMOGRAPHICS_PAGE_SIZE = 500
+# Every Lab shares one copy of each distinct lab name and units
+LAB_NAMES = Categories()
+LAB_UNITS = Categories()
+
+T = TypeVar("T")
 
 
 class Lab:
-    """Create the lab class."""
+    """
+    Create the lab class.
+
+    A hydrated lab carries all of its fields, while a lazy lab only
+    stores its IDs and reads the other fields from the database.
+    """
+
+    __slots__ = (
+        "PatientID",
+        "LabID",
+        "_name",
+        "_value",
+        "_units",
+        "_date_time",
+    )
 
-    def __init__(self, PatientID: str, LabID: str) -> None:
+    def __init__(
+        self,
+        PatientID: str,
+        LabID: str,
+        LabName: str | None = None,
+        LabValue: float | None = None,
+        LabUnits: str | None = None,
+        LabDateTime: datetime | None = None,
+    ) -> None:
         """Initialize the lab class."""
         self.PatientID = PatientID
         self.LabID = LabID
+        self._name = LabName
+        self._value = LabValue
+        self._units = LabUnits
+        self._date_time = LabDateTime
+
+    @classmethod
+    def from_row(cls, row: tuple[str, ...]) -> "Lab":
+        """Create a hydrated lab from a labs table row."""
+        patient_id, _, name, value, units, date_time, lab_id = row
+        return cls(
+            patient_id,
+            lab_id,
+            LAB_NAMES.intern(name),
+            float(value),
+            LAB_UNITS.intern(units),
+            parse_datetime(date_time),
+        )
+
+    @property
+    def hydrated(self) -> bool:
+        """Check whether the fields are held in memory."""
+        return self._date_time is not None
+
+    def hydrate(
+        self,
+        LabName: str,
+        LabValue: float,
+        LabUnits: str,
+        LabDateTime: datetime,
+    ) -> None:
+        """Store the fields of the lab in memory."""
+        self._name = LabName
+        self._value = LabValue
+        self._units = LabUnits
+        self._date_time = LabDateTime
 
     @property
     def LabName(self) -> str:
         """Define LabName property."""
-        connection = sqlite3.connect("ehr_database.db")
-        cursor = connection.cursor()
-        lab_name = cursor.execute(
-            f"""SELECT LabName
-            FROM labs
-            WHERE LabID='{self.LabID}'"""
-        ).fetchall()
-        return str(lab_name[0][0])
+        if self._name is not None:
+            return self._name
+        return str(self._select(schema.SELECT_LAB_NAME, "Lab.LabName"))
 
     @property
-    def LabValue(self) -> str:
+    def LabValue(self) -> float:
         """Define LabValue property."""
-        connection = sqlite3.connect("ehr_database.db")
-        cursor = connection.cursor()
-        print(self.PatientID)
-        lab_value = cursor.execute(
-            f"""SELECT LabValue
-            FROM labs
-            WHERE LabID='{self.LabID}'"""
-        ).fetchall()
-        return str(lab_value[0][0])
+        if self._value is not None:
+            return self._value
+        return float(self._select(schema.SELECT_LAB_VALUE, "Lab.LabValue"))
 
     @property
     def LabUnits(self) -> str:
         """Define LabUnits property."""
-        connection = sqlite3.connect("ehr_database.db")
-        cursor = connection.cursor()
-        lab_units = cursor.execute(
-            f"""SELECT LabUnits
-            FROM labs
-            WHERE LabID='{self.LabID}'"""
-        ).fetchall()
-        return str(lab_units[0][0])
+        if self._units is not None:
+            return self._units
+        return str(self._select(schema.SELECT_LAB_UNITS, "Lab.LabUnits"))
 
     @property
     def LabDateTime(self) -> datetime:
         """Calculate the date of the lab."""
-        connection = sqlite3.connect("ehr_database.db")
-        cursor = connection.cursor()
-        lab_date_raw = cursor.execute(
-            f"""
-            SELECT LabDateTime
-            FROM labs
-            WHERE LabID='{self.LabID}'"""
-        ).fetchall()
-        lab_date_str = str(lab_date_raw[0][0])
-        format = "%Y-%m-%d %H:%M:%S.%f"
-        lab_date = datetime.strptime(lab_date_str, format)
+        if self._date_time is not None:
+            return self._date_time
+        return from_epoch_us(
+            self._select(schema.SELECT_LAB_DATE_TIME, "Lab.LabDateTime")
+        )
+
+    def _select(self, sql: str, accessor: str) -> Any:
+        """Read one field of a lazy lab, attributing it to the accessor."""
+        if not ehr_metrics.is_enabled():
+            return self._fetch(sql)
+        with ehr_metrics.attributed(accessor):
+            return self._fetch(sql)
+
+    def _fetch(self, sql: str) -> Any:
+        """Read one field of a lazy lab."""
+        cursor = get_manager().connection().cursor()
+        return cursor.execute(sql, (self.LabID,)).fetchone()[0]
+
+
+def index_entry(lab: Lab) -> IndexEntry[Lab]:
+    """Key a lab for a PatientLabIndex by its own fields."""
+    return (lab.PatientID, lab.LabName, lab.LabDateTime, lab.LabValue, lab)
+
+
+@ehr_metrics.accessor("hydrate_labs")
+def hydrate_labs(
+    labs: Iterable[Lab], chunk_size: int = HYDRATE_CHUNK_SIZE
+) -> None:
+    """Load the fields of lazy labs with one query per chunk of labs."""
+    lazy_labs = (lab for lab in labs if not lab.hydrated)
+    cursor = get_manager().connection().cursor()
+    while chunk := list(islice(lazy_labs, chunk_size)):
+        by_id = {lab.LabID: lab for lab in chunk}
+        rows = cursor.execute(
+            schema.select_labs_by_id(len(by_id)), tuple(by_id)
+        )
+        for lab_id, name, value, units, date_time in rows:
+            by_id[str(lab_id)].hydrate(
+                LAB_NAMES.intern(name),
+                float(value),
+                LAB_UNITS.intern(units),
+                from_epoch_us(date_time),
+            )
+
+
+class DatabaseLabIndex:
+    """
+    Create the lab index of lazy patients, answered by the database.
+
+    It has the lookups of PatientLabIndex, which are answered with the
+    labs table's (PatientKey, LabDateTime) and (LabNameKey, PatientKey,
+    LabValue) indexes, so nothing is held in memory per lab. The labs it
+    returns are read again on every lookup.
+    """
+
+    def __init__(self, hydrate: bool = False) -> None:
+        """Initialize the index, returning lazy labs unless hydrate is set."""
+        self.hydrate = hydrate
+
+    def __len__(self) -> int:
+        """Count the labs in the database."""
+        cursor = get_manager().connection().cursor()
+        return int(cursor.execute(schema.COUNT_LABS).fetchone()[0])
+
+    def __contains__(self, patient_id: object) -> bool:
+        """Check whether a patient has any labs."""
+        cursor = get_manager().connection().cursor()
+        row = cursor.execute(schema.SELECT_PATIENT_HAS_LABS, (patient_id,))
+        return bool(row.fetchone()[0])
+
+    def lab_names(self, patient_id: str) -> list[str]:
+        """List the names of a patient's labs in sorted order."""
+        cursor = get_manager().connection().cursor()
+        rows = cursor.execute(schema.SELECT_PATIENT_LAB_NAMES, (patient_id,))
+        return [row[0] for row in rows]
+
+    @ehr_metrics.accessor("Patient.patient_labs")
+    def labs(
+        self,
+        patient_id: str,
+        lab_name: str | None = None,
+        start: datetime | None = None,
+        end: datetime | None = None,
+    ) -> list[Lab]:
+        """Find a patient's labs like PatientLabIndex.labs."""
+        parameters: list[str | int] = [patient_id]
+        if lab_name is not None:
+            parameters.append(lab_name)
+        if start is not None:
+            parameters.append(epoch_us(start))
+        if end is not None:
+            parameters.append(epoch_us(end))
+        sql = schema.select_patient_labs(
+            lab_name is not None, start is not None, end is not None
+        )
+        cursor = get_manager().connection().cursor()
+        rows = cursor.execute(sql, parameters)
+        labs = [Lab(patient_id, str(row[0])) for row in rows]
+        if self.hydrate:
+            hydrate_labs(labs)
+        return labs
+
+    def is_sick(
+        self, patient_id: str, lab_name: str, operator: str, value: float
+    ) -> bool:
+        """
+        Answer Patient.is_sick with one indexed aggregate query.
+
+        Unknown patients raise KeyError, like Patient.age.
+        """
+        schema.check_operator(operator)
+        cursor = get_manager().connection().cursor()
+        sick = cursor.execute(
+            schema.select_is_sick(operator), (value, lab_name, patient_id)
+        ).fetchone()
+        if sick is None:
+            raise KeyError(patient_id)
+        return bool(sick[0])
+
+
+# Where parse_data patients find their labs
+LabIndex = PatientLabIndex[Lab] | DatabaseLabIndex
+
+# A patient's DEMOGRAPHIC_COLUMNS, with None for missing values
+Demographics = tuple[str | float | None, ...]
+
+
+@ehr_metrics.accessor("Patient.demographics")
+def select_demographics(patient_ids: Sequence[str]) -> dict[str, Demographics]:
+    """Read the demographics of patients, leaving unknown ones out."""
+    cursor = get_manager().connection().cursor()
+    rows = cursor.execute(
+        schema.select_demographics(len(patient_ids)), tuple(patient_ids)
+    )
+    return {row[0]: tuple(row[1:]) for row in rows}
+
+
+def demographic_value(column: str, value: Any) -> str | float | None:
+    """
+    Convert a stored demographic, None if it is missing.
+
+    Cohort arrays hold "" and NaN for missing values and the table NULL,
+    or "" in databases loaded before blanks were stored as NULL.
+    """
+    if value is None or (isinstance(value, str) and not value):
+        return None
+    if column in schema.NUMERIC_DEMOGRAPHICS:
+        number = float(value)
+        return None if math.isnan(number) else number
+    return str(value)
+
 
-        return lab_date
+class DemographicsPrefetch:
+    """Create the paged loader of the demographics of a patient list."""
+
+    def __init__(
+        self,
+        patients: Sequence["Patient"],
+        page_size: int = DEMOGRAPHICS_PAGE_SIZE,
+    ) -> None:
+        """
+        Attach the loader to patients.
+
+        The first patient read from each page of page_size patients
+        loads the whole page with one query.
+        """
+        self.patient_ids = [patient.patient_id for patient in patients]
+        self.page_size = page_size
+        self._pages: dict[int, dict[str, Demographics]] = {}
+        self._generation = ehr_cache.generation()
+        for position, patient in enumerate(patients):
+            patient._prefetch = (self, position)
+
+    def demographics(self, position: int) -> Demographics:
+        """
+        Read the demographics of the patient at position.
+
+        An unknown patient raises KeyError without failing the rest of
+        their page.
+        """
+        if self._generation != ehr_cache.generation():
+            # The tables were reloaded since the pages were read
+            self._pages.clear()
+            self._generation = ehr_cache.generation()
+        page = position // self.page_size
+        demographics = self._pages.get(page)
+        if demographics is None:
+            start = page * self.page_size
+            stop = start + self.page_size
+            demographics = self._pages[page] = select_demographics(
+                self.patient_ids[start:stop]
+            )
+        return demographics[self.patient_ids[position]]
+
+
+def prefetch_demographics(
+    patients: Sequence["Patient"], page_size: int = DEMOGRAPHICS_PAGE_SIZE
+) -> DemographicsPrefetch:
+    """Load the demographics of patients in pages when first read."""
+    return DemographicsPrefetch(patients, page_size)
 
 
 class Patient:
     """Create the patient class."""
 
-    def __init__(self, patient_id: str, patient_labs: list[Lab]) -> None:
-        """Intiialize the patient."""
+    def __init__(
+        self,
+        patient_id: str,
+        patient_labs: list[Lab] | None = None,
+        cohort: EHRCohort | None = None,
+        lab_index: LabIndex | None = None,
+    ) -> None:
+        """
+        Intiialize the patient.
+
+        When the patient belongs to a cohort, age, initial_age and the
+        demographics are read from the cohort arrays instead of the
+        database. With a lab index, patient_labs and is_sick are
+        answered by the index.
+
+        A cohort read from the database is replaced by the current one
+        once the tables change, and the labs read with it by the
+        database's.
+        """
         self.patient_id = patient_id
-        self.patient_labs = patient_labs
+        self._patient_labs = patient_labs
+        self._cohort = cohort
+        self.lab_index = lab_index
+        self._prefetch: tuple[DemographicsPrefetch, int] | None = None
+
+    @property
+    def cohort(self) -> EHRCohort | None:
+        """Return the cohort of the patient, None without one."""
+        self._refresh()
+        return self._cohort
+
+    @cohort.setter
+    def cohort(self, cohort: EHRCohort | None) -> None:
+        """Attach the patient to a cohort."""
+        self._cohort = cohort
+
+    def _refresh(self) -> None:
+        """Replace a cohort and labs the tables changed since."""
+        cohort = self._cohort
+        if (
+            cohort is None
+            or not cohort.stale
+            or cohort.database != get_manager().database
+        ):
+            return
+        self._cohort = current_cohort()
+        if not isinstance(self.lab_index, DatabaseLabIndex):
+            self._patient_labs = None
+            self.lab_index = DatabaseLabIndex(hydrate=True)
+
+    @property
+    def patient_labs(self) -> list[Lab]:
+        """
+        List the labs of the patient.
+
+        Lazy patients of parse_data read them from the database on every
+        access.
+        """
+        self._refresh()
+        if self._patient_labs is not None:
+            return self._patient_labs
+        if self.lab_index is not None:
+            return self.lab_index.labs(self.patient_id)
+        return []
+
+    @patient_labs.setter
+    def patient_labs(self, patient_labs: list[Lab]) -> None:
+        """Replace the labs of the patient."""
+        self._patient_labs = patient_labs
+
+    def _cached(
+        self, key: tuple[Hashable, ...], compute: Callable[[], T]
+    ) -> T:
+        """
+        Look up a metric in ehr_cache, computing it on a miss.
+
+        The cache only sees loads made by this process, so metrics read
+        from a read-only database, which other processes write, are
+        never cached.
+        """
+        if self.cohort is None and get_manager().read_only:
+            return compute()
+        return ehr_cache.cached(key, compute)
+
+    def _source(self) -> Hashable:
+        """Identify where the patient's metrics are read from."""
+        if self.cohort is not None:
+            return self.cohort
+        return get_manager().database
+
+    def _demographic(self, column: str) -> str | float | None:
+        """
+        Read one of the DEMOGRAPHIC_COLUMNS, None if it is missing.
+
+        Without a cohort, a patient of prefetch_demographics reads it
+        with its page and any other patient with its own query.
+        """
+        cohort = self.cohort
+        if cohort is not None and cohort.demographics is not None:
+            return demographic_value(
+                column,
+                cohort.demographics[column][cohort.position(self.patient_id)],
+            )
+        if self._prefetch is not None:
+            prefetch, position = self._prefetch
+            demographics = prefetch.demographics(position)
+        else:
+            demographics = self._cached(
+                ("demographics", self._source(), self.patient_id),
+                lambda: select_demographics([self.patient_id])[
+                    self.patient_id
+                ],
+            )
+        return demographic_value(
+            column, demographics[schema.DEMOGRAPHIC_COLUMNS.index(column)]
+        )
+
+    @property
+    def gender(self) -> str | None:
+        """Read PatientGender."""
+        return self._text("PatientGender")
+
+    @property
+    def race(self) -> str | None:
+        """Read PatientRace."""
+        return self._text("PatientRace")
+
+    @property
+    def marital_status(self) -> str | None:
+        """Read PatientMaritalStatus."""
+        return self._text("PatientMaritalStatus")
 
     @property
-    def age(self) -> int:
-        """Calculate the age in years."""
-        connection = sqlite3.connect("ehr_database.db")
-        cursor = connection.cursor()
-
-        patient_birthday_raw = cursor.execute(
-            f"""SELECT PatientDateOfBirth
-            FROM patients
-            WHERE PatientID='{self.patient_id}'"""
-        ).fetchall()
-        patient_birthday_str: str = str(patient_birthday_raw[0][0])
-
-        format = "%Y-%m-%d %H:%M:%S.%f"
-        patient_birthday = datetime.strptime(patient_birthday_str, format)
-        current_time = datetime.now()
-        delta = current_time - patient_birthday
-        age = int(delta.days / 365.2425)
-        connection.close()
-        return age
+    def language(self) -> str | None:
+        """Read PatientLanguage."""
+        return self._text("PatientLanguage")
+
+    @property
+    def poverty(self) -> float | None:
+        """Read PatientPopulationPercentageBelowPoverty."""
+        value = self._demographic("PatientPopulationPercentageBelowPoverty")
+        return None if value is None else float(value)
+
+    def _text(self, column: str) -> str | None:
+        """Read a text demographic column."""
+        value = self._demographic(column)
+        return None if value is None else str(value)
+
+    @property
+    @ehr_metrics.accessor("Patient.age")
+    def age(self) -> int | None:
+        """
+        Calculate the age in years as of ehr_cache.as_of().
+
+        The age is None without a birth date, and unknown patients raise
+        KeyError.
+        """
+        as_of = ehr_cache.as_of()
+        return self._cached(
+            ("age", self._source(), self.patient_id, as_of),
+            lambda: self._age(as_of),
+        )
 
+    def _age(self, as_of: datetime) -> int | None:
+        """Calculate the age in years at a date without the cache."""
+        if self.cohort is not None:
+            return self.cohort.age_of(self.patient_id, as_of)
+        cursor = get_manager().connection().cursor()
+        patient_birthday = self._birth_date(cursor)
+        if patient_birthday is None:
+            return None
+        return whole_years(patient_birthday, as_of)
+
+    def _birth_date(self, cursor: sqlite3.Cursor) -> datetime | None:
+        """Read the birth date, failing for unknown patients."""
+        row = cursor.execute(
+            schema.SELECT_BIRTH_DATE, (self.patient_id,)
+        ).fetchone()
+        if row is None:
+            raise KeyError(self.patient_id)
+        return None if row[0] is None else from_epoch_us(row[0])
+
+    @ehr_metrics.accessor("Patient.is_sick")
     def is_sick(
         self,
         lab_name: str,
@@ -109,185 +535,328 @@ class Patient:
         """
         Take in patient records and determine relationship to threshold.
 
-        Return boolean.
+        Return whether any lab named lab_name is below ("<") or above
+        (">") value, which is False when the patient has no such lab.
         """
-        connection = sqlite3.connect("ehr_database.db")
-        cursor = connection.cursor()
-
-        lab_values = self.patient_labs
-        float_values = [
-            float(lab_values[i].LabValue) for i in range(len(lab_values))
-        ]
-        if operator == "<":
-            if min(float_values) < value:
-                return True
-        if operator == ">":
-            if max(float_values) > value:
-                return True
-        return False
-
-    def initial_age(self) -> int:
-        """Calculate patient age for initial lab record."""
-        connection = sqlite3.connect("ehr_database.db")
-        cursor = connection.cursor()
+        schema.check_operator(operator)
+        self._refresh()
+        if self.cohort is not None and self.cohort.store is not None:
+            return self.cohort.store.patient_is_sick(
+                self.patient_id, lab_name, operator, value
+            )
+        lab_index = self.lab_index
+        if lab_index is None:
+            lab_index = DatabaseLabIndex()
+        return lab_index.is_sick(self.patient_id, lab_name, operator, value)
+
+    @ehr_metrics.accessor("Patient.initial_age")
+    def initial_age(self) -> int | None:
+        """
+        Calculate patient age for initial lab record.
+
+        Like age, it is None without a birth date or without any labs.
+        """
+        return self._cached(
+            ("initial_age", self._source(), self.patient_id),
+            self._initial_age,
+        )
+
+    def _initial_age(self) -> int | None:
+        """Calculate the age at the first lab without the cache."""
+        if self.cohort is not None:
+            return self.cohort.initial_age_of(self.patient_id)
+        cursor = get_manager().connection().cursor()
         # Finding the birthday for the patient
-        format = "%Y-%m-%d %H:%M:%S.%f"  # O(1)
-        patient_birthday_raw = cursor.execute(
-            f"""SELECT PatientDateOfBirth
-            FROM Patients
-            WHERE PatientID='{self.patient_id}'"""
-        ).fetchall()
-        patient_birthday_str = str(patient_birthday_raw[0][0])
-        patient_birthday = datetime.strptime(patient_birthday_str, format)
+        patient_birthday = self._birth_date(cursor)
 
         min_date_raw = cursor.execute(
-            f"""SELECT MIN(LabDateTime)
-            FROM labs
-            WHERE PatientID='{self.patient_id}'"""
-        ).fetchall()
-        min_date2 = min_date_raw[0][0]
-        min_date = datetime.strptime(min_date2, format)
-        delta = min_date - patient_birthday
-        age = int(delta.days / 365.2425)
+            schema.SELECT_FIRST_LAB_DATE, (self.patient_id,)
+        ).fetchone()
+        if patient_birthday is None or min_date_raw[0] is None:
+            return None
+        return whole_years(patient_birthday, from_epoch_us(min_date_raw[0]))
 
-        return age
 
+def current_cohort() -> EHRCohort:
+    """Read the cohort of the current database once per generation."""
+    return ehr_cache.cached(
+        ("cohort", get_manager().database), EHRCohort.from_database
+    )
 
-def parse_lab_file(lab_filename: str) -> list[Lab]:
-    """Parse through the lab file."""
-    connection = sqlite3.connect("ehr_database.db")
-    cursor = connection.cursor()
 
-    # Read File
-    lab_file = open(lab_filename)  # O(1)
-    headers = lab_file.readline().strip().split("\t")  # O(q)
-    data = lab_file.readlines()  # O(pq)
-    lab_file.close()
+@ehr_metrics.accessor("cohort_is_sick")
+def cohort_is_sick(
+    lab_name: str,
+    operator: str,
+    value: float,
+) -> dict[str, bool]:
+    """Answer Patient.is_sick for every patient with one query."""
+    schema.check_operator(operator)
+    cursor = get_manager().connection().cursor()
+    rows = cursor.execute(
+        schema.select_cohort_is_sick(operator), (value, lab_name)
+    )
+    return {patient_id: bool(sick) for patient_id, sick in rows}
 
-    # Parse lab file and get individual lab records
-    labs: list[Lab] = []
-    lab_id = 0
-    for lab in data:
-        # Creating a Lab Class instance with Patient idea
-        lab_data = lab.split("\t")
-        lab_dict = dict(zip(headers, lab_data))
-        # Storing the rest of the lab data in the SQL database
-        cursor.executemany(
-            """INSERT INTO labs (PatientID,
-                                AdmissionID,
-                                LabName,
-                                LabValue,
-                                LabUnits,
-                                LabDateTime,
-                                LabID)
-                VALUES (?, ?, ?, ?, ?, ?, ?)""",
-            [
-                (
-                    lab_dict["PatientID"],
-                    lab_dict["AdmissionID"],
-                    lab_dict["LabName"],
-                    lab_dict["LabValue"],
-                    lab_dict["LabUnits"],
-                    lab_dict["LabDateTime"],
-                    str(lab_id),
-                )
-            ],
-        )
 
-        labs.append(Lab(lab_dict["PatientID"], str(lab_id)))
-        lab_id += 1
+class LoadReport(NamedTuple):
+    """Summary of a bulk load."""
+
+    rows: int
+    seconds: float
+
+    @property
+    def rows_per_second(self) -> float:
+        """Calculate the load throughput."""
+        if self.seconds <= 0:
+            return float(self.rows)
+        return self.rows / self.seconds
+
+
+DEFAULT_CHUNK_SIZE = 10_000
+# The journal stays in WAL mode so readers are never blocked by a load
+BULK_LOAD_PRAGMAS = {
+    "synchronous": "OFF",
+    "cache_size": "-65536",
+}
+
+
+@ehr_metrics.accessor("bulk_load_lab_file")
+def bulk_load_lab_file(
+    lab_filename: str,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    on_chunk: Callable[[list[tuple[str, ...]]], None] | None = None,
+    workers: int = 1,
+) -> LoadReport:
+    """
+    Load the lab file into the labs table in a single transaction.
+
+    Rows are streamed in chunks of chunk_size and each chunk is written
+    with one executemany call. on_chunk is called with every chunk of
+    inserted rows, which end with the generated LabID.
+
+    With more than one worker, the file is tokenized by that many
+    processes in byte ranges, which replace chunk_size as the unit of
+    each insert. LabIDs are the same as with a single worker.
+    """
+    start = time.perf_counter()
+    if workers > 1:
+        chunks = read_chunks_parallel(lab_filename, LAB_COLUMNS, workers)
+    else:
+        chunks = read_chunks(lab_filename, LAB_COLUMNS, chunk_size)
+    connection = get_manager().connection()
     connection.commit()
-    connection.close()
+    rows = 0
+    with tuned_pragmas(connection, BULK_LOAD_PRAGMAS), closing(
+        connection.cursor()
+    ) as cursor:
+        cursor.execute("BEGIN")
+        try:
+            for records in chunks:
+                chunk = [
+                    (*record, str(lab_id))
+                    for lab_id, record in enumerate(records, start=rows)
+                ]
+                schema.insert_labs(cursor, chunk)
+                if on_chunk is not None:
+                    on_chunk(chunk)
+                rows += len(chunk)
+        except BaseException:
+            connection.rollback()
+            raise
+        connection.commit()
+    ehr_cache.invalidate()
+
+    return LoadReport(rows, time.perf_counter() - start)
+
+
+def parse_lab_file(
+    lab_filename: str,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    lazy: bool = False,
+    workers: int = 1,
+) -> list[Lab]:
+    """
+    Parse through the lab file.
+
+    Labs are hydrated as they are parsed unless lazy is set, in which
+    case they only hold their IDs and read everything else from the
+    database. workers sets the number of processes tokenizing the file.
+    """
+    labs: list[Lab] = []
+
+    def add_labs(chunk: list[tuple[str, ...]]) -> None:
+        if lazy:
+            labs.extend(Lab(row[0], row[-1]) for row in chunk)
+        else:
+            labs.extend(Lab.from_row(row) for row in chunk)
+
+    bulk_load_lab_file(lab_filename, chunk_size, add_labs, workers)
 
     return labs
 
 
+def parse_lab_index(
+    lab_filename: str,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    lazy: bool = False,
+    workers: int = 1,
+) -> LabIndex:
+    """
+    Parse through the lab file into a lab index.
+
+    The arguments are those of parse_lab_file. Hydrated labs are kept in
+    a PatientLabIndex, while lazy ones are only kept in the database and
+    looked up through a DatabaseLabIndex.
+    """
+    if lazy:
+        bulk_load_lab_file(lab_filename, chunk_size, workers=workers)
+        return DatabaseLabIndex()
+    entries: list[IndexEntry[Lab]] = []
+
+    def add_entries(chunk: list[tuple[str, ...]]) -> None:
+        entries.extend(index_entry(Lab.from_row(row)) for row in chunk)
+
+    bulk_load_lab_file(lab_filename, chunk_size, add_entries, workers)
+
+    return PatientLabIndex(entries)
+
+
 def parse_patient_file(
-    patient_filename: str, lab_records: list[Lab]
+    patient_filename: str,
+    lab_records: list[Lab] | LabIndex,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
 ) -> list[Patient]:
-    """Parse through just the patient file."""
-    connection = sqlite3.connect("ehr_database.db")
-    cursor = connection.cursor()
+    """
+    Parse through just the patient file.
 
-    # Read file
-    patient_file = open(patient_filename)  # O(1)
-    headers = (
-        patient_file.readline().strip().split("\t")
-    )  # O(n) #chars in line1
-    data = patient_file.readlines()  # O(mn) - reads entire file
-    patient_file.close()  # O(1)
+    A list of labs is indexed first, and patients without labs get an
+    empty list of labs.
+    """
+    connection = get_manager().connection()
+    cursor = connection.cursor()
 
-    # Parse through labs and make dictionary
-    labs_dict: dict[str, list[Lab]] = dict()
-    for lab in lab_records:
-        labs_dict.setdefault(lab.PatientID, []).append(lab)
+    if isinstance(lab_records, list):
+        lab_index: LabIndex = PatientLabIndex(
+            index_entry(lab) for lab in lab_records
+        )
+    else:
+        lab_index = lab_records
 
-    # Parse rows and get records for each patient
+    # Stream rows and get records for each patient
     patient_records = []
-    for patient in data:
-        patient_data = patient.split("\t")
-        patient_records_dict = dict(zip(headers, patient_data))
-        print(labs_dict)
-        patient_labs: list[Lab] = labs_dict[patient_records_dict["PatientID"]]
-        patientClass = Patient(patient_records_dict["PatientID"], patient_labs)
-
-        patient_records.append(patientClass)
-        cursor.executemany(
-            "INSERT INTO patients Values(?, ?, ?, ?, ?, ?, ?)",
-            [
-                (
-                    patient_records_dict["PatientID"],
-                    patient_records_dict["PatientGender"],
-                    patient_records_dict["PatientDateOfBirth"],
-                    patient_records_dict["PatientRace"],
-                    patient_records_dict["PatientMaritalStatus"],
-                    patient_records_dict["PatientLanguage"],
-                    patient_records_dict[
-                        "PatientPopulationPercentageBelowPoverty"
-                    ],
-                )
-            ],
-        )
+    for chunk in read_chunks(patient_filename, PATIENT_COLUMNS, chunk_size):
+        for patient in chunk:
+            patient_records.append(Patient(patient[0], lab_index=lab_index))
+        schema.upsert_patients(cursor, chunk)
     connection.commit()
-    connection.close()
 
     return patient_records
 
 
-def parse_data(patient_filename: str, lab_filename: str) -> list[Patient]:
-    """Take in files and return dictionaries of data."""
-    connection = sqlite3.connect("ehr_database.db")
+@ehr_metrics.accessor("parse_data")
+def parse_data(
+    patient_filename: str,
+    lab_filename: str,
+    lazy: bool = False,
+    workers: int = 1,
+) -> list[Patient]:
+    """
+    Take in files and return dictionaries of data.
+
+    Set lazy to keep the labs in the database instead of in memory, and
+    workers to tokenize the lab file in that many processes.
+    """
+    connection = get_manager().connection()
     cursor = connection.cursor()
-    cursor.execute("DROP TABLE IF EXISTS patients")
-    cursor.execute("DROP TABLE IF EXISTS labs")
-
-    cursor.execute(
-        """CREATE TABLE patients
-                (PatientID VARCHAR,
-                PatientGender VARCHAR,
-                PatientDateOfBirth VARCHAR,
-                PatientRace VARCHAR,
-                PatientMaritalStatus VARCHAR,
-                PatientLanguage VARCHAR,
-                PatientPopulationPercentageBelowPoverty VARCHAR)"""
-    )
+    schema.create_tables(cursor)
+    connection.commit()
+    lab_index = parse_lab_index(lab_filename, lazy=lazy, workers=workers)
+    patient_records = parse_patient_file(patient_filename, lab_index)
+    # Indexes are built after the bulk load rather than maintained per row
+    schema.create_indexes(cursor)
+    # Incremental loads resume after the files loaded here
+    record_ingested(cursor, lab_filename)
+    record_ingested(cursor, patient_filename)
+    connection.commit()
+    ehr_cache.invalidate()
 
-    cursor.execute(
-        """CREATE TABLE labs
-                (PatientID VARCHAR,
-                AdmissionID VARCHAR,
-                LabName VARCHAR,
-                LabValue VARCHAR,
-                LabUnits VARCHAR,
-                LabDateTime VARCHAR,
-                LabID VARCHAR)"""
-    )
-    lab_records = parse_lab_file(lab_filename)
-    patient_records = parse_patient_file(patient_filename, lab_records)
+    cohort = EHRCohort.from_database()
+    for patient in patient_records:
+        patient.cohort = cohort
 
     return patient_records
 
 
+def rebuild_database(
+    patient_filename: str,
+    lab_filename: str,
+    lazy: bool = False,
+    workers: int = 1,
+) -> list[Patient]:
+    """
+    Load files like parse_data into a new database, then publish it.
+
+    The current database keeps its previous data until all of the new
+    data replaces it in one transaction, so readers never see the
+    emptied tables parse_data starts from.
+    """
+    target = get_manager().database
+    with tempfile.TemporaryDirectory() as directory:
+        building = os.path.join(directory, "ehr.db")
+        with using_database(building):
+            patients = parse_data(
+                patient_filename, lab_filename, lazy, workers
+            )
+        publish_database(building, target)
+    ehr_cache.invalidate()
+
+    cohort = EHRCohort.from_database()
+    for patient in patients:
+        patient.cohort = cohort
+    return patients
+
+
+def store_labs(store: LabStore, patient_id: str) -> list[Lab]:
+    """Create hydrated labs for a patient from a columnar store."""
+    return [
+        Lab(patient_id, str(store.lab_ids[row]), *store.lab_fields(row))
+        for row in store.patient_range(patient_id)
+    ]
+
+
+def parse_columnar(patient_filename: str, lab_filename: str) -> list[Patient]:
+    """
+    Take in files and return patients backed by a columnar lab store.
+
+    Nothing is written to the database, and the patients' metrics are
+    computed from the in-memory columns.
+    """
+    store = LabStore.from_file(lab_filename)
+    patients = list(
+        read_rows(
+            patient_filename,
+            ("PatientID", "PatientDateOfBirth", *schema.DEMOGRAPHIC_COLUMNS),
+        )
+    )
+    cohort = EHRCohort.from_store(
+        store,
+        [patient[0] for patient in patients],
+        to_datetime64(patient[1] for patient in patients),
+        demographic_arrays([patient[2:] for patient in patients]),
+    )
+    return [
+        cohort_patient(cohort, patient_id) for patient_id in cohort.patient_ids
+    ]
+
+
+def cohort_patient(cohort: EHRCohort, patient_id: str) -> Patient:
+    """Create a patient of a cohort backed by a columnar store."""
+    if cohort.store is None:
+        raise ValueError("The cohort has no lab store")
+    return Patient(patient_id, store_labs(cohort.store, patient_id), cohort)
+
+
 def main() -> None:
     """Run the ehr-module."""
 
@@ -0,0 +1,543 @@
+"""
+This module defines the SQLite schema and queries of the EHR module.
+
+Indexes are created separately from the tables so that they can be
+built once after a bulk load.
+"""
+import sqlite3
+from typing import Iterable, Sequence
+from ehr_dates import epoch_us_column
+
+MIGRATION_CHUNK_SIZE = 10_000
+
+# Columns read from the lab and patient files, in table order
+LAB_COLUMNS = (
+    "PatientID",
+    "AdmissionID",
+    "LabName",
+    "LabValue",
+    "LabUnits",
+    "LabDateTime",
+)
+PATIENT_COLUMNS = (
+    "PatientID",
+    "PatientGender",
+    "PatientDateOfBirth",
+    "PatientRace",
+    "PatientMaritalStatus",
+    "PatientLanguage",
+    "PatientPopulationPercentageBelowPoverty",
+)
+DEMOGRAPHIC_COLUMNS = PATIENT_COLUMNS[1:2] + PATIENT_COLUMNS[3:]
+NUMERIC_DEMOGRAPHICS = ("PatientPopulationPercentageBelowPoverty",)
+
+# Version of the typed schema, stored as PRAGMA user_version
+SCHEMA_VERSION = 2
+
+# Patients are referred to by an integer PatientKey, which labs loaded
+# before their patient register with empty demographics. PatientInFile
+# is set once the patient file has a row for the patient
+CREATE_PATIENTS = """CREATE TABLE IF NOT EXISTS patients
+                (PatientKey INTEGER PRIMARY KEY,
+                PatientID TEXT NOT NULL UNIQUE,
+                PatientGender TEXT,
+                PatientDateOfBirth INTEGER,
+                PatientRace TEXT,
+                PatientMaritalStatus TEXT,
+                PatientLanguage TEXT,
+                PatientPopulationPercentageBelowPoverty REAL,
+                PatientInFile INTEGER NOT NULL DEFAULT 0)"""
+
+CREATE_LAB_NAMES = """CREATE TABLE IF NOT EXISTS lab_names
+                (LabNameKey INTEGER PRIMARY KEY,
+                LabName TEXT NOT NULL UNIQUE)"""
+
+CREATE_LAB_UNITS = """CREATE TABLE IF NOT EXISTS lab_units
+                (LabUnitsKey INTEGER PRIMARY KEY,
+                LabUnits TEXT NOT NULL UNIQUE)"""
+
+# Timestamps are INTEGER microseconds since the epoch
+CREATE_LABS = """CREATE TABLE IF NOT EXISTS labs
+                (LabID INTEGER PRIMARY KEY,
+                PatientKey INTEGER NOT NULL REFERENCES patients,
+                AdmissionID INTEGER,
+                LabNameKey INTEGER NOT NULL REFERENCES lab_names,
+                LabValue REAL,
+                LabUnitsKey INTEGER NOT NULL REFERENCES lab_units,
+                LabDateTime INTEGER)"""
+
+# Files loaded into the database with the hash of their first ByteOffset
+# bytes, which is where the next incremental load resumes
+CREATE_INGESTED_FILES = """CREATE TABLE IF NOT EXISTS ingested_files
+                (Path VARCHAR PRIMARY KEY,
+                ByteOffset INTEGER,
+                ContentHash VARCHAR)"""
+
+LAB_INDEXES = (
+    """CREATE INDEX IF NOT EXISTS labs_patient_key_lab_date_time
+        ON labs (PatientKey, LabDateTime)""",
+    # Covers is_sick, which reads the extreme LabValue of one group
+    """CREATE INDEX IF NOT EXISTS labs_lab_name_key_patient_key
+        ON labs (LabNameKey, PatientKey, LabValue)""",
+)
+
+# Patients registered by labs that the patient file never listed are
+# left out of the patient-level results
+KNOWN_PATIENT = "PatientInFile=1"
+REGISTER_PATIENT = "INSERT OR IGNORE INTO patients (PatientID) VALUES (?)"
+REGISTER_LAB_NAME = "INSERT OR IGNORE INTO lab_names (LabName) VALUES (?)"
+REGISTER_LAB_UNITS = "INSERT OR IGNORE INTO lab_units (LabUnits) VALUES (?)"
+# Labs are inserted with the LabNameKey and LabUnitsKey of their strings
+INSERT_LAB = """INSERT INTO labs VALUES (
+                ?,
+                (SELECT PatientKey FROM patients WHERE PatientID=?),
+                ?,
+                ?,
+                ?,
+                ?,
+                ?)"""
+UPSERT_PATIENT = """INSERT INTO patients (PatientID,
+                    PatientGender,
+                    PatientDateOfBirth,
+                    PatientRace,
+                    PatientMaritalStatus,
+                    PatientLanguage,
+                    PatientPopulationPercentageBelowPoverty,
+                    PatientInFile)
+    VALUES (?, ?, ?, ?, ?, ?, ?, 1)
+    ON CONFLICT (PatientID) DO UPDATE SET
+        PatientGender=excluded.PatientGender,
+        PatientDateOfBirth=excluded.PatientDateOfBirth,
+        PatientRace=excluded.PatientRace,
+        PatientMaritalStatus=excluded.PatientMaritalStatus,
+        PatientLanguage=excluded.PatientLanguage,
+        PatientPopulationPercentageBelowPoverty=
+            excluded.PatientPopulationPercentageBelowPoverty,
+        PatientInFile=1"""
+UPSERT_INGESTED_FILE = """INSERT OR REPLACE INTO ingested_files
+    VALUES (?, ?, ?)"""
+SELECT_INGESTED_FILE = """SELECT ByteOffset, ContentHash
+            FROM ingested_files
+            WHERE Path=?"""
+SELECT_INGESTED_CONTENT = """SELECT Path
+            FROM ingested_files
+            WHERE ByteOffset=? AND ContentHash=?"""
+SELECT_NEXT_LAB_ID = """SELECT COALESCE(MAX(LabID) + 1, 0)
+            FROM labs"""
+
+SELECT_LAB_NAME = """SELECT LabName
+            FROM labs
+            JOIN lab_names USING (LabNameKey)
+            WHERE LabID=?"""
+SELECT_LAB_VALUE = """SELECT LabValue
+            FROM labs
+            WHERE LabID=?"""
+SELECT_LAB_UNITS = """SELECT LabUnits
+            FROM labs
+            JOIN lab_units USING (LabUnitsKey)
+            WHERE LabID=?"""
+SELECT_LAB_DATE_TIME = """SELECT LabDateTime
+            FROM labs
+            WHERE LabID=?"""
+SELECT_BIRTH_DATE = f"""SELECT PatientDateOfBirth
+            FROM patients
+            WHERE PatientID=? AND {KNOWN_PATIENT}"""
+SELECT_FIRST_LAB_DATE = """SELECT MIN(LabDateTime)
+            FROM labs
+            WHERE PatientKey=(
+                SELECT PatientKey FROM patients WHERE PatientID=?)"""
+SELECT_PATIENT_LAB_IDS = """SELECT LabID
+            FROM labs
+            WHERE PatientKey=(
+                SELECT PatientKey FROM patients WHERE PatientID=?)
+            ORDER BY LabID"""
+SELECT_PATIENT_HAS_LABS = """SELECT EXISTS (SELECT 1
+            FROM labs
+            WHERE PatientKey=(
+                SELECT PatientKey FROM patients WHERE PatientID=?))"""
+SELECT_PATIENT_LAB_NAMES = """SELECT DISTINCT LabName
+            FROM labs
+            JOIN lab_names USING (LabNameKey)
+            WHERE PatientKey=(
+                SELECT PatientKey FROM patients WHERE PatientID=?)
+            ORDER BY LabName"""
+COUNT_LABS = "SELECT COUNT(*) FROM labs"
+SELECT_LAB_CODES = """SELECT
+                PatientID,
+                LabID,
+                LabNameKey,
+                LabValue,
+                LabUnitsKey,
+                LabDateTime
+            FROM labs
+            JOIN patients USING (PatientKey)"""
+SELECT_LAB_NAME_KEYS = """SELECT LabNameKey, LabName
+            FROM lab_names
+            ORDER BY LabNameKey"""
+SELECT_LAB_UNITS_KEYS = """SELECT LabUnitsKey, LabUnits
+            FROM lab_units
+            ORDER BY LabUnitsKey"""
+SELECT_COHORT_COLUMNS = f"""SELECT
+                PatientID,
+                PatientDateOfBirth,
+                (SELECT MIN(LabDateTime)
+                FROM labs
+                WHERE labs.PatientKey=patients.PatientKey),
+                {', '.join(DEMOGRAPHIC_COLUMNS)}
+            FROM patients
+            WHERE {KNOWN_PATIENT}
+            ORDER BY PatientKey"""
+# Whole tables in load order, as read back by exports
+SELECT_EXPORT_LABS = f"""SELECT {', '.join(LAB_COLUMNS)}, LabID
+            FROM labs
+            JOIN patients USING (PatientKey)
+            JOIN lab_names USING (LabNameKey)
+            JOIN lab_units USING (LabUnitsKey)
+            ORDER BY LabID"""
+SELECT_EXPORT_PATIENTS = f"""SELECT {', '.join(PATIENT_COLUMNS)}
+            FROM patients
+            WHERE {KNOWN_PATIENT}
+            ORDER BY PatientKey"""
+# Subquery finding the key of the LabName parameter
+LAB_NAME_KEY = "(SELECT LabNameKey FROM lab_names WHERE LabName=?)"
+
+# Aggregates that answer is_sick, keyed by the supported operators
+LAB_AGGREGATES = {"<": "MIN", ">": "MAX"}
+
+
+def check_operator(operator: str) -> None:
+    """Raise an error for an unsupported is_sick operator."""
+    if operator not in LAB_AGGREGATES:
+        raise ValueError(f"Unsupported operator: {operator!r}")
+
+
+def patient_is_sick(operator: str) -> str:
+    """Build the subquery comparing the extreme lab of a patient row."""
+    aggregate = LAB_AGGREGATES[operator]
+    return f"""(SELECT COALESCE({aggregate}(LabValue) {operator} ?, 0)
+                FROM labs
+                WHERE LabNameKey={LAB_NAME_KEY}
+                    AND PatientKey=patients.PatientKey)"""
+
+
+def select_is_sick(operator: str) -> str:
+    """
+    Build the query comparing a patient's extreme lab to a value.
+
+    It returns no row for an unknown patient.
+    """
+    return f"""SELECT {patient_is_sick(operator)}
+            FROM patients
+            WHERE PatientID=? AND {KNOWN_PATIENT}"""
+
+
+def select_cohort_is_sick(operator: str) -> str:
+    """Build the query comparing every patient's extreme lab to a value."""
+    aggregate = LAB_AGGREGATES[operator]
+    return f"""SELECT PatientID, COALESCE(extreme {operator} ?, 0)
+            FROM patients
+            LEFT JOIN (
+                SELECT PatientKey, {aggregate}(LabValue) AS extreme
+                FROM labs
+                WHERE LabNameKey={LAB_NAME_KEY}
+                GROUP BY PatientKey
+            ) USING (PatientKey)
+            WHERE {KNOWN_PATIENT}"""
+
+
+def select_patient_labs(lab_name: bool, start: bool, end: bool) -> str:
+    """
+    Build the query for a patient's LabIDs in PatientLabIndex order.
+
+    The parameters are the PatientID, then the LabName, the first and
+    the last LabDateTime for the terms that are set.
+    """
+    terms = ["PatientKey=(SELECT PatientKey FROM patients WHERE PatientID=?)"]
+    if lab_name:
+        terms.append(f"LabNameKey={LAB_NAME_KEY}")
+    if start:
+        terms.append("LabDateTime>=?")
+    if end:
+        terms.append("LabDateTime<=?")
+    return f"""SELECT LabID
+            FROM labs
+            JOIN lab_names USING (LabNameKey)
+            WHERE {' AND '.join(terms)}
+            ORDER BY LabName, LabDateTime, LabID"""
+
+
+def select_labs_by_id(count: int) -> str:
+    """Build a query for the fields of count labs by LabID."""
+    placeholders = ", ".join("?" * count)
+    return f"""SELECT LabID, LabName, LabValue, LabUnits, LabDateTime
+            FROM labs
+            JOIN lab_names USING (LabNameKey)
+            JOIN lab_units USING (LabUnitsKey)
+            WHERE LabID IN ({placeholders})"""
+
+
+def select_birth_dates(count: int) -> str:
+    """Build a query for the birth dates of count patients by PatientID."""
+    placeholders = ", ".join("?" * count)
+    return f"""SELECT PatientID, PatientDateOfBirth
+            FROM patients
+            WHERE PatientID IN ({placeholders}) AND {KNOWN_PATIENT}"""
+
+
+def select_demographics(count: int) -> str:
+    """Build a query for the demographics of count patients by PatientID."""
+    placeholders = ", ".join("?" * count)
+    return f"""SELECT PatientID, {', '.join(DEMOGRAPHIC_COLUMNS)}
+            FROM patients
+            WHERE PatientID IN ({placeholders}) AND {KNOWN_PATIENT}"""
+
+
+def select_first_lab_dates(count: int) -> str:
+    """Build a query for the first lab dates of count patients."""
+    placeholders = ", ".join("?" * count)
+    return f"""SELECT PatientID, MIN(LabDateTime)
+            FROM patients
+            JOIN labs USING (PatientKey)
+            WHERE PatientID IN ({placeholders})
+            GROUP BY PatientKey"""
+
+
+def select_patients_is_sick(operator: str, count: int) -> str:
+    """
+    Build the is_sick query for count patients by PatientID.
+
+    Unknown patients are left out of the results.
+    """
+    placeholders = ", ".join("?" * count)
+    return f"""SELECT PatientID, {patient_is_sick(operator)}
+            FROM patients
+            WHERE PatientID IN ({placeholders}) AND {KNOWN_PATIENT}"""
+
+
+def insert_labs(cursor: sqlite3.Cursor, rows: Sequence[Sequence[str]]) -> None:
+    """
+    Insert lab file rows, in LAB_COLUMNS order followed by the LabID.
+
+    Unknown patients, lab names and units are registered first, lab
+    names and units are stored as their keys, LabValue is converted to a
+    float, NULL when blank, and LabDateTime to microseconds since the
+    epoch.
+    """
+    cursor.executemany(
+        REGISTER_PATIENT, [(key,) for key in dict.fromkeys(r[0] for r in rows)]
+    )
+    name_keys = register_keys(
+        cursor, REGISTER_LAB_NAME, SELECT_LAB_NAME_KEYS, (r[2] for r in rows)
+    )
+    unit_keys = register_keys(
+        cursor, REGISTER_LAB_UNITS, SELECT_LAB_UNITS_KEYS, (r[4] for r in rows)
+    )
+    timestamps = epoch_us_column(row[5] for row in rows)
+    cursor.executemany(
+        INSERT_LAB,
+        [
+            (
+                row[6],
+                row[0],
+                row[1],
+                name_keys[row[2]],
+                optional_float(row[3]),
+                unit_keys[row[4]],
+                timestamp,
+            )
+            for row, timestamp in zip(rows, timestamps)
+        ],
+    )
+
+
+def register_keys(
+    cursor: sqlite3.Cursor, register: str, select: str, values: Iterable[str]
+) -> dict[str, int]:
+    """Register strings in a lookup table and map every string to its key."""
+    cursor.executemany(register, [(key,) for key in dict.fromkeys(values)])
+    return {value: key for key, value in cursor.execute(select)}
+
+
+def optional_text(value: str | None) -> str | None:
+    """Convert a file value for a TEXT column, with None for a blank one."""
+    return value or None
+
+
+def optional_float(value: str | float | None) -> float | None:
+    """Convert a file value for a REAL column, with None for a blank one."""
+    if value is None or value == "":
+        return None
+    return float(value)
+
+
+def upsert_patients(
+    cursor: sqlite3.Cursor, rows: Sequence[Sequence[str]]
+) -> None:
+    """
+    Insert or update patient file rows in PATIENT_COLUMNS order.
+
+    Blank values are stored as NULL and the poverty percentage as a float.
+    """
+    birth_dates = epoch_us_column(row[2] for row in rows)
+    cursor.executemany(
+        UPSERT_PATIENT,
+        [
+            (
+                row[0],
+                optional_text(row[1]),
+                birth_date,
+                *(optional_text(value) for value in row[3:6]),
+                optional_float(row[6]),
+            )
+            for row, birth_date in zip(rows, birth_dates)
+        ],
+    )
+
+
+# Queries run by the accessors, keyed by accessor, with sample parameters
+ACCESSOR_QUERIES: dict[str, tuple[str, tuple[str, ...]]] = {
+    "Lab.LabName": (SELECT_LAB_NAME, ("0",)),
+    "Lab.LabValue": (SELECT_LAB_VALUE, ("0",)),
+    "Lab.LabUnits": (SELECT_LAB_UNITS, ("0",)),
+    "Lab.LabDateTime": (SELECT_LAB_DATE_TIME, ("0",)),
+    "Patient.age": (SELECT_BIRTH_DATE, ("",)),
+    "Patient.initial_age": (SELECT_FIRST_LAB_DATE, ("",)),
+    "Patient.is_sick": (select_is_sick("<"), ("0", "", "")),
+    "SQLiteBackend.patient": (SELECT_PATIENT_LAB_IDS, ("",)),
+    "Patient.patient_labs": (
+        select_patient_labs(True, True, True),
+        ("", "", "0", "0"),
+    ),
+}
+
+
+TABLES = ("patients", "lab_names", "lab_units", "labs", "ingested_files")
+# Tables that accessor queries must never scan
+SCANNED_TABLES = ("labs", "patients")
+
+
+def create_tables(cursor: sqlite3.Cursor) -> None:
+    """Drop and recreate the patients and labs tables."""
+    for table in TABLES:
+        cursor.execute(f"DROP TABLE IF EXISTS {table}")
+    create_missing_tables(cursor)
+
+
+def create_missing_tables(cursor: sqlite3.Cursor) -> None:
+    """Create the tables that do not exist yet, keeping existing data."""
+    for statement in (
+        CREATE_PATIENTS,
+        CREATE_LAB_NAMES,
+        CREATE_LAB_UNITS,
+        CREATE_LABS,
+        CREATE_INGESTED_FILES,
+    ):
+        cursor.execute(statement)
+    cursor.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+
+
+def table_columns(cursor: sqlite3.Cursor, table: str) -> list[str]:
+    """List the columns of a table, which are none if it is missing."""
+    return [row[1] for row in cursor.execute(f"PRAGMA table_info({table})")]
+
+
+def legacy_tables(cursor: sqlite3.Cursor) -> list[str]:
+    """List the tables still in the older VARCHAR schema."""
+    return [
+        table
+        for table, column in (("patients", "PatientID"), ("labs", "LabName"))
+        if column in (columns := table_columns(cursor, table))
+        and "PatientKey" not in columns
+    ]
+
+
+def migrate(connection: sqlite3.Connection) -> bool:
+    """
+    Convert the VARCHAR tables of an older database to the typed schema.
+
+    Rows are converted like a fresh load and keep their LabIDs. Return
+    whether anything was migrated.
+    """
+    cursor = connection.cursor()
+    if not legacy_tables(cursor):
+        return False
+    connection.commit()
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        # Another connection may have migrated the database meanwhile
+        legacy = legacy_tables(cursor)
+        if not legacy:
+            connection.rollback()
+            return False
+        for table in legacy:
+            cursor.execute(f"ALTER TABLE {table} RENAME TO legacy_{table}")
+        create_missing_tables(cursor)
+        writer = connection.cursor()
+        if "patients" in legacy:
+            rows = cursor.execute(
+                f"SELECT {', '.join(PATIENT_COLUMNS)} FROM legacy_patients"
+            )
+            while chunk := rows.fetchmany(MIGRATION_CHUNK_SIZE):
+                upsert_patients(writer, chunk)
+        if "labs" in legacy:
+            rows = cursor.execute(
+                f"""SELECT {', '.join(LAB_COLUMNS)}, LabID
+                FROM legacy_labs
+                ORDER BY rowid"""
+            )
+            while chunk := rows.fetchmany(MIGRATION_CHUNK_SIZE):
+                insert_labs(writer, chunk)
+        for table in legacy:
+            cursor.execute(f"DROP TABLE legacy_{table}")
+        create_indexes(cursor)
+    except BaseException:
+        connection.rollback()
+        raise
+    connection.commit()
+    return True
+
+
+def create_indexes(cursor: sqlite3.Cursor) -> None:
+    """Build the secondary indexes on the labs table."""
+    for statement in LAB_INDEXES:
+        cursor.execute(statement)
+
+
+def explain_query_plan(
+    connection: sqlite3.Connection, sql: str, parameters: tuple[str, ...]
+) -> list[str]:
+    """Return the detail of each step of the query plan."""
+    plan = connection.execute(f"EXPLAIN QUERY PLAN {sql}", parameters)
+    return [str(row[-1]) for row in plan.fetchall()]
+
+
+def scans_table(step: str) -> bool:
+    """
+    Check whether a query plan step reads all of the labs or patients.
+
+    Scanning a covering index still reads every row of the table, so
+    only SEARCH steps using an index count as indexed lookups.
+    """
+    words = step.split()
+    if words[:1] == ["SEARCH"]:
+        return "USING" not in words
+    if words[:1] != ["SCAN"] or len(words) < 2:
+        return False
+    # Older SQLite versions write "SCAN TABLE labs"
+    table = words[2] if words[1] == "TABLE" and len(words) > 2 else words[1]
+    return table in SCANNED_TABLES
+
+
+def full_table_scans(connection: sqlite3.Connection) -> dict[str, list[str]]:
+    """
+    Find the accessor queries that scan a whole table.
+
+    Return the offending query plans keyed by accessor, so an empty
+    dictionary means every accessor lookup searches an index.
+    """
+    scans = {}
+    for accessor, (sql, parameters) in ACCESSOR_QUERIES.items():
+        plan = explain_query_plan(connection, sql, parameters)
+        if any(scans_table(step) for step in plan):
+            scans[accessor] = plan
+    return scans
@@ -0,0 +1,119 @@
+"""
+This module saves a cohort and its lab store as a binary snapshot.
+
+A snapshot is a directory of .npy column files plus a JSON header.
+Opening it memory-maps the columns read-only, so it takes milliseconds
+whatever the size of the data, and processes opening the same snapshot
+share the same pages.
+"""
+import json
+import os
+import tempfile
+from typing import Any
+import numpy as np
+import numpy.typing as npt
+from ehr_cohort import EHRCohort
+from lab_store import LabStore
+
+SNAPSHOT_VERSION = 1
+HEADER_FILE = "header.json"
+STORE_COLUMNS = (
+    "offsets",
+    "lab_ids",
+    "name_codes",
+    "unit_codes",
+    "values",
+    "timestamps",
+)
+
+
+def write_snapshot(directory: str, cohort: EHRCohort) -> None:
+    """
+    Write a cohort backed by a lab store to a snapshot directory.
+
+    Cohorts read by EHRCohort.from_database have no store; build one with
+    EHRCohort.from_store(LabStore.from_database(), ...) to save it.
+
+    Every file is written to a staging directory and renamed into place,
+    so processes that have the previous snapshot memory-mapped keep
+    reading its files. The header is renamed last, so a directory
+    without one holds an incomplete snapshot.
+    """
+    store = cohort.store
+    if store is None:
+        raise ValueError(
+            "Only cohorts backed by a LabStore can be saved, "
+            "not cohorts read with EHRCohort.from_database"
+        )
+    os.makedirs(directory, exist_ok=True)
+    header_path = os.path.join(directory, HEADER_FILE)
+    if os.path.exists(header_path):
+        os.remove(header_path)
+
+    columns: dict[str, npt.NDArray[np.generic]] = {
+        "patient_ids": np.asarray(cohort.patient_ids, dtype=np.str_),
+        "birth_dates": cohort.birth_dates,
+        "first_lab_dates": cohort.first_lab_dates,
+        "store_patient_ids": np.asarray(store.patient_ids, dtype=np.str_),
+    }
+    for name in STORE_COLUMNS:
+        columns[name] = getattr(store, name)
+    demographics = cohort.demographics or {}
+    for name, column in demographics.items():
+        columns[name] = column
+
+    with tempfile.TemporaryDirectory(dir=directory) as staging:
+        for name, column in columns.items():
+            filename = f"{name}.npy"
+            np.save(os.path.join(staging, filename), column)
+            os.replace(
+                os.path.join(staging, filename),
+                os.path.join(directory, filename),
+            )
+        staged_header = os.path.join(staging, HEADER_FILE)
+        with open(staged_header, "w") as header:
+            json.dump(
+                {
+                    "version": SNAPSHOT_VERSION,
+                    "patients": len(cohort),
+                    "labs": len(store),
+                    "names": store.names,
+                    "units": store.units,
+                    "demographics": list(demographics),
+                },
+                header,
+            )
+        os.replace(staged_header, header_path)
+
+
+def open_snapshot(directory: str) -> EHRCohort:
+    """Memory-map a snapshot as a cohort backed by a lab store."""
+    with open(os.path.join(directory, HEADER_FILE)) as header_file:
+        header = json.load(header_file)
+    if header["version"] != SNAPSHOT_VERSION:
+        raise ValueError(f"Unsupported snapshot version {header['version']}")
+
+    def column(name: str) -> Any:
+        return np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r")
+
+    store = LabStore(
+        column("store_patient_ids"),
+        column("offsets"),
+        column("lab_ids"),
+        column("name_codes"),
+        header["names"],
+        column("unit_codes"),
+        header["units"],
+        column("values"),
+        column("timestamps"),
+    )
+    demographics = {
+        name: column(name) for name in header.get("demographics", [])
+    }
+    return EHRCohort(
+        column("patient_ids"),
+        column("birth_dates"),
+        column("first_lab_dates"),
+        store,
+        demographics or None,
+    )
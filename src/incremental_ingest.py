@@ -0,0 +1,157 @@
+"""
+This module appends new EHR file rows to an existing database.
+
+Every loaded file is recorded with the number of bytes read and a hash
+of those bytes. A file that only grew since it was recorded is read from
+where the last load stopped, a file whose content was already loaded is
+skipped, and anything else is read in full, except a lab file whose
+loaded bytes changed, which would append its labs twice.
+"""
+import hashlib
+import os
+import sqlite3
+from typing import NamedTuple
+import ehr_cache
+from ehr_connection import get_manager
+import ehr_metrics
+import ehr_schema as schema
+from parallel_ingest import read_byte_ranges
+
+HASH_BLOCK_BYTES = 1024 * 1024
+
+
+class FileState(NamedTuple):
+    """Size and hashes of a file."""
+
+    size: int
+    content_hash: str
+    prefix_hash: str | None
+
+
+class IngestReport(NamedTuple):
+    """Summary of an incremental load."""
+
+    patients: int
+    labs: int
+    skipped: list[str]
+
+
+def hash_file(filename: str, prefix_bytes: int | None = None) -> FileState:
+    """
+    Hash a file in one pass.
+
+    When prefix_bytes is given, the hash of the first prefix_bytes bytes
+    is returned too, or None if the file is shorter than that.
+    """
+    content_hash = hashlib.sha256()
+    prefix_hash = None
+    with open(filename, "rb") as file:
+        if prefix_bytes is not None:
+            remaining = prefix_bytes
+            while remaining and (
+                block := file.read(min(remaining, HASH_BLOCK_BYTES))
+            ):
+                content_hash.update(block)
+                remaining -= len(block)
+            if not remaining:
+                prefix_hash = content_hash.hexdigest()
+        while block := file.read(HASH_BLOCK_BYTES):
+            content_hash.update(block)
+        size = file.tell()
+    return FileState(size, content_hash.hexdigest(), prefix_hash)
+
+
+def resume_offset(
+    cursor: sqlite3.Cursor, filename: str, append_only: bool = False
+) -> tuple[int | None, FileState]:
+    """
+    Find where to start reading a file.
+
+    Return 0 to read the whole file, the offset of the first new byte of
+    a file that grew, or None to skip a file that was already loaded.
+    With append_only, a recorded file whose loaded bytes changed raises
+    ValueError instead of being read in full.
+    """
+    path = os.path.abspath(filename)
+    recorded = cursor.execute(schema.SELECT_INGESTED_FILE, (path,)).fetchone()
+    if recorded is not None:
+        offset, recorded_hash = recorded
+        state = hash_file(filename, offset)
+        if state.prefix_hash == recorded_hash:
+            return (offset if offset < state.size else None), state
+        if append_only:
+            raise ValueError(
+                f"{filename} changed since it was loaded, not only by "
+                "appending rows; reload it with parse_data"
+            )
+    else:
+        state = hash_file(filename)
+    duplicate = cursor.execute(
+        schema.SELECT_INGESTED_CONTENT, (state.size, state.content_hash)
+    ).fetchone()
+    return (None if duplicate else 0), state
+
+
+def record_ingested(
+    cursor: sqlite3.Cursor, filename: str, state: FileState | None = None
+) -> None:
+    """Record that a file was loaded up to its current size."""
+    if state is None:
+        state = hash_file(filename)
+    cursor.execute(
+        schema.UPSERT_INGESTED_FILE,
+        (os.path.abspath(filename), state.size, state.content_hash),
+    )
+
+
+@ehr_metrics.accessor("ingest_incremental")
+def ingest_incremental(
+    patient_filename: str, lab_filename: str
+) -> IngestReport:
+    """
+    Append new rows from the files to the database in one transaction.
+
+    New labs are numbered after the existing ones, so existing LabIDs
+    never change, and patients are upserted by PatientID so changed
+    demographics replace the stored ones. A lab file changed other than
+    by appending raises ValueError and nothing is loaded. Tables and
+    indexes are created if they are missing and are otherwise updated in
+    place.
+    """
+    counts = {patient_filename: 0, lab_filename: 0}
+    skipped = []
+    with get_manager().transaction() as cursor:
+        schema.create_missing_tables(cursor)
+        schema.create_indexes(cursor)
+        next_lab_id = cursor.execute(schema.SELECT_NEXT_LAB_ID).fetchone()[0]
+        for filename, columns in (
+            (lab_filename, schema.LAB_COLUMNS),
+            (patient_filename, schema.PATIENT_COLUMNS),
+        ):
+            offset, state = resume_offset(
+                cursor, filename, append_only=filename == lab_filename
+            )
+            if offset is None:
+                skipped.append(filename)
+                continue
+            for chunk in read_byte_ranges(
+                filename, columns, offset, state.size
+            ):
+                if filename == lab_filename:
+                    schema.insert_labs(
+                        cursor,
+                        [
+                            (*row, str(lab_id))
+                            for lab_id, row in enumerate(chunk, next_lab_id)
+                        ],
+                    )
+                    next_lab_id += len(chunk)
+                else:
+                    schema.upsert_patients(cursor, chunk)
+                counts[filename] += len(chunk)
+            record_ingested(cursor, filename, state)
+    if any(counts.values()):
+        ehr_cache.invalidate()
+    return IngestReport(
+        counts[patient_filename], counts[lab_filename], skipped
+    )
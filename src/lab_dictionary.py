@@ -0,0 +1,79 @@
+"""
+This module interns lab names and units as small integer codes.
+
+A lab table has a few hundred distinct names and units across many
+rows, so each distinct string is kept once and rows hold its code. The
+codes of a dictionary loaded from a database follow the order of the
+lab_names and lab_units keys.
+"""
+import sqlite3
+import sys
+from typing import Iterable
+import numpy as np
+import numpy.typing as npt
+
+
+class Categories:
+    """Create the dictionary of the distinct strings of one column."""
+
+    def __init__(self, values: Iterable[str] = ()) -> None:
+        """Initialize the dictionary, coding values in order."""
+        self.values: list[str] = []
+        # Database keys of the codes, for dictionaries of a lookup table
+        self.keys: list[int] = []
+        self._codes: dict[str, int] = {}
+        for value in values:
+            self.code(value)
+
+    def __len__(self) -> int:
+        """Count the distinct strings."""
+        return len(self.values)
+
+    def __contains__(self, value: object) -> bool:
+        """Check whether a string has a code."""
+        return value in self._codes
+
+    def code(self, value: str) -> int:
+        """Find the code of a string, adding it if it is new."""
+        code = self._codes.get(value)
+        if code is None:
+            code = self._codes[value] = len(self.values)
+            self.values.append(sys.intern(value))
+        return code
+
+    def find(self, value: str) -> int:
+        """Find the code of a string, or -1 if it has none."""
+        return self._codes.get(value, -1)
+
+    def intern(self, value: str) -> str:
+        """Return the one copy of a string kept by the dictionary."""
+        return self.values[self.code(value)]
+
+    def encode(self, values: Iterable[str]) -> npt.NDArray[np.int32]:
+        """Replace strings by their codes, adding new ones."""
+        return np.fromiter((self.code(v) for v in values), dtype=np.int32)
+
+    def decode(self, codes: Iterable[int]) -> list[str]:
+        """Replace codes by their strings."""
+        return [self.values[code] for code in codes]
+
+
+def from_table(cursor: sqlite3.Cursor, sql: str) -> Categories:
+    """
+    Load a dictionary from the (key, string) rows of a lookup table query.
+
+    Codes follow the order of the rows, and the dictionary keeps the
+    database key of each code in keys.
+    """
+    rows = cursor.execute(sql).fetchall()
+    categories = Categories(row[1] for row in rows)
+    categories.keys = [row[0] for row in rows]
+    return categories
+
+
+def key_codes(categories: Categories) -> npt.NDArray[np.int32]:
+    """Map each database key of a loaded dictionary to its code."""
+    keys = categories.keys
+    codes = np.full(max(keys, default=-1) + 1, -1, dtype=np.int32)
+    codes[keys] = np.arange(len(keys), dtype=np.int32)
+    return codes
@@ -0,0 +1,196 @@
+"""
+This module computes per-patient lab trends.
+
+LabSeries sorts the labs of a columnar store by patient, lab name and
+date once, so latest values, deltas and rolling means are vectorized
+passes over contiguous groups. LabTrendStream computes the same trends
+one lab at a time while the labs are being loaded.
+"""
+from bisect import bisect_right
+from datetime import datetime, timedelta
+from typing import Callable, NamedTuple, Sequence
+import numpy as np
+import numpy.typing as npt
+from ehr_dates import parse_datetime
+from lab_store import LabStore
+
+US_PER_DAY = 86_400_000_000
+
+
+class LabSeries:
+    """Create the date-ordered lab series of every patient."""
+
+    def __init__(self, store: LabStore, lab_name: str | None = None) -> None:
+        """
+        Sort the labs of the store, optionally only those named lab_name.
+
+        Every array is aligned with the sorted labs, which are grouped by
+        patient and lab name and ordered by date within each group. Labs
+        with the same date keep their store order.
+        """
+        patient_positions = np.repeat(
+            np.arange(len(store.patient_ids)), np.diff(store.offsets)
+        )
+        if lab_name is None:
+            rows = np.arange(len(store))
+        else:
+            (rows,) = np.nonzero(store.name_codes == store.name_code(lab_name))
+        order = np.lexsort(
+            (
+                store.timestamps[rows],
+                store.name_codes[rows],
+                patient_positions[rows],
+            )
+        )
+        self.store = store
+        self.rows = rows[order]
+        self.patient_positions = patient_positions[self.rows]
+        self.name_codes = store.name_codes[self.rows]
+        self.timestamps = store.timestamps[self.rows]
+        self.values = store.values[self.rows]
+        # Whether each lab starts a new patient and lab name group
+        self.new_group = np.ones(len(self.rows), dtype=np.bool_)
+        self.new_group[1:] = (np.diff(self.patient_positions) != 0) | (
+            np.diff(self.name_codes) != 0
+        )
+
+    def __len__(self) -> int:
+        """Count the labs in the series."""
+        return len(self.rows)
+
+    def latest_rows(self) -> npt.NDArray[np.int64]:
+        """Find the position of the latest lab of every group."""
+        (starts,) = np.nonzero(self.new_group)
+        ends: npt.NDArray[np.int64] = np.append(starts[1:], len(self)) - 1
+        return ends
+
+    def latest_values(self) -> dict[str, dict[str, float]]:
+        """Key the latest value of every lab by PatientID and LabName."""
+        latest: dict[str, dict[str, float]] = {}
+        for row in self.latest_rows().tolist():
+            patient_id = str(
+                self.store.patient_ids[self.patient_positions[row]]
+            )
+            lab_name = self.store.names[self.name_codes[row]]
+            latest.setdefault(patient_id, {})[lab_name] = float(
+                self.values[row]
+            )
+        return latest
+
+    def deltas(self) -> npt.NDArray[np.float64]:
+        """Subtract each lab's previous value, NaN for the first of a group."""
+        deltas = np.full(len(self), np.nan)
+        deltas[1:] = np.diff(self.values)
+        deltas[self.new_group] = np.nan
+        return deltas
+
+    def window_starts(self, days: float) -> npt.NDArray[np.int64]:
+        """
+        Find where the window of days ending at each lab starts.
+
+        The window of a lab holds the labs of its group dated after
+        days before it, up to and including the lab itself, which is
+        always in its window.
+        """
+        groups = np.cumsum(self.new_group)
+        window_us = int(days * US_PER_DAY)
+        # Merge the window bounds into the sorted labs, bounds sorting
+        # after labs of the same group and date, and count the labs
+        # before each bound
+        keys = np.concatenate([self.timestamps, self.timestamps - window_us])
+        kinds = np.repeat(np.array([0, 1]), len(self))
+        merged = np.lexsort((kinds, keys, np.concatenate([groups, groups])))
+        is_bound = kinds[merged] == 1
+        labs_before = np.cumsum(~is_bound) - ~is_bound
+        starts = np.empty(len(self), dtype=np.int64)
+        starts[merged[is_bound] - len(self)] = labs_before[is_bound]
+        clamped: npt.NDArray[np.int64] = np.minimum(
+            starts, np.arange(len(self))
+        )
+        return clamped
+
+    def rolling_means(self, days: float) -> npt.NDArray[np.float64]:
+        """Average each lab's group over the window of days ending at it."""
+        starts = self.window_starts(days)
+        sums = np.concatenate([[0.0], np.cumsum(self.values)])
+        stops = np.arange(1, len(self) + 1)
+        means: npt.NDArray[np.float64] = (sums[stops] - sums[starts]) / (
+            stops - starts
+        )
+        return means
+
+
+class TrendUpdate(NamedTuple):
+    """Trends of one lab name for one patient after a new lab."""
+
+    patient_id: str
+    lab_name: str
+    latest_value: float
+    latest_date_time: datetime
+    delta: float | None
+    rolling_mean: float
+
+
+class LabTrendStream:
+    """Create the streaming lab trends."""
+
+    def __init__(
+        self,
+        days: float,
+        on_update: Callable[[TrendUpdate], None] | None = None,
+    ) -> None:
+        """
+        Initialize the stream with the rolling window in days.
+
+        on_update is called with the trends after every lab added.
+        """
+        self.window = timedelta(days=days)
+        self.on_update = on_update
+        self._dates: dict[tuple[str, str], list[datetime]] = {}
+        self._values: dict[tuple[str, str], list[float]] = {}
+
+    def add(
+        self,
+        patient_id: str,
+        lab_name: str,
+        date_time: datetime,
+        value: float,
+    ) -> TrendUpdate:
+        """
+        Add one lab and return the trends as of that lab.
+
+        Labs may arrive out of date order. The delta and rolling mean are
+        those of the new lab among the labs added so far.
+        """
+        key = (patient_id, lab_name)
+        dates = self._dates.setdefault(key, [])
+        values = self._values.setdefault(key, [])
+        position = bisect_right(dates, date_time)
+        dates.insert(position, date_time)
+        values.insert(position, value)
+        start = bisect_right(dates, date_time - self.window, 0, position)
+        stop = position + 1
+        window = values[start:stop]
+        update = TrendUpdate(
+            patient_id,
+            lab_name,
+            values[-1],
+            dates[-1],
+            value - values[position - 1] if position else None,
+            sum(window) / len(window),
+        )
+        if self.on_update is not None:
+            self.on_update(update)
+        return update
+
+    def add_rows(self, rows: Sequence[Sequence[str]]) -> None:
+        """Add lab file rows in LAB_COLUMNS order, as loaders pass them."""
+        for row in rows:
+            self.add(row[0], row[2], parse_datetime(row[5]), float(row[3]))
+
+    def latest_values(self) -> dict[str, dict[str, float]]:
+        """Key the latest value of every lab by PatientID and LabName."""
+        latest: dict[str, dict[str, float]] = {}
+        for (patient_id, lab_name), values in self._values.items():
+            latest.setdefault(patient_id, {})[lab_name] = values[-1]
+        return latest
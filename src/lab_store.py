@@ -0,0 +1,288 @@
+"""
+This module keeps labs in memory in columnar form.
+
+Lab names and units are coded by lab_dictionary, values are float64 and lab
+dates are int64 microseconds since the epoch. Labs are sorted by
+PatientID so each patient owns one contiguous range of rows.
+"""
+from datetime import datetime
+from functools import cached_property
+from typing import Sequence
+import numpy as np
+import numpy.typing as npt
+from ehr_connection import get_manager
+from ehr_dates import from_epoch_us, to_epoch_us
+import ehr_schema as schema
+from lab_dictionary import Categories, from_table, key_codes
+from tsv_reader import read_rows
+
+PatientIDs = Sequence[str] | npt.NDArray[np.str_]
+LAB_FILE_COLUMNS = (
+    "PatientID",
+    "LabName",
+    "LabValue",
+    "LabUnits",
+    "LabDateTime",
+)
+
+
+class LabStore:
+    """Create the columnar lab store."""
+
+    def __init__(
+        self,
+        patient_ids: PatientIDs,
+        offsets: npt.NDArray[np.int64],
+        lab_ids: npt.NDArray[np.int64],
+        name_codes: npt.NDArray[np.int32],
+        names: list[str],
+        unit_codes: npt.NDArray[np.int32],
+        units: list[str],
+        values: npt.NDArray[np.float64],
+        timestamps: npt.NDArray[np.int64],
+    ) -> None:
+        """
+        Initialize the store from its columns.
+
+        The labs of patient_ids[i] are the rows offsets[i] to
+        offsets[i + 1]. names and units map codes back to strings.
+        """
+        self.patient_ids = patient_ids
+        self.offsets = offsets
+        self.lab_ids = lab_ids
+        self.name_codes = name_codes
+        self.names = names
+        self.unit_codes = unit_codes
+        self.units = units
+        self.values = values
+        self.timestamps = timestamps
+        self._name_lookup = {name: code for code, name in enumerate(names)}
+
+    @classmethod
+    def from_columns(
+        cls,
+        patient_ids: Sequence[str],
+        lab_ids: Sequence[int],
+        names: Sequence[str],
+        values: Sequence[str | float],
+        units: Sequence[str],
+        date_times: Sequence[str | int],
+    ) -> "LabStore":
+        """Build the store from unsorted lab columns."""
+        name_categories = Categories()
+        unit_categories = Categories()
+        return cls.from_codes(
+            patient_ids,
+            lab_ids,
+            name_categories.encode(names),
+            name_categories.values,
+            values,
+            unit_categories.encode(units),
+            unit_categories.values,
+            date_times,
+        )
+
+    @classmethod
+    def from_codes(
+        cls,
+        patient_ids: Sequence[str],
+        lab_ids: Sequence[int],
+        name_codes: npt.NDArray[np.int32],
+        names: list[str],
+        values: Sequence[str | float],
+        unit_codes: npt.NDArray[np.int32],
+        units: list[str],
+        date_times: Sequence[str | int],
+    ) -> "LabStore":
+        """Build the store from unsorted lab columns with coded strings."""
+        patient_categories = Categories()
+        patient_codes = patient_categories.encode(patient_ids)
+
+        # Sort patients by ID, keeping each patient's labs in file order
+        sorted_ids = sorted(patient_categories.values)
+        rank = np.empty(len(sorted_ids), dtype=np.int64)
+        rank[[patient_categories.find(i) for i in sorted_ids]] = np.arange(
+            len(sorted_ids)
+        )
+        patient_ranks = rank[patient_codes]
+        order = np.argsort(patient_ranks, kind="stable")
+        counts = np.bincount(patient_ranks, minlength=len(sorted_ids))
+        offsets = np.zeros(len(sorted_ids) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+
+        return cls(
+            sorted_ids,
+            offsets,
+            np.asarray(lab_ids, dtype=np.int64)[order],
+            name_codes[order],
+            names,
+            unit_codes[order],
+            units,
+            np.asarray(values, dtype=np.float64)[order],
+            to_epoch_us(date_times)[order],
+        )
+
+    @classmethod
+    def from_file(cls, lab_filename: str) -> "LabStore":
+        """Build the store from a lab file, numbering labs like parse_data."""
+        rows = list(read_rows(lab_filename, LAB_FILE_COLUMNS))
+        patient_ids, names, values, units, date_times = (
+            zip(*rows) if rows else ((), (), (), (), ())
+        )
+        return cls.from_columns(
+            patient_ids,
+            range(len(rows)),
+            names,
+            values,
+            units,
+            date_times,
+        )
+
+    @classmethod
+    def from_database(cls) -> "LabStore":
+        """
+        Build the store from the labs table.
+
+        Lab names and units are read as their keys and recoded, so no
+        string is read per lab.
+        """
+        cursor = get_manager().connection().cursor()
+        names = from_table(cursor, schema.SELECT_LAB_NAME_KEYS)
+        units = from_table(cursor, schema.SELECT_LAB_UNITS_KEYS)
+        rows = cursor.execute(schema.SELECT_LAB_CODES).fetchall()
+        patient_ids, lab_ids, name_keys, values, unit_keys, date_times = (
+            zip(*rows) if rows else ((), (), (), (), (), ())
+        )
+        return cls.from_codes(
+            patient_ids,
+            lab_ids,
+            key_codes(names)[np.asarray(name_keys, dtype=np.int64)],
+            names.values,
+            values,
+            key_codes(units)[np.asarray(unit_keys, dtype=np.int64)],
+            units.values,
+            date_times,
+        )
+
+    def __len__(self) -> int:
+        """Count the labs in the store."""
+        return len(self.values)
+
+    @cached_property
+    def _positions(self) -> dict[str, int]:
+        """Map each PatientID to its position, built on first use."""
+        return {
+            str(patient_id): i for i, patient_id in enumerate(self.patient_ids)
+        }
+
+    def patient_positions(
+        self, patient_ids: PatientIDs
+    ) -> npt.NDArray[np.int64]:
+        """Find the position of each patient, or -1 if they have no labs."""
+        store_ids = np.asarray(self.patient_ids)
+        ids = np.asarray(patient_ids)
+        if not len(store_ids):
+            return np.full(len(ids), -1, dtype=np.int64)
+        # The store is sorted by PatientID
+        positions = np.searchsorted(store_ids, ids)
+        found = positions < len(store_ids)
+        found[found] = store_ids[positions[found]] == ids[found]
+        return np.where(found, positions, -1).astype(np.int64)
+
+    def patient_range(self, patient_id: str) -> range:
+        """Find the rows holding a patient's labs."""
+        i = self._positions.get(patient_id)
+        if i is None:
+            return range(0)
+        return range(int(self.offsets[i]), int(self.offsets[i + 1]))
+
+    def name_code(self, lab_name: str) -> int:
+        """Find the code of a lab name, or -1 if no lab has that name."""
+        return self._name_lookup.get(lab_name, -1)
+
+    def date_time(self, row: int) -> datetime:
+        """Convert the timestamp of a row to a datetime."""
+        return from_epoch_us(int(self.timestamps[row]))
+
+    def lab_fields(self, row: int) -> tuple[str, float, str, datetime]:
+        """Decode the name, value, units and date of a row."""
+        return (
+            self.names[self.name_codes[row]],
+            float(self.values[row]),
+            self.units[self.unit_codes[row]],
+            self.date_time(row),
+        )
+
+    def first_lab_dates(self) -> npt.NDArray[np.datetime64]:
+        """Find the earliest lab date of every patient in the store."""
+        if not len(self):
+            return np.array([], dtype="datetime64[us]")
+        first = np.minimum.reduceat(self.timestamps, self.offsets[:-1])
+        return first.astype("datetime64[us]")
+
+    def is_sick(
+        self,
+        lab_name: str,
+        operator: str,
+        value: float,
+        positions: npt.NDArray[np.int64] | None = None,
+    ) -> npt.NDArray[np.bool_]:
+        """
+        Answer Patient.is_sick for every patient in the store.
+
+        With positions, only the labs of the patients at those positions
+        are checked, and a position of -1 answers False.
+        """
+        schema.check_operator(operator)
+        if positions is None:
+            hits = self._hits(slice(None), lab_name, operator, value)
+            if not len(self):
+                return hits
+            sick: npt.NDArray[np.bool_] = np.logical_or.reduceat(
+                hits, self.offsets[:-1]
+            )
+            return sick
+        found = positions[positions >= 0]
+        starts = self.offsets[found]
+        lengths = self.offsets[found + 1] - starts
+        # Concatenate the row ranges of the patients, numbering each
+        # row with the patient it belongs to
+        owners = np.repeat(np.arange(len(found)), lengths)
+        labs = np.arange(len(owners)) + np.repeat(
+            starts - (np.cumsum(lengths) - lengths), lengths
+        )
+        hits = self._hits(labs, lab_name, operator, value)
+        sick = np.zeros(len(positions), dtype=np.bool_)
+        sick[positions >= 0] = np.bincount(
+            owners[hits], minlength=len(found)
+        ).astype(np.bool_)
+        return sick
+
+    def _hits(
+        self,
+        labs: slice | npt.NDArray[np.int64],
+        lab_name: str,
+        operator: str,
+        value: float,
+    ) -> npt.NDArray[np.bool_]:
+        """Find which of the labs are named lab_name and compare true."""
+        matches = self.name_codes[labs] == self.name_code(lab_name)
+        hits: npt.NDArray[np.bool_]
+        if operator == "<":
+            hits = matches & (self.values[labs] < value)
+        else:
+            hits = matches & (self.values[labs] > value)
+        return hits
+
+    def patient_is_sick(
+        self, patient_id: str, lab_name: str, operator: str, value: float
+    ) -> bool:
+        """Answer Patient.is_sick for one patient from their rows."""
+        schema.check_operator(operator)
+        rows = self.patient_range(patient_id)
+        patient_rows = slice(rows.start, rows.stop)
+        matches = self.name_codes[patient_rows] == self.name_code(lab_name)
+        values = self.values[patient_rows][matches]
+        if operator == "<":
+            return bool((values < value).any())
+        return bool((values > value).any())
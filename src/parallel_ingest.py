@@ -0,0 +1,109 @@
+"""
+This module tokenizes large TSV files in parallel worker processes.
+
+The file is split into byte ranges that end on line boundaries. Workers
+parse the ranges and the results are yielded back in file order, so a
+single writer can number and store the rows deterministically.
+"""
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+import os
+from typing import Iterator, Sequence
+from tsv_reader import resolve_columns
+
+DEFAULT_RANGE_BYTES = 16 * 1024 * 1024
+ENCODING = "utf-8"
+
+
+def split_byte_ranges(
+    filename: str,
+    range_bytes: int = DEFAULT_RANGE_BYTES,
+    start: int | None = None,
+    end: int | None = None,
+) -> tuple[list[str], list[tuple[int, int]]]:
+    """
+    Split the body of a TSV file into byte ranges of whole lines.
+
+    Only the bytes from start, which defaults to the end of the header,
+    to end, which defaults to the end of the file, are split. start must
+    be at a line boundary. Return the header columns and the
+    (start, end) offset of each range.
+    """
+    if range_bytes < 1:
+        raise ValueError("range_bytes must be positive")
+    size = os.path.getsize(filename) if end is None else end
+    ranges = []
+    with open(filename, "rb") as file:
+        headers = file.readline().decode(ENCODING).rstrip("\r\n").split("\t")
+        start = max(start or 0, file.tell())
+        while start < size:
+            file.seek(min(start + range_bytes, size))
+            # Move the end of the range to the end of the current line
+            if file.tell() < size:
+                file.readline()
+            range_end = min(file.tell(), size)
+            ranges.append((start, range_end))
+            start = range_end
+    return headers, ranges
+
+
+def parse_byte_range(
+    filename: str, start: int, end: int, positions: Sequence[int]
+) -> list[tuple[str, ...]]:
+    """Parse the records in a byte range, keeping the given positions."""
+    with open(filename, "rb") as file:
+        file.seek(start)
+        data = file.read(end - start).decode(ENCODING)
+    rows = []
+    for line in data.split("\n"):
+        line = line.rstrip("\r")
+        if line:
+            record = line.split("\t")
+            rows.append(tuple(record[position] for position in positions))
+    return rows
+
+
+def read_byte_ranges(
+    filename: str,
+    columns: Sequence[str],
+    start: int | None = None,
+    end: int | None = None,
+    range_bytes: int = DEFAULT_RANGE_BYTES,
+) -> Iterator[list[tuple[str, ...]]]:
+    """Yield the rows of each byte range between start and end in order."""
+    headers, ranges = split_byte_ranges(filename, range_bytes, start, end)
+    positions = resolve_columns(headers, columns)
+    for range_start, range_end in ranges:
+        yield parse_byte_range(filename, range_start, range_end, positions)
+
+
+def read_chunks_parallel(
+    filename: str,
+    columns: Sequence[str],
+    workers: int | None = None,
+    range_bytes: int = DEFAULT_RANGE_BYTES,
+) -> Iterator[list[tuple[str, ...]]]:
+    """
+    Yield the rows of each byte range, parsed in worker processes.
+
+    Chunks are yielded in file order. At most two ranges per worker are
+    in flight, so memory stays bounded when the consumer is slower than
+    the workers.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    headers, ranges = split_byte_ranges(filename, range_bytes)
+    positions = resolve_columns(headers, columns)
+    window = 2 * workers
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending: deque[Future[list[tuple[str, ...]]]] = deque()
+        for start, end in ranges:
+            pending.append(
+                executor.submit(
+                    parse_byte_range, filename, start, end, positions
+                )
+            )
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
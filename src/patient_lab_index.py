@@ -0,0 +1,115 @@
+"""
+This module indexes labs by patient, lab name and date.
+
+Labs are sorted once by PatientID, LabName and LabDateTime, so every
+(patient, lab name) pair owns one contiguous, date-ordered range and a
+date range within it is found by binary search.
+"""
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+from operator import itemgetter
+from typing import Generic, Iterable, TypeVar
+import ehr_schema as schema
+
+T = TypeVar("T")
+# PatientID, LabName, LabDateTime, LabValue and the indexed lab
+IndexEntry = tuple[str, str, datetime, float, T]
+
+
+class LabGroup:
+    """Create the range of one patient's labs with one lab name."""
+
+    __slots__ = ("start", "stop", "minimum", "maximum")
+
+    def __init__(
+        self, start: int, stop: int, minimum: float, maximum: float
+    ) -> None:
+        """Initialize the group from its rows and value bounds."""
+        self.start = start
+        self.stop = stop
+        self.minimum = minimum
+        self.maximum = maximum
+
+
+class PatientLabIndex(Generic[T]):
+    """Create the per-patient lab index."""
+
+    def __init__(self, entries: Iterable[IndexEntry[T]]) -> None:
+        """
+        Build the index from (PatientID, LabName, LabDateTime, LabValue, lab).
+
+        Labs with the same patient, name and date keep their input order.
+        """
+        ordered = sorted(entries, key=itemgetter(0, 1, 2))
+        self._labs = [entry[4] for entry in ordered]
+        self._dates = [entry[2] for entry in ordered]
+        self._groups: dict[str, dict[str, LabGroup]] = {}
+        start = 0
+        while start < len(ordered):
+            patient_id, lab_name = ordered[start][:2]
+            stop = start
+            values = []
+            while (
+                stop < len(ordered)
+                and ordered[stop][0] == patient_id
+                and ordered[stop][1] == lab_name
+            ):
+                values.append(ordered[stop][3])
+                stop += 1
+            self._groups.setdefault(patient_id, {})[lab_name] = LabGroup(
+                start, stop, min(values), max(values)
+            )
+            start = stop
+
+    def __len__(self) -> int:
+        """Count the labs in the index."""
+        return len(self._labs)
+
+    def __contains__(self, patient_id: object) -> bool:
+        """Check whether a patient has any labs."""
+        return patient_id in self._groups
+
+    def lab_names(self, patient_id: str) -> list[str]:
+        """List the names of a patient's labs in sorted order."""
+        return list(self._groups.get(patient_id, {}))
+
+    def labs(
+        self,
+        patient_id: str,
+        lab_name: str | None = None,
+        start: datetime | None = None,
+        end: datetime | None = None,
+    ) -> list[T]:
+        """
+        Find a patient's labs, optionally of one name and between dates.
+
+        Both dates are inclusive. Labs come grouped by name and sorted by
+        date, and a patient without labs has none rather than an error.
+        """
+        groups = self._groups.get(patient_id, {})
+        if lab_name is not None:
+            group = groups.get(lab_name)
+            selected = [] if group is None else [group]
+        else:
+            selected = list(groups.values())
+        labs: list[T] = []
+        for group in selected:
+            lo, hi = group.start, group.stop
+            if start is not None:
+                lo = bisect_left(self._dates, start, lo, hi)
+            if end is not None:
+                hi = bisect_right(self._dates, end, lo, hi)
+            labs.extend(self._labs[lo:hi])
+        return labs
+
+    def is_sick(
+        self, patient_id: str, lab_name: str, operator: str, value: float
+    ) -> bool:
+        """Answer Patient.is_sick from the value bounds of one group."""
+        schema.check_operator(operator)
+        group = self._groups.get(patient_id, {}).get(lab_name)
+        if group is None:
+            return False
+        if operator == "<":
+            return group.minimum < value
+        return group.maximum > value
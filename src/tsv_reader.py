@@ -0,0 +1,88 @@
+"""
+This module streams records out of tab separated EHR files.
+
+Rows are produced lazily so memory is bounded by the chunk size rather
+than by the size of the file.
+"""
+from itertools import islice
+from operator import itemgetter
+from typing import Any, Callable, Iterator, Mapping, Sequence
+
+Converter = Callable[[str], Any]
+
+
+def resolve_columns(
+    headers: Sequence[str], columns: Sequence[str]
+) -> list[int]:
+    """Find the position of each requested column in the header."""
+    missing = [column for column in columns if column not in headers]
+    if missing:
+        raise ValueError(f"Missing columns in header: {', '.join(missing)}")
+    return [headers.index(column) for column in columns]
+
+
+def column_getter(
+    positions: Sequence[int],
+) -> Callable[[list[str]], tuple[str, ...]]:
+    """Build a function that picks the given positions out of a record."""
+    if len(positions) == 1:
+        (position,) = positions
+
+        def get_column(record: list[str]) -> tuple[str, ...]:
+            return (record[position],)
+
+        return get_column
+    return itemgetter(*positions)
+
+
+def read_rows(
+    filename: str,
+    columns: Sequence[str],
+    converters: Mapping[str, Converter] | None = None,
+) -> Iterator[tuple[Any, ...]]:
+    """
+    Yield one tuple per record with the requested columns in order.
+
+    The header is resolved once, so the columns may appear in any order
+    in the file. Blank lines and trailing newlines are skipped. Columns
+    named in converters are converted with the given function.
+    """
+    if not columns:
+        raise ValueError("At least one column is required")
+    with open(filename) as file:
+        headers = file.readline().rstrip("\r\n").split("\t")
+        positions = resolve_columns(headers, columns)
+        get_columns = column_getter(positions)
+        convert = [
+            (i, converters[column])
+            for i, column in enumerate(columns)
+            if converters is not None and column in converters
+        ]
+        for line in file:
+            line = line.rstrip("\r\n")
+            if not line:
+                continue
+            row: tuple[Any, ...] = get_columns(line.split("\t"))
+            if convert:
+                values = list(row)
+                for i, converter in convert:
+                    values[i] = converter(values[i])
+                row = tuple(values)
+            yield row
+
+
+def read_chunks(
+    filename: str,
+    columns: Sequence[str],
+    chunk_size: int,
+    converters: Mapping[str, Converter] | None = None,
+) -> Iterator[list[tuple[Any, ...]]]:
+    """Yield lists of at most chunk_size rows from read_rows."""
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be positive")
+    rows = read_rows(filename, columns, converters)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+        yield chunk
@@ -0,0 +1,13 @@
+"""Fixtures shared by the tests."""
+import pathlib
+from typing import Generator
+import pytest
+from ehr_connection import using_database
+
+
+@pytest.fixture
+def tmp_database(tmp_path: pathlib.Path) -> Generator[str, None, None]:
+    """Use a database of the test's own instead of the default one."""
+    database = str(tmp_path / "ehr.db")
+    with using_database(database):
+        yield database
@@ -5,6 +5,40 @@ import tempfile
 import typing
 from uuid import uuid4
 
+PATIENT_HEADER = [
+    "PatientID",
+    "PatientGender",
+    "PatientDateOfBirth",
+    "PatientRace",
+    "PatientMaritalStatus",
+    "PatientLanguage",
+    "PatientPopulationPercentageBelowPoverty",
+]
+LAB_HEADER = [
+    "PatientID",
+    "AdmissionID",
+    "LabName",
+    "LabValue",
+    "LabUnits",
+    "LabDateTime",
+]
+FAKE_PATIENT = [
+    PATIENT_HEADER,
+    ["A", "Male", "1947-12-28 02:45:40.547"]
+    + ["Unknown", "Married", "Icelandic", "18.08"],
+    ["B", "Female", "1952-01-18 19:51:12.917"]
+    + ["White", "Single", "English", ""],
+]
+FAKE_LAB = [
+    LAB_HEADER,
+    ["A", "1", "METABOLIC: ALBUMIN", "4.6", "gm/dL"]
+    + ["1992-07-01 01:36:17.910"],
+    ["A", "1", "METABOLIC: ALBUMIN", "3.1", "gm/dL"]
+    + ["1991-01-01 00:00:00.000"],
+    ["B", "2", "CBC: HEMOGLOBIN", "13.2", "gm/dl"]
+    + ["2010-03-04 05:06:07.080"],
+]
+
 
 def write_file(table: list[list[str]], dirname: str) -> str:
     """Write table to tsv file."""
@@ -0,0 +1,120 @@
+"""Testing the cohort queries."""
+from datetime import datetime
+import pathlib
+import numpy as np
+import pytest
+from benchmarks.synthetic import write_synthetic_files
+from cohort_query import (
+    age,
+    compile_sql,
+    gender,
+    lab,
+    plan,
+    poverty,
+    select_patient_ids,
+)
+import ehr_cohort
+from ehr_cohort import EHRCohort
+from ehr_connection import using_database
+from ehr_module import parse_columnar, parse_data
+from ehr_snapshot import open_snapshot, write_snapshot
+from tsv_reader import read_rows
+
+AS_OF = datetime(2023, 1, 1)
+
+
+def test_plan_order() -> None:
+    """Test that predicates are ordered from the cheapest."""
+    albumin = lab("METABOLIC: ALBUMIN") < 3.5
+    older = age > 60
+    male = gender == "Male"
+    assert plan([albumin, older, male]) == [male, older, albumin]
+    sql, parameters = compile_sql([albumin, older, male], AS_OF)
+    assert sql.index("PatientGender") < sql.index("EXISTS")
+    assert parameters[0] == "Male"
+    assert parameters[-2:] == ["METABOLIC: ALBUMIN", 3.5]
+
+
+def test_unsupported_lab_operator() -> None:
+    """Test that labs only compare like is_sick."""
+    with pytest.raises(ValueError):
+        plan([lab("METABOLIC: ALBUMIN") <= 3.5])
+
+
+def test_queries_agree(tmp_path: pathlib.Path) -> None:
+    """Test that SQL, database and columnar cohorts select the same."""
+    patient_filename = str(tmp_path / "patients.txt")
+    lab_filename = str(tmp_path / "labs.txt")
+    write_synthetic_files(patient_filename, lab_filename, 5_000)
+    predicates = (
+        age > 60,
+        lab("METABOLIC: ALBUMIN") < 3.5,
+        gender == "Male",
+        poverty < 20,
+    )
+    with using_database(str(tmp_path / "ehr.db")):
+        patients = parse_data(patient_filename, lab_filename)
+        demographics = {
+            row[0]: (row[1], float(row[2]))
+            for row in read_rows(
+                patient_filename,
+                (
+                    "PatientID",
+                    "PatientGender",
+                    "PatientPopulationPercentageBelowPoverty",
+                ),
+            )
+        }
+        expected = sorted(
+            patient.patient_id
+            for patient in patients
+            if (patient._age(AS_OF) or 0) > 60
+            and patient.is_sick("METABOLIC: ALBUMIN", "<", 3.5)
+            and demographics[patient.patient_id][0] == "Male"
+            and demographics[patient.patient_id][1] < 20
+        )
+        assert expected
+        selected = select_patient_ids(*predicates, as_of=AS_OF)
+        assert sorted(selected) == expected
+        database = EHRCohort.from_database().where(*predicates, as_of=AS_OF)
+        assert list(database.patient_ids) == selected
+
+    columnar = parse_columnar(patient_filename, lab_filename)[0].cohort
+    assert columnar is not None
+    matched = columnar.where(*predicates, as_of=AS_OF)
+    assert list(matched.patient_ids) == selected
+    assert not len(matched.where(gender == "Female"))
+
+    write_snapshot(str(tmp_path / "snapshot"), columnar)
+    opened = open_snapshot(str(tmp_path / "snapshot"))
+    assert list(opened.where(*predicates, as_of=AS_OF).patient_ids) == (
+        selected
+    )
+
+
+def test_metrics_of_rows(
+    tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Test that metrics of some rows match those of the whole cohort."""
+    patient_filename = str(tmp_path / "patients.txt")
+    lab_filename = str(tmp_path / "labs.txt")
+    write_synthetic_files(patient_filename, lab_filename, 1_000)
+    monkeypatch.setattr(ehr_cohort, "IS_SICK_BATCH_SIZE", 64)
+    with using_database(str(tmp_path / "ehr.db")):
+        parse_data(patient_filename, lab_filename)
+        database = EHRCohort.from_database()
+        columnar = parse_columnar(patient_filename, lab_filename)[0].cohort
+        assert columnar is not None
+        for cohort in (database, columnar):
+            rows = np.arange(3, len(cohort), 7)
+            for operator in ("<", ">"):
+                sick = cohort.is_sick("METABOLIC: ALBUMIN", operator, 3.5)
+                assert sick.any() and not sick.all()
+                assert (
+                    cohort.is_sick("METABOLIC: ALBUMIN", operator, 3.5, rows)
+                    == sick[rows]
+                ).all()
+            assert (cohort.ages(AS_OF, rows) == cohort.ages(AS_OF)[rows]).all()
+            assert (
+                cohort.initial_ages(rows) == cohort.initial_ages()[rows]
+            ).all()
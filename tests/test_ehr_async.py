@@ -0,0 +1,100 @@
+"""Testing the asyncio query API."""
+import asyncio
+from datetime import datetime
+import pathlib
+import pytest
+from ehr_async import AsyncEHRStore
+from ehr_connection import using_database
+from ehr_module import Patient, parse_data
+from fake_files import FAKE_LAB, FAKE_PATIENT, fake_files
+
+PATIENTS = FAKE_PATIENT + [
+    ["C", "Female", "1960-05-02 08:00:00.000", "White", "", "", ""]
+]
+LABS = FAKE_LAB[:2] + [
+    ["B", "1", "METABOLIC: ALBUMIN", "3.2", "gm/dL"]
+    + ["1993-01-04 11:02:03.110"]
+]
+AS_OF = datetime(2023, 4, 17)
+
+
+@pytest.fixture
+def database(tmp_path: pathlib.Path) -> str:
+    """Load the fake files into a database of their own."""
+    database = str(tmp_path / "async.db")
+    with using_database(database), fake_files(PATIENTS, LABS) as filenames:
+        parse_data(filenames[0], filenames[1])
+    return database
+
+
+def test_single_patient(database: str) -> None:
+    """Test the awaitable metrics of one patient."""
+
+    async def main() -> None:
+        async with AsyncEHRStore(database) as store:
+            assert await store.age("A", AS_OF) == 75
+            assert await store.initial_age("B") == 40
+            assert await store.initial_age("C") is None
+            assert await store.is_sick("B", "METABOLIC: ALBUMIN", "<", 3.5)
+            assert not await store.is_sick("C", "METABOLIC: ALBUMIN", "<", 4)
+            with pytest.raises(KeyError):
+                await store.age("D", AS_OF)
+            # Unknown patients fail like Patient.is_sick does
+            with pytest.raises(KeyError):
+                await store.is_sick("D", "METABOLIC: ALBUMIN", "<", 4)
+            with pytest.raises(KeyError):
+                await store.is_sick_many(
+                    ["A", "D"], "METABOLIC: ALBUMIN", "<", 4
+                )
+            with pytest.raises(ValueError):
+                await store.is_sick("A", "METABOLIC: ALBUMIN", "=", 4)
+
+    asyncio.run(main())
+    with using_database(database, read_only=True):
+        with pytest.raises(KeyError):
+            Patient("D").is_sick("METABOLIC: ALBUMIN", "<", 4)
+
+
+def test_concurrent_requests_are_coalesced(database: str) -> None:
+    """Test that identical concurrent requests share one query."""
+
+    async def main() -> None:
+        async with AsyncEHRStore(database, max_workers=2) as store:
+            ages = await asyncio.gather(
+                *(store.age("B", AS_OF) for _ in range(20))
+            )
+            assert ages == [71] * 20
+            assert store.queries == 1
+            sick = await asyncio.gather(
+                store.is_sick("A", "METABOLIC: ALBUMIN", ">", 4),
+                store.is_sick("A", "METABOLIC: ALBUMIN", ">", 4),
+                store.is_sick("B", "METABOLIC: ALBUMIN", ">", 4),
+            )
+            assert list(sick) == [True, True, False]
+            assert store.queries == 3
+
+    asyncio.run(main())
+
+
+def test_bulk_methods(database: str) -> None:
+    """Test the batched methods across several batches."""
+
+    async def main() -> None:
+        async with AsyncEHRStore(
+            database, batch_size=2, read_only=True
+        ) as store:
+            assert await store.ages(["A", "B", "C"], AS_OF) == {
+                "A": 75,
+                "B": 71,
+                "C": 62,
+            }
+            assert store.queries == 2
+            assert await store.initial_ages(["A", "C"]) == {
+                "A": 44,
+                "C": None,
+            }
+            assert await store.is_sick_many(
+                ["A", "B", "C"], "METABOLIC: ALBUMIN", "<", 4
+            ) == {"A": False, "B": True, "C": False}
+
+    asyncio.run(main())
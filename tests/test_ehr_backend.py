@@ -0,0 +1,126 @@
+"""Testing that every storage backend answers alike."""
+from datetime import datetime
+import os
+import pathlib
+from typing import Generator
+import pytest
+from cohort_query import age, gender, lab
+from ehr_backend import (
+    BACKENDS,
+    Backend,
+    MemorySQLiteBackend,
+    SQLiteBackend,
+    create_backend,
+)
+import ehr_cache
+from fake_files import FAKE_LAB, FAKE_PATIENT, fake_files
+
+
+@pytest.fixture(params=BACKENDS)
+def backend(
+    request: pytest.FixtureRequest, tmp_path: pathlib.Path
+) -> Generator[Backend, None, None]:
+    """Load the fake files into each backend."""
+    with create_backend(request.param, str(tmp_path / "ehr.db")) as backend:
+        with fake_files(FAKE_PATIENT, FAKE_LAB) as (patients, labs):
+            backend.load(patients, labs)
+        with backend.active(), ehr_cache.using_as_of(datetime(2023, 4, 17)):
+            yield backend
+
+
+def test_patient_metrics(backend: Backend) -> None:
+    """Test the metrics of loaded patients."""
+    a, b = backend.patient("A"), backend.patient("B")
+    assert (a.age, b.age) == (75, 71)
+    assert (a.initial_age(), b.initial_age()) == (43, 58)
+    assert a.is_sick("METABOLIC: ALBUMIN", "<", 3.5)
+    assert not a.is_sick("METABOLIC: ALBUMIN", ">", 4.6)
+    assert not b.is_sick("METABOLIC: ALBUMIN", "<", 3.5)
+    with pytest.raises(KeyError):
+        backend.patient("C")
+
+
+def test_labs(backend: Backend) -> None:
+    """Test the fields of loaded labs."""
+    labs = sorted(
+        (lab.LabDateTime, lab.LabName, lab.LabValue, lab.LabUnits)
+        for lab in backend.patient("A").patient_labs
+    )
+    assert labs == [
+        (datetime(1991, 1, 1), "METABOLIC: ALBUMIN", 3.1, "gm/dL"),
+        (
+            datetime(1992, 7, 1, 1, 36, 17, 910000),
+            "METABOLIC: ALBUMIN",
+            4.6,
+            "gm/dL",
+        ),
+    ]
+
+
+def test_cohort(backend: Backend) -> None:
+    """Test the cohort of the loaded patients."""
+    cohort = backend.cohort()
+    assert sorted(cohort.patient_ids) == ["A", "B"]
+    assert cohort.as_dict(cohort.ages()) == {"A": 75, "B": 71}
+    assert list(
+        cohort.where(age > 60, lab("METABOLIC: ALBUMIN") < 3.5).patient_ids
+    ) == ["A"]
+    assert list(cohort.where(gender == "Female").patient_ids) == ["B"]
+
+
+def test_reload(backend: Backend) -> None:
+    """Test that loading replaces what was loaded before."""
+    with fake_files(FAKE_PATIENT[:2], FAKE_LAB[:2]) as (patients, labs):
+        loaded = backend.load(patients, labs)
+    assert [patient.patient_id for patient in loaded] == ["A"]
+    assert list(backend.cohort().patient_ids) == ["A"]
+    assert len(backend.patient("A").patient_labs) == 1
+
+
+def test_partial_patients(backend: Backend) -> None:
+    """Test patients without a birth date and lab-only PatientIDs."""
+    no_birth_date = ["C", "", "", "", "", "", ""]
+    lab_only = ["Z", "3", "CBC: HEMOGLOBIN", "11.0", "gm/dl"] + [
+        "2011-03-04 05:06:07.080"
+    ]
+    with fake_files(
+        FAKE_PATIENT + [no_birth_date], FAKE_LAB + [lab_only]
+    ) as filenames:
+        backend.load(*filenames)
+    c = backend.patient("C")
+    assert (c.age, c.initial_age()) == (None, None)
+    assert not c.is_sick("CBC: HEMOGLOBIN", "<", 12.0)
+    with pytest.raises(KeyError):
+        backend.patient("Z")
+    cohort = backend.cohort()
+    assert list(cohort.patient_ids) == ["A", "B", "C"]
+    assert cohort.as_dict(cohort.ages()) == {"A": 75, "B": 71, "C": None}
+    assert list(cohort.where(lab("CBC: HEMOGLOBIN") < 12.0).patient_ids) == []
+
+
+def test_reopen_database(tmp_path: pathlib.Path) -> None:
+    """Test that an on-disk database answers after it is reopened."""
+    database = str(tmp_path / "ehr.db")
+    with SQLiteBackend(database) as backend:
+        with fake_files(FAKE_PATIENT, FAKE_LAB) as filenames:
+            backend.load(*filenames)
+    with SQLiteBackend(database) as reopened, reopened.active():
+        patient = reopened.patient("A")
+        assert patient.initial_age() == 43
+        assert sorted(lab.LabValue for lab in patient.patient_labs) == [
+            3.1,
+            4.6,
+        ]
+
+
+def test_memory_databases_are_separate(
+    tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Test that in-memory databases are private and leave no file."""
+    monkeypatch.chdir(tmp_path)
+    with MemorySQLiteBackend() as first, MemorySQLiteBackend() as second:
+        with fake_files(FAKE_PATIENT, FAKE_LAB) as filenames:
+            first.load(*filenames)
+        assert list(first.cohort().patient_ids) == ["A", "B"]
+        assert len(second.cohort()) == 0
+    assert not os.listdir(tmp_path)
@@ -0,0 +1,90 @@
+"""Testing the result cache."""
+from contextlib import closing
+from datetime import datetime
+import pathlib
+import sqlite3
+import pytest
+import ehr_cache
+from ehr_cache import LRUCache, using_as_of
+from ehr_connection import using_database
+from ehr_module import Patient, parse_data
+from fake_files import FAKE_LAB, FAKE_PATIENT, fake_files
+
+
+def test_lru_eviction() -> None:
+    """Test that the least recently used result is evicted."""
+    cache = LRUCache(maxsize=2)
+    assert cache.get("a", lambda: 1) == 1
+    assert cache.get("b", lambda: 2) == 2
+    assert cache.get("a", lambda: 0) == 1
+    assert cache.get("c", lambda: 3) == 3
+    assert cache.get("b", lambda: 4) == 4
+    assert cache.stats() == (1, 4, 2, 2)
+    cache.clear()
+    assert cache.stats() == (0, 0, 0, 2)
+    with pytest.raises(ValueError):
+        LRUCache(maxsize=-1)
+
+
+def test_generation_invalidates() -> None:
+    """Test that a new generation misses the cached results."""
+    assert ehr_cache.cached(("test", "x"), lambda: 1) == 1
+    assert ehr_cache.cached(("test", "x"), lambda: 2) == 1
+    hits = ehr_cache.get_cache().hits
+    ehr_cache.invalidate()
+    # Results of older generations are dropped rather than left to expire
+    assert ehr_cache.get_cache().stats()[2:] == (0, ehr_cache.DEFAULT_MAXSIZE)
+    assert ehr_cache.get_cache().hits == hits
+    assert ehr_cache.cached(("test", "x"), lambda: 2) == 2
+
+
+def test_patient_metrics_are_cached(tmp_database: str) -> None:
+    """Test that ages are cached per as-of date and reset by parse_data."""
+    with fake_files(FAKE_PATIENT[:2], FAKE_LAB[:2]) as filenames:
+        (patient,) = parse_data(filenames[0], filenames[1])
+        hits = ehr_cache.get_cache().hits
+        with using_as_of(datetime(2023, 1, 1)):
+            assert patient.age == 75
+            assert patient.age == 75
+            assert patient.initial_age() == 44
+            assert patient.initial_age() == 44
+        assert ehr_cache.get_cache().hits == hits + 2
+        with using_as_of(datetime(2024, 1, 1)):
+            assert patient.age == 76
+
+        generation = ehr_cache.generation()
+        (patient,) = parse_data(filenames[0], filenames[1])
+        assert ehr_cache.generation() > generation
+
+
+def test_default_as_of() -> None:
+    """Test that ages default to the start of the current day."""
+    assert ehr_cache.as_of().date() == datetime.now().date()
+    assert ehr_cache.as_of().time() == datetime.min.time()
+    ehr_cache.set_as_of(datetime(2000, 1, 1))
+    try:
+        assert ehr_cache.as_of() == datetime(2000, 1, 1)
+    finally:
+        ehr_cache.set_as_of(None)
+
+
+def test_read_only_databases_are_not_cached(tmp_path: pathlib.Path) -> None:
+    """Test that readers see what another process writes."""
+    database = str(tmp_path / "ehr.db")
+    with using_database(database), fake_files(
+        FAKE_PATIENT[:2], FAKE_LAB[:2]
+    ) as filenames:
+        parse_data(*filenames)
+    with using_database(database, read_only=True):
+        patient = Patient("A")
+        with using_as_of(datetime(2023, 1, 1)):
+            assert patient.age == 75
+            # Another process changes the birth date without invalidating
+            # this process's cache
+            with closing(sqlite3.connect(database)) as writer, writer:
+                writer.execute(
+                    "UPDATE patients SET PatientDateOfBirth=0, "
+                    "PatientGender='Female'"
+                )
+            assert patient.age == 53
+            assert patient.gender == "Female"
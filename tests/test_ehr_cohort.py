@@ -0,0 +1,96 @@
+"""Testing the EHR cohort."""
+from datetime import datetime
+import pathlib
+import numpy as np
+import pytest
+from cohort_query import lab, select_patient_ids
+from ehr_cohort import EHRCohort
+from ehr_connection import using_database
+from ehr_export import export_table
+from ehr_module import Patient, cohort_is_sick
+import ehr_schema
+
+
+def test_cohort_metrics(tmp_path: pathlib.Path) -> None:
+    """Test the cohort metrics against the per-patient methods."""
+    with using_database(str(tmp_path / "ehr.db")) as manager:
+        with manager.transaction() as cursor:
+            ehr_schema.create_tables(cursor)
+            ehr_schema.upsert_patients(
+                cursor,
+                [
+                    ("A", "Male", "1947-12-28 02:45:40.547")
+                    + ("Unknown", "Married", "Icelandic", "18.08"),
+                    ("B", "Female", "1952-01-18 19:51:12.917")
+                    + ("Unknown", "Single", "English", "13.03"),
+                ],
+            )
+            ehr_schema.insert_labs(
+                cursor,
+                [
+                    ("A", "1", "METABOLIC: ALBUMIN", "4.6", "gm/dL")
+                    + ("1992-07-01 01:36:17.910", "0"),
+                    ("A", "1", "METABOLIC: ALBUMIN", "3.1", "gm/dL")
+                    + ("1991-01-01 00:00:00.000", "1"),
+                ],
+            )
+            ehr_schema.create_indexes(cursor)
+
+        cohort = EHRCohort.from_database()
+        as_of = datetime(2023, 4, 17)
+        assert cohort.patient_ids == ["A", "B"]
+        assert cohort.ages(as_of).tolist() == [75, 71]
+        assert cohort.initial_ages().tolist() == [43, None]
+        assert cohort.as_dict(
+            cohort.is_sick("METABOLIC: ALBUMIN", "<", 4)
+        ) == {
+            "A": True,
+            "B": False,
+        }
+        assert cohort.age_of("B", as_of) == 71
+
+        patient = Patient("A", [], cohort)
+        assert patient.initial_age() == 43
+        assert patient.age == cohort.ages()[0]
+        assert patient.initial_age() == Patient("A", []).initial_age()
+        assert isinstance(cohort.first_lab_dates, np.ndarray)
+
+        # A patient without labs has no initial age on either path
+        assert cohort.initial_age_of("B") is None
+        assert Patient("B", [], cohort).initial_age() is None
+        assert Patient("B", []).initial_age() is None
+        with pytest.raises(KeyError):
+            Patient("C", []).age
+
+
+def test_lab_only_patients_are_left_out(tmp_path: pathlib.Path) -> None:
+    """Test that PatientIDs only in the lab file are not patients."""
+    with using_database(str(tmp_path / "ehr.db")) as manager:
+        with manager.transaction() as cursor:
+            ehr_schema.create_tables(cursor)
+            ehr_schema.insert_labs(
+                cursor,
+                [
+                    ("A", "1", "METABOLIC: ALBUMIN", "3.1", "gm/dL")
+                    + ("1991-01-01 00:00:00.000", "0"),
+                    ("Z", "1", "METABOLIC: ALBUMIN", "3.1", "gm/dL")
+                    + ("1991-01-01 00:00:00.000", "1"),
+                ],
+            )
+            ehr_schema.upsert_patients(
+                cursor,
+                [
+                    ("A", "Male", "1947-12-28 02:45:40.547")
+                    + ("Unknown", "Married", "Icelandic", "18.08"),
+                ],
+            )
+            ehr_schema.create_indexes(cursor)
+
+        cohort = EHRCohort.from_database()
+        assert cohort.patient_ids == ["A"]
+        assert cohort_is_sick("METABOLIC: ALBUMIN", "<", 3.5) == {"A": True}
+        assert select_patient_ids(lab("METABOLIC: ALBUMIN") < 3.5) == ["A"]
+        with pytest.raises(KeyError):
+            Patient("Z").age
+        path = str(tmp_path / "patients.csv")
+        assert export_table("patients", path) == 1
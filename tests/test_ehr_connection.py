@@ -0,0 +1,131 @@
+"""Testing the connection manager."""
+from contextlib import closing
+import pathlib
+import sqlite3
+import threading
+import pytest
+from benchmarks.synthetic import write_synthetic_files
+from ehr_cohort import EHRCohort
+import ehr_connection
+from ehr_connection import ConnectionManager, using_database
+from ehr_module import parse_data, rebuild_database
+import ehr_schema as schema
+
+
+def test_connection_is_pooled_per_thread(tmp_path: pathlib.Path) -> None:
+    """Test that each thread reuses its own connection."""
+    with ConnectionManager(str(tmp_path / "ehr.db")) as manager:
+        main_connection = manager.connection()
+        assert manager.connection() is main_connection
+
+        other_connections = []
+        thread = threading.Thread(
+            target=lambda: other_connections.append(manager.connection())
+        )
+        thread.start()
+        thread.join()
+        assert other_connections[0] is not main_connection
+
+    assert manager.closed
+    with pytest.raises(RuntimeError):
+        manager.connection()
+
+
+def test_transaction_rolls_back(tmp_path: pathlib.Path) -> None:
+    """Test that a failed transaction is rolled back."""
+    with ConnectionManager(str(tmp_path / "ehr.db")) as manager:
+        with manager.transaction() as cursor:
+            cursor.execute("CREATE TABLE labs (LabID VARCHAR)")
+        with pytest.raises(ValueError):
+            with manager.transaction() as cursor:
+                cursor.execute("INSERT INTO labs VALUES ('0')")
+                raise ValueError
+        count = manager.connection().execute("SELECT COUNT(*) FROM labs")
+        assert count.fetchone()[0] == 0
+
+
+def test_using_database(tmp_path: pathlib.Path) -> None:
+    """Test temporarily switching the database."""
+    previous = ehr_connection.get_manager()
+    with using_database(str(tmp_path / "ehr.db")) as manager:
+        assert ehr_connection.get_manager() is manager
+        assert manager.database == str(tmp_path / "ehr.db")
+    assert manager.closed
+    assert ehr_connection.get_manager() is previous
+
+
+def test_read_only_manager(tmp_path: pathlib.Path) -> None:
+    """Test that a read-only manager reads a WAL database it cannot write."""
+    database = str(tmp_path / "ehr db.sqlite")
+    with ConnectionManager(database) as writer:
+        with writer.transaction() as cursor:
+            cursor.execute("CREATE TABLE labs (LabID INTEGER)")
+            cursor.execute("INSERT INTO labs VALUES (1)")
+        mode = writer.connection().execute("PRAGMA journal_mode")
+        assert mode.fetchone()[0] == "wal"
+
+        with ConnectionManager(database, read_only=True) as reader:
+            labs = reader.connection().execute("SELECT LabID FROM labs")
+            assert labs.fetchall() == [(1,)]
+            with pytest.raises(sqlite3.OperationalError, match="readonly"):
+                reader.connection().execute("INSERT INTO labs VALUES (2)")
+
+    with pytest.raises(ValueError):
+        ConnectionManager(":memory:", read_only=True)
+
+
+def test_read_only_manager_needs_migration(tmp_path: pathlib.Path) -> None:
+    """Test that a read-only manager refuses a database to be migrated."""
+    database = str(tmp_path / "ehr.db")
+    with closing(sqlite3.connect(database)) as connection:
+        connection.execute(
+            f"CREATE TABLE labs ({', '.join(schema.LAB_COLUMNS)}, LabID)"
+        )
+    with ConnectionManager(database, read_only=True) as reader:
+        with pytest.raises(sqlite3.OperationalError, match="migrate"):
+            reader.connection()
+    with ConnectionManager(database) as writer:
+        writer.connection()
+    with ConnectionManager(database, read_only=True) as reader:
+        assert "PatientKey" in schema.table_columns(
+            reader.connection().cursor(), "labs"
+        )
+
+
+def test_readers_during_rebuild(tmp_path: pathlib.Path) -> None:
+    """Test that readers see whole loads while the database is rebuilt."""
+    first = (str(tmp_path / "p1.txt"), str(tmp_path / "l1.txt"))
+    second = (str(tmp_path / "p2.txt"), str(tmp_path / "l2.txt"))
+    write_synthetic_files(*first, 1_000, seed=1)
+    write_synthetic_files(*second, 20_000, seed=2)
+    database = str(tmp_path / "ehr.db")
+    with using_database(database):
+        parse_data(*first)
+
+        counts = set()
+        done = threading.Event()
+
+        def read() -> None:
+            with ConnectionManager(database, read_only=True) as reader:
+                while not done.is_set():
+                    count = reader.connection().execute(
+                        "SELECT COUNT(*) FROM labs"
+                    )
+                    counts.add(count.fetchone()[0])
+
+        thread = threading.Thread(target=read)
+        thread.start()
+        try:
+            patients = rebuild_database(*second)
+        finally:
+            done.set()
+            thread.join()
+
+        assert sum(len(patient.patient_labs) for patient in patients) == (
+            20_000
+        )
+        assert EHRCohort.from_database().patient_ids == [
+            patient.patient_id for patient in patients
+        ]
+    assert counts <= {1_000, 20_000}
+    assert 1_000 in counts
@@ -0,0 +1,47 @@
+"""Testing the timestamp parsers."""
+from datetime import datetime
+import numpy as np
+import pytest
+import ehr_dates
+from ehr_dates import DATE_FORMAT, parse_datetime
+
+
+@pytest.mark.parametrize(
+    "value",
+    [
+        "1992-07-01 01:36:17.910",
+        "1947-12-28 02:45:40.547123",
+        "1992-07-01 01:36:17.9",
+        "2000-02-29 23:59:59.000",
+    ],
+)
+def test_parse_datetime_matches_strptime(value: str) -> None:
+    """Test that the fast path agrees with strptime."""
+    assert parse_datetime(value) == datetime.strptime(value, DATE_FORMAT)
+
+
+@pytest.mark.parametrize(
+    "value",
+    [
+        "1992-07-01T01:36:17.910",
+        "1992-07-01 01:36:17",
+        "1992-02-30 01:36:17.910",
+    ],
+)
+def test_parse_datetime_rejects_other_layouts(value: str) -> None:
+    """Test that malformed timestamps raise like strptime does."""
+    with pytest.raises(ValueError):
+        parse_datetime(value)
+
+
+def test_vectorized_conversion() -> None:
+    """Test converting a column of timestamps."""
+    column = ehr_dates.to_datetime64(["1970-01-01 00:00:01.500", None])
+    assert column.dtype == np.dtype("datetime64[us]")
+    assert np.isnat(column[1])
+    assert ehr_dates.to_epoch_us(["1970-01-01 00:00:01.500"]).tolist() == [
+        1_500_000
+    ]
+    assert ehr_dates.from_epoch_us(1_500_000) == datetime(
+        1970, 1, 1, 0, 0, 1, 500000
+    )
@@ -0,0 +1,152 @@
+"""Testing the export of tables and cohort results."""
+import csv
+from datetime import datetime
+import math
+import pathlib
+from typing import Generator
+import numpy as np
+import pytest
+from ehr_backend import Backend, MemorySQLiteBackend
+from ehr_export import (
+    Chunk,
+    ParquetWriter,
+    export_cohort,
+    export_table,
+    write_chunks,
+)
+from ehr_dates import parse_datetime
+from fake_files import FAKE_LAB, FAKE_PATIENT, fake_files
+
+
+@pytest.fixture
+def backend() -> Generator[Backend, None, None]:
+    """Load the fake files into an in-memory database."""
+    with MemorySQLiteBackend() as backend:
+        with fake_files(FAKE_PATIENT, FAKE_LAB) as (patients, labs):
+            backend.load(patients, labs)
+        with backend.active():
+            yield backend
+
+
+def test_export_labs_csv(backend: Backend, tmp_path: pathlib.Path) -> None:
+    """Test that the labs table is exported in chunks to CSV."""
+    path = str(tmp_path / "labs.csv")
+    assert export_table("labs", path, chunk_size=2) == 3
+    with open(path, newline="") as file:
+        rows = list(csv.reader(file))
+    assert rows[0] == FAKE_LAB[0] + ["LabID"]
+    assert [row[:-2] for row in rows[1:]] == [row[:-1] for row in FAKE_LAB[1:]]
+    assert [parse_datetime(row[-2]) for row in rows[1:]] == [
+        parse_datetime(row[-1]) for row in FAKE_LAB[1:]
+    ]
+    assert [row[-1] for row in rows[1:]] == ["0", "1", "2"]
+
+
+def test_csv_round_trip(tmp_path: pathlib.Path) -> None:
+    """Test that exported labs load back with the same timestamps."""
+    labs = FAKE_LAB[:1] + [
+        ["A", "1", "METABOLIC: ALBUMIN", "4.6", "gm/dL"]
+        + ["1992-07-01 01:36:17.910123"],
+    ]
+    exported = str(tmp_path / "labs.csv")
+    with MemorySQLiteBackend() as backend, backend.active():
+        with fake_files(FAKE_PATIENT, labs) as (patients, lab_file):
+            backend.load(patients, lab_file)
+        export_table("labs", exported)
+    with open(exported, newline="") as file:
+        rows = list(csv.reader(file))
+    assert rows[1][5] == "1992-07-01 01:36:17.910123"
+    reloaded = [row[:-1] for row in rows]
+    with MemorySQLiteBackend() as backend, backend.active():
+        with fake_files(FAKE_PATIENT, reloaded) as (patients, lab_file):
+            backend.load(patients, lab_file)
+        (lab,) = backend.patient("A").patient_labs
+        assert lab.LabDateTime == datetime(1992, 7, 1, 1, 36, 17, 910123)
+
+
+def test_empty_csv_has_header(tmp_path: pathlib.Path) -> None:
+    """Test that empty tables and cohorts still get a header row."""
+    with MemorySQLiteBackend() as backend, backend.active():
+        with fake_files(FAKE_PATIENT[:1], FAKE_LAB[:1]) as filenames:
+            backend.load(*filenames)
+        assert export_table("labs", str(tmp_path / "labs.csv")) == 0
+        assert export_cohort(backend.cohort(), str(tmp_path / "c.csv")) == 0
+    with open(tmp_path / "labs.csv", newline="") as file:
+        assert list(csv.reader(file)) == [FAKE_LAB[0] + ["LabID"]]
+    with open(tmp_path / "c.csv", newline="") as file:
+        assert list(csv.reader(file)) == [["PatientID", "age", "initial_age"]]
+
+
+def test_export_patients_npz(backend: Backend, tmp_path: pathlib.Path) -> None:
+    """Test that the patients table is exported in chunks to NPZ."""
+    path = str(tmp_path / "patients.npz")
+    assert export_table("patients", path, chunk_size=1) == 2
+    with np.load(path) as arrays:
+        assert arrays["PatientID"].tolist() == ["A", "B"]
+        assert arrays["PatientLanguage"].tolist() == ["Icelandic", "English"]
+        assert arrays["PatientDateOfBirth"][1] == np.datetime64(
+            "1952-01-18T19:51:12.917"
+        )
+        poverty = arrays["PatientPopulationPercentageBelowPoverty"]
+        assert poverty[0] == 18.08 and math.isnan(poverty[1])
+
+
+def test_export_cohort(backend: Backend, tmp_path: pathlib.Path) -> None:
+    """Test that cohort ages and is_sick flags are exported."""
+    path = str(tmp_path / "cohort.npz")
+    rows = export_cohort(
+        backend.cohort(),
+        path,
+        as_of=datetime(2023, 4, 17),
+        sick=[("METABOLIC: ALBUMIN", "<", 3.5)],
+        chunk_size=1,
+    )
+    assert rows == 2
+    with np.load(path) as arrays:
+        assert arrays["PatientID"].tolist() == ["A", "B"]
+        assert arrays["age"].tolist() == [75, 71]
+        assert arrays["initial_age"].tolist() == [43, 58]
+        sick = arrays["is_sick(METABOLIC: ALBUMIN < 3.5)"]
+        assert sick.tolist() == [True, False]
+
+
+def test_unknown_exports(tmp_path: pathlib.Path) -> None:
+    """Test that unknown tables and formats are refused."""
+    with pytest.raises(ValueError):
+        export_table("admissions", str(tmp_path / "admissions.csv"))
+    with pytest.raises(ValueError):
+        write_chunks([], str(tmp_path / "labs.xlsx"))
+
+
+def test_export_parquet(backend: Backend, tmp_path: pathlib.Path) -> None:
+    """Test that the labs table is exported to Parquet."""
+    parquet = pytest.importorskip("pyarrow.parquet")
+    path = str(tmp_path / "labs.parquet")
+    assert export_table("labs", path, chunk_size=2) == 3
+    table = parquet.read_table(path)
+    assert table.column("LabValue").to_pylist() == [4.6, 3.1, 13.2]
+
+
+def test_parquet_needs_pyarrow(tmp_path: pathlib.Path) -> None:
+    """Test that Parquet exports explain that pyarrow is missing."""
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        with pytest.raises(ImportError, match="pyarrow"):
+            ParquetWriter(str(tmp_path / "labs.parquet"))
+    else:
+        pytest.skip("pyarrow is installed")
+
+
+def test_masked_values(tmp_path: pathlib.Path) -> None:
+    """Test that masked values are written as missing values."""
+    chunk: Chunk = {
+        "initial_age": np.ma.masked_array([43, 0], mask=[False, True])
+    }
+    assert write_chunks([chunk], str(tmp_path / "ages.csv")) == 2
+    with open(tmp_path / "ages.csv", newline="") as file:
+        assert list(csv.reader(file)) == [["initial_age"], ["43"], [""]]
+    write_chunks([chunk], str(tmp_path / "ages.npz"))
+    with np.load(tmp_path / "ages.npz") as arrays:
+        ages = arrays["initial_age"]
+        assert ages[0] == 43 and math.isnan(ages[1])
@@ -0,0 +1,71 @@
+"""Testing the hot path instrumentation."""
+import json
+import pathlib
+from typing import Generator
+import pytest
+from benchmarks.synthetic import write_synthetic_files
+from ehr_connection import get_manager, using_database
+from ehr_dates import parse_datetime
+import ehr_metrics
+from ehr_module import Patient, parse_data
+import ehr_schema as schema
+
+
+@pytest.fixture(autouse=True)
+def clean_metrics() -> Generator[None, None, None]:
+    """Start and end every test with nothing recorded."""
+    ehr_metrics.reset()
+    yield
+    ehr_metrics.disable()
+    ehr_metrics.reset()
+
+
+def test_accessor_statements(
+    tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Test that statements are timed by the accessor that ran them."""
+    patient_filename = str(tmp_path / "patients.txt")
+    lab_filename = str(tmp_path / "labs.txt")
+    write_synthetic_files(patient_filename, lab_filename, 200)
+    with using_database(str(tmp_path / "ehr.db")):
+        patients = parse_data(patient_filename, lab_filename, lazy=True)
+        assert ehr_metrics.snapshot() == {"statements": {}, "counters": {}}
+
+        with ehr_metrics.recording():
+            lab = patients[0].patient_labs[0]
+            lab.LabValue
+            lab.LabValue
+            Patient(patients[0].patient_id).age
+            cursor = get_manager().connection().cursor()
+        # Cursors opened while enabled stop recording too
+        cursor.execute(schema.SELECT_LAB_VALUE, (lab.LabID,))
+        # Nothing is recorded, or even attributed, once disabled
+        monkeypatch.setattr(ehr_metrics, "attributed", None)
+        lab.LabValue
+
+    statements = ehr_metrics.snapshot()["statements"]
+    assert ehr_metrics.UNATTRIBUTED not in statements
+    lab_value = statements["Lab.LabValue"][
+        ehr_metrics.statement_key(schema.SELECT_LAB_VALUE)
+    ]
+    assert lab_value["count"] == 2
+    assert sum(lab_value["buckets"].values()) == 2
+    assert lab_value["total_seconds"] > 0
+    assert list(statements["Patient.age"]) == [
+        ehr_metrics.statement_key(schema.SELECT_BIRTH_DATE)
+    ]
+    assert json.loads(ehr_metrics.to_json()) == ehr_metrics.snapshot()
+
+
+def test_counters(tmp_path: pathlib.Path) -> None:
+    """Test that connection opens and strptime calls are counted."""
+    with ehr_metrics.recording():
+        with using_database(str(tmp_path / "ehr.db")) as manager:
+            manager.connection()
+            manager.connection()
+        parse_datetime("2023-04-17 10:00:00.123")
+        parse_datetime("2023-04-17 10:00:00.1")
+    assert ehr_metrics.snapshot()["counters"] == {
+        "connection_opens": 1,
+        "strptime_calls": 1,
+    }
@@ -2,11 +2,22 @@
 from ehr_module import parse_data
 import ehr_module
 from ehr_module import Patient, Lab
+from datetime import datetime
+import pathlib
+from benchmarks.synthetic import write_synthetic_files
+import ehr_cache
+from ehr_cache import using_as_of
+from ehr_connection import get_manager, using_database
+import ehr_metrics
+from tsv_reader import read_rows
+from ehr_dates import from_epoch_us
+import ehr_schema
 from fake_files import fake_files
 import sqlite3
+import pytest
 
 
-def test_parse_data_Patients() -> None:
+def test_parse_data_Patients(tmp_database: str) -> None:
     """Test the parse data function for correct Patient information."""
 
     fake_patient = [
@@ -54,7 +65,7 @@ def test_parse_data_Patients() -> None:
         assert patient.patient_id == "FB2ABB23-C9D0-4D09-8464-49BF0B982F0F"
 
 
-def test_parse_data_Labs() -> None:
+def test_parse_data_Labs(tmp_database: str) -> None:
     """Test the parse data function for correct Labs."""
 
     fake_patient = [
@@ -109,13 +120,73 @@ def test_parse_data_Labs() -> None:
         patient = patient_records[0]
         lab_1 = patient.patient_labs[0]
         lab_2 = patient.patient_labs[1]
-        assert lab_1.LabValue == "1.8"
-        assert lab_2.LabValue == "3.2"
+        assert lab_1.LabValue == 1.8
+        assert lab_2.LabValue == 3.2
 
 
-def test_patient_age() -> None:
+def test_parse_data_lazy_labs(tmp_database: str) -> None:
+    """Test that lazy labs read from the database and can be hydrated."""
+    fake_patient = [
+        [
+            "PatientID",
+            "PatientGender",
+            "PatientDateOfBirth",
+            "PatientRace",
+            "PatientMaritalStatus",
+            "PatientLanguage",
+            "PatientPopulationPercentageBelowPoverty",
+        ],
+        [
+            "FB2ABB23-C9D0-4D09-8464-49BF0B982F0F",
+            "Male",
+            "1947-12-28 02:45:40.547",
+            "Unknown",
+            "Married",
+            "Icelandic",
+            "18.08",
+        ],
+    ]
+    fake_lab = [
+        [
+            "PatientID",
+            "AdmissionID",
+            "LabName",
+            "LabValue",
+            "LabUnits",
+            "LabDateTime",
+        ],
+        [
+            "FB2ABB23-C9D0-4D09-8464-49BF0B982F0F",
+            "1",
+            "URINALYSIS: RED BLOOD CELLS",
+            "1.8",
+            "rbc/hpf",
+            "1992-07-01 01:36:17.910",
+        ],
+    ]
+    with fake_files(fake_patient, fake_lab) as filenames:
+        patient = parse_data(filenames[0], filenames[1], lazy=True)[0]
+    # Lazy patients read their labs from the database on every access
+    labs = patient.patient_labs
+    lab = labs[0]
+    assert not lab.hydrated
+    assert lab.LabValue == 1.8
+    assert lab.LabDateTime == datetime(1992, 7, 1, 1, 36, 17, 910000)
+    assert isinstance(patient.lab_index, ehr_module.DatabaseLabIndex)
+    assert patient.patient_labs[0] is not lab
+
+    ehr_module.hydrate_labs(labs)
+    assert lab.hydrated
+    assert lab.LabName == "URINALYSIS: RED BLOOD CELLS"
+    assert lab.LabUnits == "rbc/hpf"
+    assert lab.LabValue == 1.8
+    assert not hasattr(lab, "__dict__")
+
+
+def test_patient_age(tmp_path: pathlib.Path) -> None:
     """Test patient age."""
-    connection = sqlite3.connect("test_patient_age_database.db")
+    database = str(tmp_path / "ehr.db")
+    connection = sqlite3.connect(database)
     cursor = connection.cursor()
     cursor.execute("DROP TABLE IF EXISTS patients")
     cursor.execute("DROP TABLE IF EXISTS labs")
@@ -175,12 +246,14 @@ def test_patient_age() -> None:
     lab_1 = Lab("FB2ABB23-C9D0-4D09-8464-49BF0B982F0F", "0")
     patient = Patient("FB2ABB23-C9D0-4D09-8464-49BF0B982F0F", [lab_1])
 
-    assert patient.age == 75
+    with using_database(database), using_as_of(datetime(2023, 1, 1)):
+        assert patient.age == 75
 
 
-def test_is_sick() -> None:
+def test_is_sick(tmp_path: pathlib.Path) -> None:
     """Test patient is_sick."""
-    connection = sqlite3.connect("test_is_sick_database.db")
+    database = str(tmp_path / "ehr.db")
+    connection = sqlite3.connect(database)
     cursor = connection.cursor()
     cursor.execute("DROP TABLE IF EXISTS patients")
     cursor.execute("DROP TABLE IF EXISTS labs")
@@ -240,21 +313,23 @@ def test_is_sick() -> None:
     lab_1 = Lab("FB2ABB23-C9D0-4D09-8464-49BF0B982F0F", "0")
     patient = Patient("FB2ABB23-C9D0-4D09-8464-49BF0B982F0F", [lab_1])
 
-    assert not patient.is_sick(
-        "URINALYSIS: RED BLOOD CELLS",
-        ">",
-        4.0,
-    )
-    assert patient.is_sick(
-        "URINALYSIS: RED BLOOD CELLS",
-        "<",
-        4.0,
-    )
+    with using_database(database):
+        assert not patient.is_sick(
+            "URINALYSIS: RED BLOOD CELLS",
+            ">",
+            4.0,
+        )
+        assert patient.is_sick(
+            "URINALYSIS: RED BLOOD CELLS",
+            "<",
+            4.0,
+        )
 
 
-def test_patient_initial_age() -> None:
+def test_patient_initial_age(tmp_path: pathlib.Path) -> None:
     """Test patient initial age."""
-    connection = sqlite3.connect("test_initial_age_database.db")
+    database = str(tmp_path / "ehr.db")
+    connection = sqlite3.connect(database)
     cursor = connection.cursor()
     cursor.execute("DROP TABLE IF EXISTS patients")
     cursor.execute("DROP TABLE IF EXISTS labs")
@@ -314,4 +389,248 @@ def test_patient_initial_age() -> None:
     lab_1 = Lab("FB2ABB23-C9D0-4D09-8464-49BF0B982F0F", "0")
     patient = Patient("FB2ABB23-C9D0-4D09-8464-49BF0B982F0F", [lab_1])
 
-    assert patient.initial_age() == 44
+    with using_database(database):
+        assert patient.initial_age() == 44
+
+
+def test_bulk_load_lab_file(tmp_database: str) -> None:
+    """Test bulk loading the lab file in small chunks."""
+    fake_lab = [
+        [
+            "LabName",
+            "PatientID",
+            "AdmissionID",
+            "LabValue",
+            "LabUnits",
+            "LabDateTime",
+        ],
+        [
+            "URINALYSIS: RED BLOOD CELLS",
+            "FB2ABB23-C9D0-4D09-8464-49BF0B982F0F",
+            "1",
+            "1.8",
+            "rbc/hpf",
+            "1992-07-01 01:36:17.910",
+        ],
+        [
+            "METABOLIC: ALBUMIN",
+            "FB2ABB23-C9D0-4D09-8464-49BF0B982F0F",
+            "1",
+            "4.1",
+            "gm/dL",
+            "1992-07-01 01:36:17.910",
+        ],
+        [
+            "METABOLIC: ALBUMIN",
+            "64182B95-EB72-4E2B-BE77-8050B71498CE",
+            "2",
+            "3.2",
+            "gm/dL",
+            "1993-01-04 11:02:03.110",
+        ],
+    ]
+    connection = sqlite3.connect(tmp_database)
+    cursor = connection.cursor()
+    ehr_schema.create_tables(cursor)
+    connection.commit()
+    with fake_files(fake_lab) as filenames:
+        report = ehr_module.bulk_load_lab_file(filenames[0], chunk_size=2)
+
+    assert report.rows == 3
+    assert report.rows_per_second > 0
+    rows = cursor.execute(
+        """SELECT LabID, LabName, LabValue, LabDateTime
+        FROM labs JOIN lab_names USING (LabNameKey)
+        ORDER BY LabID"""
+    ).fetchall()
+    connection.close()
+    assert [row[:3] for row in rows] == [
+        (0, "URINALYSIS: RED BLOOD CELLS", 1.8),
+        (1, "METABOLIC: ALBUMIN", 4.1),
+        (2, "METABOLIC: ALBUMIN", 3.2),
+    ]
+    assert from_epoch_us(rows[2][3]) == datetime(1993, 1, 4, 11, 2, 3, 110000)
+
+
+def test_is_sick_by_lab_name(tmp_database: str) -> None:
+    """Test is_sick for one patient and for the whole cohort."""
+    fake_patient = [
+        [
+            "PatientID",
+            "PatientGender",
+            "PatientDateOfBirth",
+            "PatientRace",
+            "PatientMaritalStatus",
+            "PatientLanguage",
+            "PatientPopulationPercentageBelowPoverty",
+        ],
+        [
+            "FB2ABB23-C9D0-4D09-8464-49BF0B982F0F",
+            "Male",
+            "1947-12-28 02:45:40.547",
+            "Unknown",
+            "Married",
+            "Icelandic",
+            "18.08",
+        ],
+        [
+            "64182B95-EB72-4E2B-BE77-8050B71498CE",
+            "Female",
+            "1952-01-18 19:51:12.917",
+            "African American",
+            "Separated",
+            "English",
+            "13.03",
+        ],
+    ]
+    fake_lab = [
+        [
+            "PatientID",
+            "AdmissionID",
+            "LabName",
+            "LabValue",
+            "LabUnits",
+            "LabDateTime",
+        ],
+        [
+            "FB2ABB23-C9D0-4D09-8464-49BF0B982F0F",
+            "1",
+            "URINALYSIS: RED BLOOD CELLS",
+            "1.8",
+            "rbc/hpf",
+            "1992-07-01 01:36:17.910",
+        ],
+        [
+            "FB2ABB23-C9D0-4D09-8464-49BF0B982F0F",
+            "1",
+            "METABOLIC: ALBUMIN",
+            "4.6",
+            "gm/dL",
+            "1992-07-01 01:36:17.910",
+        ],
+        [
+            "64182B95-EB72-4E2B-BE77-8050B71498CE",
+            "1",
+            "METABOLIC: ALBUMIN",
+            "3.2",
+            "gm/dL",
+            "1993-01-04 11:02:03.110",
+        ],
+    ]
+    with fake_files(fake_patient, fake_lab) as filenames:
+        patient_1, patient_2 = parse_data(filenames[0], filenames[1])
+
+    assert patient_1.is_sick("METABOLIC: ALBUMIN", ">", 4.0)
+    assert not patient_1.is_sick("METABOLIC: ALBUMIN", "<", 4.0)
+    assert not patient_2.is_sick("URINALYSIS: RED BLOOD CELLS", "<", 4.0)
+    assert ehr_module.cohort_is_sick("METABOLIC: ALBUMIN", "<", 4.0) == {
+        "FB2ABB23-C9D0-4D09-8464-49BF0B982F0F": False,
+        "64182B95-EB72-4E2B-BE77-8050B71498CE": True,
+    }
+    assert ehr_module.cohort_is_sick(
+        "URINALYSIS: RED BLOOD CELLS", ">", 1
+    ) == {
+        "FB2ABB23-C9D0-4D09-8464-49BF0B982F0F": True,
+        "64182B95-EB72-4E2B-BE77-8050B71498CE": False,
+    }
+    with pytest.raises(ValueError):
+        patient_1.is_sick("METABOLIC: ALBUMIN", "=", 4.0)
+
+
+def test_patient_demographics(tmp_path: pathlib.Path) -> None:
+    """Test reading demographics from cohorts and in prefetched pages."""
+    patient_filename = str(tmp_path / "patients.txt")
+    lab_filename = str(tmp_path / "labs.txt")
+    write_synthetic_files(patient_filename, lab_filename, 2_500)
+    expected = {
+        row[0]: (row[1], row[3], row[4], row[5], float(row[6]))
+        for row in read_rows(patient_filename, ehr_schema.PATIENT_COLUMNS)
+    }
+
+    def demographics(patient: Patient) -> tuple[object, ...]:
+        return (
+            patient.gender,
+            patient.race,
+            patient.marital_status,
+            patient.language,
+            patient.poverty,
+        )
+
+    with using_database(str(tmp_path / "ehr.db")), ehr_metrics.recording():
+        patients = parse_data(patient_filename, lab_filename)
+        ehr_metrics.reset()
+        # Cohort patients read the cohort arrays without any query
+        assert {p.patient_id: demographics(p) for p in patients} == expected
+        assert ehr_metrics.snapshot()["statements"] == {}
+
+        standalone = [Patient(p.patient_id) for p in patients]
+        ehr_module.prefetch_demographics(standalone, page_size=10)
+        assert {p.patient_id: demographics(p) for p in standalone} == expected
+        pages = ehr_metrics.snapshot()["statements"]["Patient.demographics"]
+        assert [page["count"] for page in pages.values()] == [2, 1]
+        assert len(patients) == 25
+
+        with get_manager().transaction() as cursor:
+            cursor.execute(
+                "UPDATE patients SET PatientLanguage=NULL WHERE PatientID=?",
+                (patients[0].patient_id,),
+            )
+        ehr_cache.invalidate()
+        assert standalone[0].language is None
+        assert Patient(patients[0].patient_id).language is None
+        with pytest.raises(KeyError):
+            Patient("unknown").gender
+
+        # An unknown patient only fails when their own fields are read
+        known, unknown = Patient(patients[1].patient_id), Patient("unknown")
+        ehr_module.prefetch_demographics([unknown, known])
+        assert known.gender == expected[known.patient_id][0]
+        with pytest.raises(KeyError):
+            unknown.gender
+
+    columnar = ehr_module.parse_columnar(patient_filename, lab_filename)
+    assert {p.patient_id: demographics(p) for p in columnar} == expected
+
+
+def test_missing_demographics(tmp_path: pathlib.Path) -> None:
+    """Test that every path reads missing demographics as None."""
+    fake_patient = [
+        list(ehr_schema.PATIENT_COLUMNS),
+        ["A", "", "1947-12-28 02:45:40.547", "", "", "", ""],
+    ]
+    fake_lab = [
+        list(ehr_schema.LAB_COLUMNS),
+        ["A", "1", "METABOLIC: ALBUMIN", "4.6", "gm/dL"]
+        + ["1992-07-01 01:36:17.910"],
+    ]
+
+    def demographics(patient: Patient) -> tuple[object, ...]:
+        return (
+            patient.gender,
+            patient.race,
+            patient.marital_status,
+            patient.language,
+            patient.poverty,
+        )
+
+    missing = (None,) * 5
+    with using_database(str(tmp_path / "ehr.db")), fake_files(
+        fake_patient, fake_lab
+    ) as filenames:
+        (cohort_patient,) = parse_data(*filenames)
+        prefetched = Patient("A")
+        ehr_module.prefetch_demographics([prefetched])
+        assert demographics(cohort_patient) == missing
+        assert demographics(Patient("A")) == missing
+        assert demographics(prefetched) == missing
+
+        # Databases loaded before blanks were stored as NULL hold ""
+        with get_manager().transaction() as cursor:
+            cursor.execute(
+                """UPDATE patients
+                SET PatientGender='',
+                    PatientPopulationPercentageBelowPoverty=''"""
+            )
+        ehr_cache.invalidate()
+        assert demographics(Patient("A")) == missing
+        assert demographics(prefetched) == missing
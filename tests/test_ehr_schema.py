@@ -0,0 +1,140 @@
+"""Testing the EHR schema."""
+import pathlib
+import sqlite3
+import pytest
+import ehr_schema
+
+
+def test_accessor_queries_use_indexes(
+    tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Test that accessor lookups only avoid full scans once indexed."""
+    connection = sqlite3.connect(tmp_path / "ehr.db")
+    cursor = connection.cursor()
+    ehr_schema.create_tables(cursor)
+
+    scans = ehr_schema.full_table_scans(connection)
+    assert "Patient.initial_age" in scans
+    assert "Patient.is_sick" in scans
+    # Labs are keyed by LabID and patients by PatientID
+    assert "Lab.LabValue" not in scans
+    assert "Patient.age" not in scans
+
+    ehr_schema.create_indexes(cursor)
+    assert ehr_schema.full_table_scans(connection) == {}
+
+    # Reading every entry of a covering index is still a full scan
+    covering = ehr_schema.explain_query_plan(
+        connection, "SELECT PatientKey FROM labs", ()
+    )
+    assert covering[0].startswith("SCAN labs USING COVERING INDEX")
+    monkeypatch.setitem(
+        ehr_schema.ACCESSOR_QUERIES,
+        "labs",
+        ("SELECT PatientKey FROM labs", ()),
+    )
+    assert ehr_schema.full_table_scans(connection) == {"labs": covering}
+
+    plan = ehr_schema.explain_query_plan(
+        connection,
+        "SELECT LabValue FROM labs WHERE LabNameKey=? AND PatientKey=?",
+        ("0", "0"),
+    )
+    assert plan == [
+        "SEARCH labs USING COVERING INDEX labs_lab_name_key_patient_key "
+        "(LabNameKey=? AND PatientKey=?)"
+    ]
+    connection.close()
+
+
+def test_migrate_varchar_tables(tmp_path: pathlib.Path) -> None:
+    """Test converting the older VARCHAR tables to the typed schema."""
+    connection = sqlite3.connect(tmp_path / "ehr.db")
+    connection.execute(
+        "CREATE TABLE patients (PatientID VARCHAR, PatientGender VARCHAR, "
+        "PatientDateOfBirth VARCHAR, PatientRace VARCHAR, "
+        "PatientMaritalStatus VARCHAR, PatientLanguage VARCHAR, "
+        "PatientPopulationPercentageBelowPoverty VARCHAR)"
+    )
+    connection.execute(
+        "CREATE TABLE labs (PatientID VARCHAR, AdmissionID VARCHAR, "
+        "LabName VARCHAR, LabValue VARCHAR, LabUnits VARCHAR, "
+        "LabDateTime VARCHAR, LabID VARCHAR)"
+    )
+    connection.execute(
+        "INSERT INTO patients VALUES "
+        "('A', 'Male', '1970-01-01 00:00:01.000', '', '', '', '18.08')"
+    )
+    connection.executemany(
+        "INSERT INTO labs VALUES (?, '1', ?, ?, 'gm/dL', ?, ?)",
+        [
+            ("A", "METABOLIC: ALBUMIN", "4.6", "1970-01-01 00:00:02.000", "5"),
+            ("B", "METABOLIC: ALBUMIN", "3.1", "1970-01-01 00:00:03.000", "7"),
+        ],
+    )
+    connection.commit()
+
+    assert ehr_schema.migrate(connection)
+    assert not ehr_schema.migrate(connection)
+    assert connection.execute("PRAGMA user_version").fetchone()[0] == 2
+    assert (
+        connection.execute(
+            """SELECT LabID, PatientID, AdmissionID, LabName, LabValue,
+            LabUnits, LabDateTime
+        FROM labs
+        JOIN patients USING (PatientKey)
+        JOIN lab_names USING (LabNameKey)
+        JOIN lab_units USING (LabUnitsKey)"""
+        ).fetchall()
+        == [
+            (5, "A", 1, "METABOLIC: ALBUMIN", 4.6, "gm/dL", 2_000_000),
+            (7, "B", 1, "METABOLIC: ALBUMIN", 3.1, "gm/dL", 3_000_000),
+        ]
+    )
+    assert (
+        connection.execute(
+            """SELECT PatientID, PatientDateOfBirth,
+            PatientPopulationPercentageBelowPoverty
+        FROM patients"""
+        ).fetchall()
+        == [("A", 1_000_000, 18.08), ("B", None, None)]
+    )
+    assert ehr_schema.full_table_scans(connection) == {}
+    connection.close()
+
+
+def test_blank_values_are_null(tmp_path: pathlib.Path) -> None:
+    """Test that blank file values are stored as NULL, not as text."""
+    connection = sqlite3.connect(tmp_path / "ehr.db")
+    cursor = connection.cursor()
+    ehr_schema.create_tables(cursor)
+    ehr_schema.upsert_patients(
+        cursor,
+        [
+            ("A", "", "", "", "", "", ""),
+            ("B", "Male", "", "White", "", "English", "13.03"),
+        ],
+    )
+    ehr_schema.insert_labs(
+        cursor,
+        [("A", "1", "METABOLIC: ALBUMIN", "", "gm/dL", "", "0")],
+    )
+    assert (
+        cursor.execute(
+            f"""SELECT {', '.join(ehr_schema.PATIENT_COLUMNS)}
+        FROM patients"""
+        ).fetchall()
+        == [
+            ("A", None, None, None, None, None, None),
+            ("B", "Male", None, "White", None, "English", 13.03),
+        ]
+    )
+    assert (
+        cursor.execute(
+            """SELECT typeof(PatientPopulationPercentageBelowPoverty)
+        FROM patients"""
+        ).fetchall()
+        == [("null",), ("real",)]
+    )
+    assert cursor.execute("SELECT LabValue FROM labs").fetchall() == [(None,)]
+    connection.close()
@@ -0,0 +1,82 @@
+"""Testing the binary snapshots."""
+from datetime import datetime
+import os
+import pathlib
+import numpy as np
+import pytest
+from benchmarks.synthetic import write_synthetic_files
+from ehr_cohort import EHRCohort
+from ehr_module import cohort_patient, parse_columnar
+from ehr_snapshot import open_snapshot, write_snapshot
+
+AS_OF = datetime(2023, 1, 1)
+
+
+def test_snapshot_round_trip(tmp_path: pathlib.Path) -> None:
+    """Test that an opened snapshot answers like the original cohort."""
+    patient_filename = str(tmp_path / "patients.txt")
+    lab_filename = str(tmp_path / "labs.txt")
+    write_synthetic_files(patient_filename, lab_filename, 2_000)
+    patients = parse_columnar(patient_filename, lab_filename)
+    cohort = patients[0].cohort
+    assert cohort is not None
+
+    write_snapshot(str(tmp_path / "snapshot"), cohort)
+    opened = open_snapshot(str(tmp_path / "snapshot"))
+
+    assert isinstance(opened.birth_dates, np.memmap)
+    assert opened.store is not None and isinstance(
+        opened.store.values, np.memmap
+    )
+    assert list(opened.patient_ids) == list(cohort.patient_ids)
+    assert (opened.ages() == cohort.ages()).all()
+    assert (opened.initial_ages() == cohort.initial_ages()).all()
+    lab = ("METABOLIC: ALBUMIN", "<", 3.5)
+    assert (opened.is_sick(*lab) == cohort.is_sick(*lab)).all()
+
+    patient = patients[3]
+    opened_patient = cohort_patient(opened, patient.patient_id)
+    assert [
+        (lab.LabID, lab.LabName, lab.LabValue, lab.LabDateTime)
+        for lab in opened_patient.patient_labs
+    ] == [
+        (lab.LabID, lab.LabName, lab.LabValue, lab.LabDateTime)
+        for lab in patient.patient_labs
+    ]
+    assert opened_patient.initial_age() == patient.initial_age()
+    assert opened_patient.is_sick(*lab) == patient.is_sick(*lab)
+
+
+def test_incomplete_snapshot(tmp_path: pathlib.Path) -> None:
+    """Test that a snapshot without a header cannot be opened."""
+    (tmp_path / "values.npy").write_bytes(b"")
+    with pytest.raises(FileNotFoundError):
+        open_snapshot(str(tmp_path))
+
+
+def test_overwrite_open_snapshot(tmp_path: pathlib.Path) -> None:
+    """Test that rewriting a snapshot leaves mapped readers intact."""
+    patient_filename = str(tmp_path / "patients.txt")
+    lab_filename = str(tmp_path / "labs.txt")
+    write_synthetic_files(patient_filename, lab_filename, 200)
+    cohort = parse_columnar(patient_filename, lab_filename)[0].cohort
+    assert cohort is not None
+    directory = str(tmp_path / "snapshot")
+    write_snapshot(directory, cohort)
+    opened = open_snapshot(directory)
+    ages = np.array(opened.ages(AS_OF))
+
+    write_snapshot(directory, cohort.subset(np.arange(1)))
+    assert (opened.ages(AS_OF) == ages).all()
+    assert len(open_snapshot(directory)) == 1
+    assert all(
+        name.endswith((".npy", ".json")) for name in os.listdir(directory)
+    )
+
+
+def test_database_cohort_is_rejected(tmp_path: pathlib.Path) -> None:
+    """Test that a cohort without a lab store cannot be saved."""
+    cohort = EHRCohort([], np.array([], dtype="datetime64[us]"), np.array([]))
+    with pytest.raises(ValueError, match="from_database"):
+        write_snapshot(str(tmp_path / "snapshot"), cohort)
+    assert not (tmp_path / "snapshot").exists()
@@ -0,0 +1,136 @@
+"""Testing the incremental ingest."""
+import pathlib
+import pytest
+from ehr_connection import using_database
+from ehr_module import parse_data, Patient
+from incremental_ingest import hash_file, ingest_incremental
+
+PATIENT_HEADER = (
+    "PatientID\tPatientGender\tPatientDateOfBirth\tPatientRace\t"
+    "PatientMaritalStatus\tPatientLanguage\t"
+    "PatientPopulationPercentageBelowPoverty\n"
+)
+LAB_HEADER = (
+    "PatientID\tAdmissionID\tLabName\tLabValue\tLabUnits\tLabDateTime\n"
+)
+
+
+def test_hash_file(tmp_path: pathlib.Path) -> None:
+    """Test hashing a file and its prefix in one pass."""
+    filename = tmp_path / "labs.txt"
+    filename.write_bytes(b"abcdef")
+    prefix = tmp_path / "prefix.txt"
+    prefix.write_bytes(b"abc")
+    state = hash_file(str(filename), 3)
+    assert state.size == 6
+    assert state.prefix_hash == hash_file(str(prefix)).content_hash
+    assert hash_file(str(filename), 10).prefix_hash is None
+
+
+def test_ingest_incremental(tmp_path: pathlib.Path) -> None:
+    """Test appending labs and upserting patients after parse_data."""
+    patients = tmp_path / "patients.txt"
+    labs = tmp_path / "labs.txt"
+    patients.write_text(
+        PATIENT_HEADER + "A\tMale\t1947-12-28 02:45:40.547\tWhite\tSingle\t"
+        "English\t18.08\n"
+    )
+    labs.write_text(
+        LAB_HEADER + "A\t1\tMETABOLIC: ALBUMIN\t4.6\tgm/dL\t"
+        "1992-07-01 01:36:17.910\n"
+    )
+    with using_database(str(tmp_path / "ehr.db")) as manager:
+        parse_data(str(patients), str(labs))
+        assert ingest_incremental(str(patients), str(labs)) == (
+            0,
+            0,
+            [str(labs), str(patients)],
+        )
+
+        with labs.open("a") as lab_file:
+            lab_file.write(
+                "A\t2\tMETABOLIC: ALBUMIN\t3.1\tgm/dL\t"
+                "1990-01-01 00:00:00.000\n"
+                "B\t1\tMETABOLIC: ALBUMIN\t3.9\tgm/dL\t"
+                "1995-01-01 00:00:00.000\n"
+            )
+        patients.write_text(
+            PATIENT_HEADER + "A\tMale\t1947-12-28 02:45:40.547\tWhite\t"
+            "Married\tEnglish\t18.08\n"
+            "B\tFemale\t1952-01-18 19:51:12.917\tAsian\tSingle\tThai\t13.03\n"
+        )
+        assert ingest_incremental(str(patients), str(labs)) == (2, 2, [])
+
+        cursor = manager.connection().cursor()
+        assert (
+            cursor.execute(
+                """SELECT LabID, PatientID, LabValue
+            FROM labs JOIN patients USING (PatientKey)
+            ORDER BY LabID"""
+            ).fetchall()
+            == [
+                (0, "A", 4.6),
+                (1, "A", 3.1),
+                (2, "B", 3.9),
+            ]
+        )
+        assert cursor.execute(
+            "SELECT PatientID, PatientMaritalStatus FROM patients"
+        ).fetchall() == [("A", "Married"), ("B", "Single")]
+        assert Patient("A", []).initial_age() == 42
+
+        # The same content under another name is not loaded twice
+        copy = tmp_path / "labs_copy.txt"
+        copy.write_bytes(labs.read_bytes())
+        assert ingest_incremental(str(patients), str(copy)).skipped == [
+            str(copy),
+            str(patients),
+        ]
+
+        # A rewritten lab file is refused rather than appended again
+        labs.write_text(
+            LAB_HEADER + "A\t1\tMETABOLIC: ALBUMIN\t4.7\tgm/dL\t"
+            "1992-07-01 01:36:17.910\n"
+        )
+        with pytest.raises(ValueError, match="changed"):
+            ingest_incremental(str(patients), str(labs))
+        assert cursor.execute("SELECT COUNT(*) FROM labs").fetchone() == (3,)
+
+
+def test_parsed_patients_see_ingested_rows(tmp_path: pathlib.Path) -> None:
+    """Test that parse_data patients read the rows ingested after it."""
+    for lazy in (False, True):
+        patients = tmp_path / f"patients_{lazy}.txt"
+        labs = tmp_path / f"labs_{lazy}.txt"
+        patients.write_text(
+            PATIENT_HEADER + "A\tMale\t1947-12-28 02:45:40.547\tWhite\t"
+            "Single\tEnglish\t18.08\n"
+        )
+        labs.write_text(
+            LAB_HEADER + "A\t1\tMETABOLIC: ALBUMIN\t4.6\tgm/dL\t"
+            "1992-07-01 01:36:17.910\n"
+        )
+        with using_database(str(tmp_path / f"ehr_{lazy}.db")):
+            (patient,) = parse_data(str(patients), str(labs), lazy)
+            assert patient.initial_age() == 44
+            assert patient.marital_status == "Single"
+            assert not patient.is_sick("METABOLIC: ALBUMIN", "<", 3.5)
+            assert len(patient.patient_labs) == 1
+
+            with labs.open("a") as lab_file:
+                lab_file.write(
+                    "A\t2\tMETABOLIC: ALBUMIN\t3.1\tgm/dL\t"
+                    "1960-01-01 00:00:00.000\n"
+                )
+            patients.write_text(
+                PATIENT_HEADER + "A\tMale\t1947-12-28 02:45:40.547\tWhite\t"
+                "Married\tEnglish\t18.08\n"
+            )
+            ingest_incremental(str(patients), str(labs))
+
+            assert patient.initial_age() == Patient("A").initial_age() == 12
+            assert patient.marital_status == "Married"
+            assert patient.is_sick("METABOLIC: ALBUMIN", "<", 3.5)
+            assert [lab.LabValue for lab in patient.patient_labs] == [3.1, 4.6]
+            assert patient.cohort is not None
+            assert not patient.cohort.stale
@@ -0,0 +1,69 @@
+"""Testing the lab name and units dictionary."""
+import pathlib
+import sqlite3
+from benchmarks.synthetic import write_synthetic_files
+from ehr_connection import using_database
+from ehr_module import parse_data
+from lab_dictionary import Categories, from_table, key_codes
+from lab_store import LabStore
+
+
+def test_categories() -> None:
+    """Test that strings are coded in order of first appearance."""
+    categories = Categories(["mg/dL", "gm/dL"])
+    assert categories.encode(["gm/dL", "k/cumm", "gm/dL"]).tolist() == [
+        1,
+        2,
+        1,
+    ]
+    assert categories.values == ["mg/dL", "gm/dL", "k/cumm"]
+    assert categories.decode([2, 0]) == ["k/cumm", "mg/dL"]
+    assert categories.find("mmol/L") == -1 and "mmol/L" not in categories
+    name = "".join(["CBC: ", "HEMOGLOBIN"])
+    assert categories.intern(name) is categories.intern("CBC: HEMOGLOBIN")
+
+
+def test_key_codes() -> None:
+    """Test that database keys map to the codes of their strings."""
+    connection = sqlite3.connect(":memory:")
+    connection.executescript(
+        """CREATE TABLE lab_units (LabUnitsKey INTEGER PRIMARY KEY,
+            LabUnits TEXT);
+        INSERT INTO lab_units VALUES (4, 'gm/dL'), (2, 'mg/dL');"""
+    )
+    units = from_table(
+        connection.cursor(),
+        "SELECT LabUnitsKey, LabUnits FROM lab_units ORDER BY LabUnitsKey",
+    )
+    assert units.values == ["mg/dL", "gm/dL"]
+    assert key_codes(units).tolist() == [-1, -1, 0, -1, 1]
+
+
+def test_store_from_codes(tmp_path: pathlib.Path) -> None:
+    """Test that a store read as keys matches the parsed labs."""
+    patient_filename = str(tmp_path / "patients.txt")
+    lab_filename = str(tmp_path / "labs.txt")
+    write_synthetic_files(patient_filename, lab_filename, 1_000)
+    with using_database(str(tmp_path / "ehr.db")) as manager:
+        patients = parse_data(patient_filename, lab_filename)
+        store = LabStore.from_database()
+        name_keys = manager.connection().execute(
+            "SELECT DISTINCT typeof(LabNameKey), typeof(LabUnitsKey) FROM labs"
+        )
+        assert name_keys.fetchall() == [("integer", "integer")]
+
+    labs = [lab for patient in patients for lab in patient.patient_labs]
+    assert len(store) == len(labs)
+    by_id = {int(lab.LabID): lab for lab in labs}
+    for row in range(len(store)):
+        lab = by_id[int(store.lab_ids[row])]
+        name, value, units, _ = store.lab_fields(row)
+        assert (name, value, units) == (
+            lab.LabName,
+            lab.LabValue,
+            lab.LabUnits,
+        )
+    # Labs share one copy of each lab name
+    assert len({id(lab.LabName) for lab in labs}) == len(
+        {lab.LabName for lab in labs}
+    )
@@ -0,0 +1,83 @@
+"""Testing the lab trends."""
+import pathlib
+import numpy as np
+from benchmarks.synthetic import write_synthetic_files
+from ehr_connection import using_database
+from ehr_dates import from_epoch_us
+from ehr_module import bulk_load_lab_file
+from ehr_schema import create_tables
+from lab_series import LabSeries, LabTrendStream, TrendUpdate
+from lab_store import LabStore
+
+ALBUMIN = "METABOLIC: ALBUMIN"
+STORE = LabStore.from_columns(
+    ["B", "A", "A", "A", "A", "A"],
+    range(6),
+    [ALBUMIN, ALBUMIN, "CBC: HEMOGLOBIN", ALBUMIN, ALBUMIN, ALBUMIN],
+    [3.0, 4.0, 12.0, 2.0, 6.0, 5.0],
+    ["gm/dL", "gm/dL", "gm/dL", "gm/dL", "gm/dL", "gm/dL"],
+    [
+        "2000-01-01 00:00:00.000",
+        "2000-01-10 00:00:00.000",
+        "2000-01-01 00:00:00.000",
+        "2000-01-01 00:00:00.000",
+        "2000-01-11 00:00:00.000",
+        "2000-01-20 00:00:00.000",
+    ],
+)
+
+
+def test_latest_values_and_deltas() -> None:
+    """Test latest values and deltas of date-ordered groups."""
+    series = LabSeries(STORE)
+    # Lab names are in order of first appearance
+    assert series.values.tolist() == [2.0, 4.0, 6.0, 5.0, 12.0, 3.0]
+    assert series.latest_values() == {
+        "A": {"CBC: HEMOGLOBIN": 12.0, ALBUMIN: 5.0},
+        "B": {ALBUMIN: 3.0},
+    }
+    deltas = series.deltas()
+    assert np.isnan(deltas[[0, 4, 5]]).all()
+    assert deltas[[1, 2, 3]].tolist() == [2.0, 2.0, -1.0]
+
+
+def test_rolling_means() -> None:
+    """Test that windows exclude labs exactly the window before."""
+    series = LabSeries(STORE, ALBUMIN)
+    assert len(series) == 5
+    assert series.window_starts(10).tolist() == [0, 0, 1, 2, 4]
+    assert series.rolling_means(10).tolist() == [2.0, 3.0, 5.0, 5.5, 3.0]
+    assert series.rolling_means(0).tolist() == series.values.tolist()
+
+
+def test_stream_matches_series(tmp_path: pathlib.Path) -> None:
+    """Test that the streaming trends agree with the bulk ones."""
+    patient_filename = str(tmp_path / "patients.txt")
+    lab_filename = str(tmp_path / "labs.txt")
+    write_synthetic_files(patient_filename, lab_filename, 3_000)
+    series = LabSeries(LabStore.from_file(lab_filename))
+
+    updates: list[TrendUpdate] = []
+    stream = LabTrendStream(30, updates.append)
+    with using_database(str(tmp_path / "ehr.db")) as manager:
+        with manager.transaction() as cursor:
+            create_tables(cursor)
+        bulk_load_lab_file(lab_filename, on_chunk=stream.add_rows)
+    assert len(updates) == len(series)
+    assert stream.latest_values() == series.latest_values()
+
+    # Added in date order, every lab's trends match the bulk ones
+    stream = LabTrendStream(30)
+    means = []
+    deltas = []
+    for row in range(len(series)):
+        update = stream.add(
+            str(series.store.patient_ids[series.patient_positions[row]]),
+            series.store.names[series.name_codes[row]],
+            from_epoch_us(int(series.timestamps[row])),
+            float(series.values[row]),
+        )
+        means.append(update.rolling_mean)
+        deltas.append(np.nan if update.delta is None else update.delta)
+    assert np.allclose(means, series.rolling_means(30))
+    assert np.allclose(deltas, series.deltas(), equal_nan=True)
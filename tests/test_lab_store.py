@@ -0,0 +1,69 @@
+"""Testing the columnar lab store."""
+from datetime import datetime
+import numpy as np
+from ehr_module import parse_columnar
+from fake_files import (
+    FAKE_LAB,
+    FAKE_PATIENT,
+    LAB_HEADER,
+    PATIENT_HEADER,
+    fake_files,
+)
+from lab_store import LabStore
+
+PATIENTS = [PATIENT_HEADER, FAKE_PATIENT[2], FAKE_PATIENT[1]]
+LABS = [
+    LAB_HEADER,
+    ["B", "1", "METABOLIC: ALBUMIN", "3.2", "gm/dL"]
+    + ["1993-01-04 11:02:03.110"],
+    FAKE_LAB[1],
+    ["B", "1", "CBC: HEMOGLOBIN", "12.5", "gm/dl"]
+    + ["1990-02-03 04:05:06.000"],
+]
+
+
+def test_lab_store_columns() -> None:
+    """Test that labs are encoded and grouped by patient."""
+    with fake_files(LABS) as filenames:
+        store = LabStore.from_file(filenames[0])
+
+    assert store.patient_ids == ["A", "B"]
+    assert store.offsets.tolist() == [0, 1, 3]
+    assert store.lab_ids.tolist() == [1, 0, 2]
+    assert store.names == ["METABOLIC: ALBUMIN", "CBC: HEMOGLOBIN"]
+    assert store.name_codes.tolist() == [0, 0, 1]
+    assert store.values.dtype == np.float64
+    assert store.timestamps.dtype == np.int64
+    assert store.lab_fields(2) == (
+        "CBC: HEMOGLOBIN",
+        12.5,
+        "gm/dl",
+        datetime(1990, 2, 3, 4, 5, 6),
+    )
+    assert store.patient_range("B") == range(1, 3)
+    assert store.patient_range("C") == range(0)
+    assert store.first_lab_dates().tolist() == [
+        datetime(1992, 7, 1, 1, 36, 17, 910000),
+        datetime(1990, 2, 3, 4, 5, 6),
+    ]
+    assert store.is_sick("METABOLIC: ALBUMIN", "<", 4).tolist() == [
+        False,
+        True,
+    ]
+    assert store.is_sick("CBC: HEMOGLOBIN", ">", 12).tolist() == [False, True]
+    assert store.is_sick("UNKNOWN", ">", 0).tolist() == [False, False]
+
+
+def test_parse_columnar() -> None:
+    """Test the patient API on top of the columnar store."""
+    with fake_files(PATIENTS, LABS) as filenames:
+        patient_b, patient_a = parse_columnar(filenames[0], filenames[1])
+
+    assert patient_a.patient_id == "A"
+    assert [lab.LabID for lab in patient_b.patient_labs] == ["0", "2"]
+    assert patient_b.patient_labs[1].LabName == "CBC: HEMOGLOBIN"
+    assert patient_b.patient_labs[0].LabValue == 3.2
+    assert patient_b.initial_age() == 38
+    assert patient_a.initial_age() == 44
+    assert patient_b.is_sick("METABOLIC: ALBUMIN", "<", 4.0)
+    assert not patient_a.is_sick("METABOLIC: ALBUMIN", "<", 4.0)
@@ -0,0 +1,42 @@
+"""Testing the parallel ingest."""
+import pathlib
+from benchmarks.synthetic import write_synthetic_files
+from ehr_connection import using_database
+from ehr_module import parse_data
+from ehr_schema import LAB_COLUMNS
+from parallel_ingest import read_chunks_parallel, split_byte_ranges
+from tsv_reader import read_rows
+
+
+def test_split_byte_ranges(tmp_path: pathlib.Path) -> None:
+    """Test that ranges cover the body and end on line boundaries."""
+    filename = tmp_path / "labs.txt"
+    filename.write_bytes(b"PatientID\tLabName\nA\tx\nBB\ty\r\nCCC\tz")
+    headers, ranges = split_byte_ranges(str(filename), range_bytes=3)
+    assert headers == ["PatientID", "LabName"]
+    assert ranges == [(18, 22), (22, 28), (28, 33)]
+
+
+def test_parallel_matches_sequential(tmp_path: pathlib.Path) -> None:
+    """Test that parallel parsing keeps rows and LabIDs in file order."""
+    patient_filename = str(tmp_path / "patients.txt")
+    lab_filename = str(tmp_path / "labs.txt")
+    write_synthetic_files(patient_filename, lab_filename, 500)
+
+    chunks = list(
+        read_chunks_parallel(lab_filename, LAB_COLUMNS, 2, range_bytes=4096)
+    )
+    assert len(chunks) > 2
+    rows = [row for chunk in chunks for row in chunk]
+    assert rows == list(read_rows(lab_filename, LAB_COLUMNS))
+
+    with using_database(str(tmp_path / "sequential.db")):
+        sequential = parse_data(patient_filename, lab_filename)
+    with using_database(str(tmp_path / "parallel.db")):
+        parallel = parse_data(patient_filename, lab_filename, workers=2)
+    assert [
+        [(lab.LabID, lab.LabValue) for lab in p.patient_labs]
+        for p in sequential
+    ] == [
+        [(lab.LabID, lab.LabValue) for lab in p.patient_labs] for p in parallel
+    ]
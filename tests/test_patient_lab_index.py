@@ -0,0 +1,136 @@
+"""Testing the per-patient lab index."""
+from datetime import datetime
+import pathlib
+import pytest
+from benchmarks.synthetic import write_synthetic_files
+from ehr_connection import using_database
+from ehr_module import DatabaseLabIndex, parse_data
+from fake_files import fake_files
+from patient_lab_index import PatientLabIndex
+
+ENTRIES = [
+    ("A", "CBC: HEMOGLOBIN", datetime(2001, 3, 1), 12.0, "a3"),
+    ("B", "METABOLIC: ALBUMIN", datetime(2000, 1, 1), 3.2, "b1"),
+    ("A", "METABOLIC: ALBUMIN", datetime(2002, 1, 1), 4.6, "a2"),
+    ("A", "METABOLIC: ALBUMIN", datetime(2000, 1, 1), 3.1, "a1"),
+    ("A", "CBC: HEMOGLOBIN", datetime(2001, 3, 1), 13.0, "a4"),
+]
+
+
+def test_labs_by_name_and_date() -> None:
+    """Test that labs are grouped by name and sorted by date."""
+    index = PatientLabIndex(ENTRIES)
+    assert len(index) == 5
+    assert "A" in index and "C" not in index
+    assert index.lab_names("A") == ["CBC: HEMOGLOBIN", "METABOLIC: ALBUMIN"]
+    assert index.labs("A") == ["a3", "a4", "a1", "a2"]
+    assert index.labs("A", "METABOLIC: ALBUMIN") == ["a1", "a2"]
+    assert index.labs("B", "CBC: HEMOGLOBIN") == []
+    assert index.labs("C") == []
+
+
+def test_date_range() -> None:
+    """Test that both ends of a date range are inclusive."""
+    index = PatientLabIndex(ENTRIES)
+    albumin = "METABOLIC: ALBUMIN"
+    assert index.labs("A", albumin, start=datetime(2000, 1, 2)) == ["a2"]
+    assert index.labs("A", albumin, end=datetime(2000, 1, 1)) == ["a1"]
+    assert index.labs(
+        "A", start=datetime(2001, 3, 1), end=datetime(2001, 3, 1)
+    ) == ["a3", "a4"]
+    assert index.labs("A", start=datetime(2003, 1, 1)) == []
+
+
+def test_is_sick() -> None:
+    """Test is_sick against the value bounds of a group."""
+    index = PatientLabIndex(ENTRIES)
+    assert index.is_sick("A", "METABOLIC: ALBUMIN", "<", 3.5)
+    assert index.is_sick("A", "METABOLIC: ALBUMIN", ">", 4.5)
+    assert not index.is_sick("A", "CBC: HEMOGLOBIN", ">", 13.0)
+    assert not index.is_sick("C", "CBC: HEMOGLOBIN", ">", 0)
+    with pytest.raises(ValueError):
+        index.is_sick("A", "CBC: HEMOGLOBIN", "=", 12.0)
+
+
+def test_parse_data_patient_without_labs(tmp_database: str) -> None:
+    """Test that a patient without labs is parsed with no labs."""
+    fake_patient = [
+        [
+            "PatientID",
+            "PatientGender",
+            "PatientDateOfBirth",
+            "PatientRace",
+            "PatientMaritalStatus",
+            "PatientLanguage",
+            "PatientPopulationPercentageBelowPoverty",
+        ],
+        ["A", "Male", "1947-12-28 02:45:40.547", "Unknown", "", "", ""],
+        ["B", "Female", "1952-01-18 19:51:12.917", "White", "", "", ""],
+    ]
+    fake_lab = [
+        [
+            "PatientID",
+            "AdmissionID",
+            "LabName",
+            "LabValue",
+            "LabUnits",
+            "LabDateTime",
+        ],
+        [
+            "A",
+            "1",
+            "METABOLIC: ALBUMIN",
+            "4.6",
+            "gm/dL",
+            "1993-01-04 11:02:03.110",
+        ],
+        [
+            "A",
+            "1",
+            "METABOLIC: ALBUMIN",
+            "3.1",
+            "gm/dL",
+            "1992-07-01 01:36:17.910",
+        ],
+    ]
+    for lazy in (False, True):
+        with fake_files(fake_patient, fake_lab) as filenames:
+            patient_a, patient_b = parse_data(
+                filenames[0], filenames[1], lazy=lazy
+            )
+        assert [lab.LabValue for lab in patient_a.patient_labs] == [3.1, 4.6]
+        assert patient_a.is_sick("METABOLIC: ALBUMIN", "<", 3.5)
+        assert patient_b.patient_labs == []
+        assert not patient_b.is_sick("METABOLIC: ALBUMIN", "<", 3.5)
+
+
+def test_database_index_matches(tmp_path: pathlib.Path) -> None:
+    """Test that lazy patients' database index answers like the index."""
+    patient_filename = str(tmp_path / "patients.txt")
+    lab_filename = str(tmp_path / "labs.txt")
+    write_synthetic_files(patient_filename, lab_filename, 2_000)
+    with using_database(str(tmp_path / "hydrated.db")):
+        hydrated = parse_data(patient_filename, lab_filename)
+    with using_database(str(tmp_path / "lazy.db")):
+        lazy = parse_data(patient_filename, lab_filename, lazy=True)
+        database_index = lazy[0].lab_index
+        assert isinstance(database_index, DatabaseLabIndex)
+        index = hydrated[0].lab_index
+        assert isinstance(index, PatientLabIndex)
+        assert len(database_index) == len(index)
+        start, end = datetime(1990, 1, 1), datetime(2005, 1, 1)
+        for patient in hydrated:
+            patient_id = patient.patient_id
+            assert (patient_id in database_index) == (patient_id in index)
+            names = index.lab_names(patient_id)
+            assert database_index.lab_names(patient_id) == names
+            for lab_name in [None, *names[:2]]:
+                assert [
+                    lab.LabID
+                    for lab in database_index.labs(
+                        patient_id, lab_name, start, end
+                    )
+                ] == [
+                    lab.LabID
+                    for lab in index.labs(patient_id, lab_name, start, end)
+                ]
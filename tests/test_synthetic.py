@@ -0,0 +1,39 @@
+"""Testing the synthetic EHR generator and the benchmark runner."""
+import pathlib
+from benchmarks import run
+from benchmarks.synthetic import write_synthetic_files
+from ehr_connection import using_database
+from ehr_module import parse_data
+
+
+def test_synthetic_files_are_deterministic(tmp_path: pathlib.Path) -> None:
+    """Test that a seed always generates the same files."""
+    first = (str(tmp_path / "p1.txt"), str(tmp_path / "l1.txt"))
+    second = (str(tmp_path / "p2.txt"), str(tmp_path / "l2.txt"))
+    assert write_synthetic_files(*first, 1_000, seed=3) == (10, 1_000)
+    write_synthetic_files(*second, 1_000, seed=3)
+    for a, b in zip(first, second):
+        assert pathlib.Path(a).read_text() == pathlib.Path(b).read_text()
+
+    with using_database(str(tmp_path / "ehr.db")):
+        patients = parse_data(*first)
+    assert len(patients) == 10
+    lab_counts = sorted(len(p.patient_labs) for p in patients)
+    assert sum(lab_counts) == 1_000
+    # Labs per patient are skewed rather than uniform
+    assert lab_counts[-1] > 2 * lab_counts[0]
+
+
+def test_regressions() -> None:
+    """Test flagging scenarios slower than the baseline."""
+    baseline = {
+        "results": [{"name": "a", "min": 1.0}, {"name": "b", "min": 1.0}]
+    }
+    report = {
+        "results": [
+            {"name": "a", "min": 1.1},
+            {"name": "b", "min": 2.0},
+            {"name": "c", "min": 5.0},
+        ]
+    }
+    assert run.regressions(report, baseline) == ["b: 1.0000s -> 2.0000s"]
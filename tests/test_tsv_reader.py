@@ -0,0 +1,48 @@
+"""Testing the TSV reader."""
+import pathlib
+import pytest
+from fake_files import fake_files
+from tsv_reader import read_chunks, read_rows
+
+
+def test_read_rows_reorders_columns() -> None:
+    """Test that rows follow the requested column order."""
+    fake_table = [
+        ["LabValue", "PatientID", "LabName"],
+        ["1.8", "A", "URINALYSIS: RED BLOOD CELLS"],
+        ["4.1", "B", "METABOLIC: ALBUMIN"],
+    ]
+    with fake_files(fake_table) as filenames:
+        rows = list(
+            read_rows(
+                filenames[0],
+                ["PatientID", "LabValue"],
+                converters={"LabValue": float},
+            )
+        )
+    assert rows == [("A", 1.8), ("B", 4.1)]
+
+
+def test_read_rows_trailing_newlines(tmp_path: pathlib.Path) -> None:
+    """Test that trailing newlines and blank lines are skipped."""
+    filename = tmp_path / "patients.txt"
+    filename.write_text(
+        "PatientID\tPatientGender\r\nA\tMale\r\n\nB\tFemale\n\n"
+    )
+    rows = list(read_rows(str(filename), ["PatientID"]))
+    assert rows == [("A",), ("B",)]
+
+
+def test_read_chunks() -> None:
+    """Test that rows are grouped into chunks."""
+    fake_table = [["PatientID"], ["A"], ["B"], ["C"]]
+    with fake_files(fake_table) as filenames:
+        chunks = list(read_chunks(filenames[0], ["PatientID"], 2))
+    assert chunks == [[("A",), ("B",)], [("C",)]]
+
+
+def test_read_rows_missing_column() -> None:
+    """Test that a missing column is reported."""
+    with fake_files([["PatientID"], ["A"]]) as filenames:
+        with pytest.raises(ValueError, match="LabName"):
+            list(read_rows(filenames[0], ["PatientID", "LabName"]))